@@ -0,0 +1,220 @@
+"""
+時間のかかる比較処理をバックグラウンドで実行するジョブ管理モジュール
+
+ジョブはプロセス内のワーカープールで実行され、進捗や途中結果をイベントとして記録する。
+クライアントはジョブIDでステータスを取得するか、Server-Sent Events でイベントを受け取る。
+"""
+
+from __future__ import annotations
+
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Any, Callable, Deque, Dict, Iterator, Optional
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+_DEFAULT_MAX_WORKERS = 4
+# 完了したジョブを保持しておく秒数
+_DEFAULT_RETENTION_SECONDS = 60 * 60
+# ジョブごとに保持するイベント数の上限 (最終結果は result にも保持する)
+_DEFAULT_MAX_EVENTS = 1000
+# SSE 接続を維持するためのコメント送信間隔
+_KEEPALIVE_SECONDS = 15
+
+
+class JobError(Exception):
+    """ジョブの失敗理由と HTTP ステータスコードを保持する例外"""
+
+    def __init__(self, message: str, status_code: int = 500):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class Job:
+    """
+    1 件のジョブの状態とイベント履歴
+
+    イベントは新しい max_events 件だけを保持し、それより古いイベントは手放す。
+    最後のイベント (result / error) は常に保持されるため、後から接続しても最終結果は受け取れる
+    """
+
+    def __init__(self, job_id: str, max_events: int = _DEFAULT_MAX_EVENTS):
+        self.id = job_id
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.status_code = 200
+        self.events: Deque[Dict[str, Any]] = deque(maxlen=max(1, max_events))
+        # これまでに記録したイベントの数 (次のイベントID)
+        self._event_count = 0
+        self._condition = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self.status in (SUCCEEDED, FAILED)
+
+    def emit(self, event: str, data: Any = None) -> None:
+        """イベントを記録し、待機中のクライアントに通知する"""
+        with self._condition:
+            self._append(event, data)
+            self._condition.notify_all()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """ジョブの完了を待つ。タイムアウトした場合は False"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self.done, timeout)
+
+    def iter_events(self, start: int = 0) -> Iterator[Optional[Dict[str, Any]]]:
+        """
+        ID が start 以降のイベントを順に返し、ジョブ完了後の最後のイベントで終了する
+
+        保持数の上限を超えて手放したイベントは飛ばし、保持している最も古いイベントから返す。
+        新しいイベントが一定時間来なかった場合は None を返す (キープアライブ用)
+        """
+        index = start
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: index < self._event_count or self.done, _KEEPALIVE_SECONDS
+                )
+                first_id = self._event_count - len(self.events)
+                index = max(index, first_id)
+                pending = list(islice(self.events, index - first_id, None))
+                finished = self.done
+            if not pending and not finished:
+                yield None
+                continue
+
+            for event in pending:
+                yield event
+            index += len(pending)
+
+            if finished and index >= self._event_count:
+                return
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "event_count": self._event_count,
+            "result": self.result,
+            "error": self.error,
+        }
+
+    def _finish(
+        self,
+        status: str,
+        result: Any = None,
+        error: Optional[str] = None,
+        status_code: int = 200,
+    ) -> None:
+        with self._condition:
+            self.status = status
+            self.result = result
+            self.error = error
+            self.status_code = status_code
+            self.finished_at = time.time()
+            if status == SUCCEEDED:
+                self._append("result", result)
+            else:
+                self._append("error", {"error": error})
+            self._condition.notify_all()
+
+    def _append(self, event: str, data: Any) -> None:
+        self.events.append({"id": self._event_count, "event": event, "data": data})
+        self._event_count += 1
+
+
+class JobManager:
+    """
+    ワーカープールでジョブを実行し、ジョブIDで参照できるようにする
+
+    引数:
+        max_workers: 同時に実行するジョブ数
+        retention_seconds: 完了したジョブを保持する秒数
+        max_events: ジョブごとに保持するイベント数の上限
+    """
+
+    def __init__(
+        self,
+        max_workers: int = _DEFAULT_MAX_WORKERS,
+        retention_seconds: float = _DEFAULT_RETENTION_SECONDS,
+        max_events: int = _DEFAULT_MAX_EVENTS,
+    ):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="job"
+        )
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._retention_seconds = retention_seconds
+        self._max_events = max_events
+
+    def submit(self, func: Callable[[Job], Any]) -> Job:
+        """
+        ジョブを登録する。func はジョブを受け取り、結果を返す
+
+        func が JobError を送出した場合は、その HTTP ステータスコードで失敗として記録する
+        """
+        self._purge()
+        job = Job(uuid.uuid4().hex, self._max_events)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, func)
+        return job
+
+    def run(self, func: Callable[[Job], Any]) -> Job:
+        """
+        ジョブを呼び出し元のスレッドで実行し、完了したジョブを返す
+
+        ワーカープールを使わず、ジョブIDでの参照もできない (結果を待つだけの同期 API 用)
+        """
+        job = Job(uuid.uuid4().hex, self._max_events)
+        self._run(job, func)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job: Job, func: Callable[[Job], Any]) -> None:
+        job.status = RUNNING
+        job.emit("status", {"status": RUNNING})
+        try:
+            result = func(job)
+        except JobError as exc:
+            job._finish(FAILED, error=str(exc), status_code=exc.status_code)
+        except Exception as exc:
+            job._finish(FAILED, error=str(exc), status_code=500)
+        else:
+            job._finish(SUCCEEDED, result=result)
+
+    def _purge(self) -> None:
+        threshold = time.time() - self._retention_seconds
+        with self._lock:
+            expired = [
+                job_id
+                for job_id, job in self._jobs.items()
+                if job.finished_at is not None and job.finished_at < threshold
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+
+def format_sse(event: Optional[Dict[str, Any]]) -> str:
+    """イベントを Server-Sent Events 形式の文字列にする (None はキープアライブ)"""
+    if event is None:
+        return ": keep-alive\n\n"
+    data = json.dumps(event["data"], ensure_ascii=False)
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {data}\n\n"
@@ -1,14 +1,32 @@
-import glob
 import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from pathlib import Path
 
-from flask import Flask, jsonify, render_template, request, send_from_directory
+from dotenv import load_dotenv
+from flask import (
+    Flask,
+    Response,
+    jsonify,
+    render_template,
+    request,
+    send_from_directory,
+)
+
+# マッチャーは初めて使うときに読み込まれるため、各モジュールが設定を読む前に .env を読み込んでおく
+load_dotenv()
 
-from hotel_matching.matcher import compare
+from apps.jobs import JobError, JobManager, format_sse
+from hotel_matching.hash_index import HashIndex
+from hotel_matching.matcher import compare_iter, compare_many, prepare
+from hotel_matching.matchers.gemini_cache import get_verdict_cache_stats
+from hotel_matching.matchers.phash_matcher import index_phash
+from hotel_matching.matchers.registry import get_matcher, warmup
 from hotel_matching.scraper import (
     extract_hotel_images_airtrip,
     extract_hotel_images_tour,
 )
+from hotel_matching.scraper.store import ImageStore
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -18,25 +36,62 @@ app = Flask(
     static_folder=str(BASE_DIR / "static"),
 )
 
-# 画像フォルダの設定
+# 画像フォルダの設定 (サイト・ホテルIDごとに保存し、TTL 内は再利用する)
 IMAGES_FOLDER = BASE_DIR / "images"
-IMAGES_FOLDER.mkdir(parents=True, exist_ok=True)
+IMAGE_STORE = ImageStore(
+    IMAGES_FOLDER,
+    ttl_seconds=float(os.getenv("HOTEL_MATCHING_IMAGE_TTL", "3600")),
+    gc_interval_seconds=float(os.getenv("HOTEL_MATCHING_IMAGE_GC_INTERVAL", "300")),
+    release_grace_seconds=float(os.getenv("HOTEL_MATCHING_IMAGE_RELEASE_GRACE", "600")),
+)
+
+# 設定されていればスクレイピングした画像の pHash をカタログ用インデックスに追記する
+_PHASH_INDEX_DIR = os.getenv("HOTEL_MATCHING_PHASH_INDEX_DIR")
+PHASH_INDEX = HashIndex(_PHASH_INDEX_DIR) if _PHASH_INDEX_DIR else None
+
+# 比較ジョブを実行するワーカープール
+JOBS = JobManager(
+    max_workers=int(os.getenv("HOTEL_MATCHING_JOB_WORKERS", "4")),
+    max_events=int(os.getenv("HOTEL_MATCHING_JOB_MAX_EVENTS", "1000")),
+)
 
+# 指定された手法 (例: "clip,feature") のモジュールとモデルを起動時に読み込み、
+# 最初のリクエストで読み込みを待たないようにする
+_PRELOAD_METHODS = [
+    name.strip()
+    for name in os.getenv("HOTEL_MATCHING_PRELOAD", "").split(",")
+    if name.strip()
+]
+if _PRELOAD_METHODS:
+    warmup(_PRELOAD_METHODS)
 
-def cleanup_images(pattern):
+
+def _scrape_and_prepare(site, scrape, hotel_id, methods):
     """
-    指定されたパターンに一致する画像を削除
+    ホテルの画像を (ダウンロード済みでなければスクレイピングして) 取得し、
+    続けて選択された手法の特徴量を事前計算する
+
+    事前計算の結果は特徴量キャッシュを経由して比較に渡される。
+    キャッシュが無効 (HOTEL_MATCHING_CACHE=0) の場合は事前計算を行わず、比較時に計算する
 
     引数:
-        pattern (str): 削除する画像のGlobパターン (例: "tour_12345_*")
+        site (str): 画像ストア上のサイト名
+        scrape: スクレイピング関数
+        hotel_id (str): スクレイピング対象のホテルID
+        methods (list[str]): マッチング手法名のリスト
+
+    戻り値:
+        Lease: 画像ファイルパスのリストを持つ lease (使用後に release する)
     """
-    files = glob.glob(str(IMAGES_FOLDER / pattern))
-    for file in files:
+    lease = IMAGE_STORE.checkout(site, hotel_id, scrape)
+    images = lease.images
+    for method in methods if images else []:
         try:
-            os.remove(file)
-            print(f"削除しました: {file}")
-        except Exception as e:
-            print(f"削除に失敗しました {file}: {e}")
+            prepare(method, images)
+        except Exception as exc:
+            # 事前計算に失敗しても比較時に改めて計算されるので処理は続ける
+            print(f"特徴量の事前計算に失敗しました: {exc}")
+    return lease
 
 
 @app.route("/")
@@ -45,81 +100,320 @@ def index():
     return render_template("index.html")
 
 
-@app.route("/api/scrape_and_compare", methods=["POST"])
-def scrape_and_compare():
+def _parse_compare_request(data):
     """
-    両サイトから画像をスクレイピングして比較
-    期待されるJSON: {"tour_id": "...", "airtrip_id": "...", "threshold": 0.9, "method": "hash"}
+    比較リクエストのJSONを検証して、比較に必要なパラメータを返す
+
+    引数:
+        data (dict): リクエストのJSON
+
+    method には手法名のリストも指定でき、その場合 threshold は手法名ごとの辞書でもよい。
+    top_k (任意) を指定すると、類似度の上位 top_k 件だけを返す
+
+    戻り値:
+        dict: tour_id, airtrip_id, threshold, method, methods (手法名のリスト), top_k
+
+    例外:
+        JobError: 入力が不正な場合 (ステータスコード 400)
     """
-    try:
-        data = request.get_json() or {}
-        tour_id = data.get("tour_id", "").strip()
-        airtrip_id = data.get("airtrip_id", "").strip()
-        raw_threshold = data.get("threshold")
-        method = data.get("method")
+    if not isinstance(data, dict):
+        raise JobError("リクエストはJSONオブジェクトで指定してください", 400)
+
+    tour_id = data.get("tour_id", "")
+    airtrip_id = data.get("airtrip_id", "")
+    raw_threshold = data.get("threshold")
+    method = data.get("method")
+
+    if not isinstance(tour_id, str) or not isinstance(airtrip_id, str):
+        raise JobError("tour_idとairtrip_idは文字列で指定してください", 400)
+    tour_id = tour_id.strip()
+    airtrip_id = airtrip_id.strip()
 
-        if not tour_id or not airtrip_id:
-            return jsonify({"error": "tour_idとairtrip_idの両方が必要です"}), 400
+    if not tour_id or not airtrip_id:
+        raise JobError("tour_idとairtrip_idの両方が必要です", 400)
 
-        if not method:
-            return jsonify({"error": "マッチング手法が指定されていません"}), 400
+    if not method:
+        raise JobError("マッチング手法が指定されていません", 400)
 
-        if raw_threshold is None:
-            return jsonify({"error": "閾値が指定されていません"}), 400
+    methods = [method] if isinstance(method, str) else method
+    if not isinstance(methods, list) or not all(
+        isinstance(m, str) and m for m in methods
+    ):
+        raise JobError("マッチング手法は文字列またはそのリストで指定してください", 400)
 
+    for name in methods:
         try:
+            get_matcher(name)
+        except ValueError as exc:
+            raise JobError(str(exc), 400) from exc
+
+    if raw_threshold is None:
+        raise JobError("閾値が指定されていません", 400)
+
+    try:
+        if isinstance(raw_threshold, dict) and not isinstance(method, str):
+            threshold = {name: float(raw_threshold[name]) for name in methods}
+        else:
             threshold = float(raw_threshold)
-        except (TypeError, ValueError):
-            return jsonify({"error": "閾値は数値で指定してください"}), 400
-
-        # ステップ1: 既存の画像をすべて削除
-        cleanup_images("*.jpg")
-        cleanup_images("*.png")
-        cleanup_images("*.webp")
-
-        # ステップ2: tour.ne.jpからスクレイピング
-        tour_images = extract_hotel_images_tour(tour_id)
-        if not tour_images:
-            return (
-                jsonify({"error": "tour.ne.jpからの画像ダウンロードに失敗しました"}),
-                500,
-            )
+    except KeyError as exc:
+        raise JobError(f"手法 {exc} の閾値が指定されていません", 400) from exc
+    except (TypeError, ValueError) as exc:
+        raise JobError("閾値は数値で指定してください", 400) from exc
+
+    top_k = data.get("top_k")
+    if top_k is not None and (
+        not isinstance(top_k, int) or isinstance(top_k, bool) or top_k < 1
+    ):
+        raise JobError("top_k は 1 以上の整数で指定してください", 400)
+
+    return {
+        "tour_id": tour_id,
+        "airtrip_id": airtrip_id,
+        "threshold": threshold,
+        "method": method,
+        "methods": methods,
+        "top_k": top_k,
+    }
+
+
+def _run_scrape_and_compare(job, params):
+    """
+    両サイトから画像をスクレイピングして比較するジョブ本体
+
+    進捗は job.emit で "progress" イベントとして、マッチ結果は "match" イベントとして通知する
+
+    引数:
+        job (Job): 実行中のジョブ
+        params (dict): _parse_compare_request の戻り値
 
-        # ステップ3: airtrip.jpからスクレイピング
-        airtrip_images = extract_hotel_images_airtrip(airtrip_id)
-        if not airtrip_images:
-            return (
-                jsonify({"error": "airtrip.jpからの画像ダウンロードに失敗しました"}),
-                500,
+    戻り値:
+        dict: 比較結果のレスポンス
+    """
+    tour_id = params["tour_id"]
+    airtrip_id = params["airtrip_id"]
+    methods = params["methods"]
+
+    # ステップ1: 使用中でない古い画像の削除を (前回から一定時間経っていれば) 別スレッドで始める
+    IMAGE_STORE.collect_garbage_in_background()
+
+    # ステップ2: 両サイトから並行してスクレイピングし、
+    # 先に取得できた側から特徴量の事前計算を始める
+    job.emit("progress", {"stage": "scraping"})
+    with ExitStack() as stack:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            tour_future = executor.submit(
+                _scrape_and_prepare, "tour", extract_hotel_images_tour, tour_id, methods
             )
+            airtrip_future = executor.submit(
+                _scrape_and_prepare,
+                "airtrip",
+                extract_hotel_images_airtrip,
+                airtrip_id,
+                methods,
+            )
+
+        # 比較が終わるまで画像が削除されないように lease を保持する
+        for future in (tour_future, airtrip_future):
+            if future.exception() is None:
+                stack.callback(future.result().release)
+
+        tour_images = tour_future.result().images
+        airtrip_images = airtrip_future.result().images
+        return _compare_images(job, params, tour_images, airtrip_images)
+
+
+def _compare_images(job, params, tour_images, airtrip_images):
+    """スクレイピングした画像を選択された手法で比較し、レスポンスを組み立てる"""
+    threshold = params["threshold"]
+    method = params["method"]
+    top_k = params.get("top_k")
+
+    if not tour_images:
+        raise JobError("tour.ne.jpからの画像ダウンロードに失敗しました", 500)
+
+    if not airtrip_images:
+        raise JobError("airtrip.jpからの画像ダウンロードに失敗しました", 500)
+
+    job.emit(
+        "progress",
+        {
+            "stage": "scraped",
+            "tour_count": len(tour_images),
+            "airtrip_count": len(airtrip_images),
+        },
+    )
 
-        # ステップ4: 選択されたマッチング方法で比較
+    if PHASH_INDEX is not None:
         try:
-            matches = compare(method, tour_images, airtrip_images, threshold)
-        except ValueError as exc:
-            return jsonify({"error": str(exc)}), 400
-        except RuntimeError as exc:
-            return jsonify({"error": str(exc)}), 500
+            # 古いバージョンの画像は削除されるため、バージョンによらない ID で登録する
+            index_phash(
+                tour_images + airtrip_images, PHASH_INDEX, key=IMAGE_STORE.image_key
+            )
+        except Exception as exc:
+            print(f"pHashインデックスの更新に失敗しました: {exc}")
 
-        match_count = sum(1 for match in matches if match.get("passed_threshold", True))
-        return jsonify(
-            {
-                "success": True,
-                "tour_count": len(tour_images),
-                "airtrip_count": len(airtrip_images),
-                "total_comparisons": len(tour_images) * len(airtrip_images),
-                "matches": matches,
-                "match_count": match_count,
-                "threshold": threshold,
-                "method": method,
-            }
-        )
+    # ステップ3: 選択されたマッチング方法で比較
+    job.emit("progress", {"stage": "matching", "method": method})
+    stats = None
+    try:
+        if isinstance(method, str):
+            # 全ペアの比較を待たずに、見つかった結果から順に通知する
+            stream = compare_iter(
+                method, tour_images, airtrip_images, threshold, top_k=top_k
+            )
+            matches = []
+            for match in stream:
+                job.emit("match", match)
+                matches.append(match)
+            stats = stream.stats
+        else:
+            matches = compare_many(method, tour_images, airtrip_images, threshold)
+    except ValueError as exc:
+        raise JobError(str(exc), 400) from exc
+    except RuntimeError as exc:
+        raise JobError(str(exc), 500) from exc
+
+    response = {
+        "success": True,
+        "tour_count": len(tour_images),
+        "airtrip_count": len(airtrip_images),
+        "total_comparisons": len(tour_images) * len(airtrip_images),
+        "threshold": threshold,
+        "method": method,
+        "tour_image_base": _image_base(tour_images),
+        "airtrip_image_base": _image_base(airtrip_images),
+    }
+
+    if isinstance(method, str):
+        matches.sort(key=lambda x: x["similarity"], reverse=True)
+        response.update(_summarize_matches(matches, stats))
+        return response
+
+    # 複数の手法: 手法ごとの結果と、画像ペアごとの統合結果を返す
+    for method_matches in matches["results"].values():
+        for match in method_matches:
+            job.emit("match", match)
+    response["results"] = {
+        name: _summarize_matches(method_matches[:top_k], matches["stats"].get(name))
+        for name, method_matches in matches["results"].items()
+    }
+    response["errors"] = matches["errors"]
+    response["matches"] = matches["fused"][:top_k]
+    response["match_count"] = len(response["matches"])
+    return response
+
+
+def _summarize_matches(matches, stats=None):
+    """1 つの手法のマッチ結果と一致件数 (カスケード型の手法は段階ごとの統計も) を返す"""
+    summary = {
+        "matches": matches,
+        "match_count": sum(
+            1 for match in matches if match.get("passed_threshold", True)
+        ),
+    }
+    # カスケード型の手法は段階ごとの処理時間と絞り込み件数を返す
+    if stats is not None:
+        summary["stats"] = stats
+    return summary
 
+
+def _image_base(images):
+    """画像が保存されているディレクトリの URL"""
+    return "/images/" + IMAGE_STORE.url_path(os.path.dirname(images[0]))
+
+
+def _compare_request_params():
+    # 不正な JSON もパラメータの検証エラーと同じく 400 で返す
+    data = request.get_json(silent=True)
+    return _parse_compare_request({} if data is None else data)
+
+
+@app.route("/api/scrape_and_compare", methods=["POST"])
+def scrape_and_compare():
+    """
+    両サイトから画像をスクレイピングして比較 (ジョブの完了を待って結果を返す)
+    期待されるJSON: {"tour_id": "...", "airtrip_id": "...", "threshold": 0.9, "method": "hash"}
+    """
+    try:
+        params = _compare_request_params()
+        # リクエストのスレッドで実行し、非同期ジョブのワーカーは使わない
+        job = JOBS.run(lambda job: _run_scrape_and_compare(job, params))
+        if job.error is not None:
+            return jsonify({"error": job.error}), job.status_code
+        return jsonify(job.result)
+
+    except JobError as exc:
+        return jsonify({"error": str(exc)}), exc.status_code
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/images/<filename>")
+@app.route("/api/jobs", methods=["POST"])
+def submit_job():
+    """
+    比較ジョブを登録してジョブIDを返す
+    期待されるJSONは /api/scrape_and_compare と同じ
+    """
+    try:
+        params = _compare_request_params()
+        job = JOBS.submit(lambda job: _run_scrape_and_compare(job, params))
+    except JobError as exc:
+        return jsonify({"error": str(exc)}), exc.status_code
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    return (
+        jsonify(
+            {
+                "job_id": job.id,
+                "status": job.status,
+                "status_url": f"/api/jobs/{job.id}",
+                "events_url": f"/api/jobs/{job.id}/events",
+            }
+        ),
+        202,
+    )
+
+
+@app.route("/api/jobs/<job_id>")
+def job_status(job_id):
+    """ジョブのステータスと (完了していれば) 結果を返す"""
+    job = JOBS.get(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません"}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route("/api/jobs/<job_id>/events")
+def job_events(job_id):
+    """ジョブのイベントを Server-Sent Events で配信する"""
+    job = JOBS.get(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません"}), 404
+
+    try:
+        start = int(request.headers.get("Last-Event-ID", "-1")) + 1
+    except ValueError:
+        start = 0
+
+    def stream():
+        for event in job.iter_events(start):
+            yield format_sse(event)
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/api/gemini/cache_stats")
+def gemini_cache_stats():
+    """Gemini 判定キャッシュのヒット数・ミス数と短縮できた時間の見積もりを返す"""
+    return jsonify(get_verdict_cache_stats())
+
+
+@app.route("/images/<path:filename>")
 def serve_image(filename):
     """imagesフォルダから画像を配信"""
     return send_from_directory(str(IMAGES_FOLDER), filename)
@@ -0,0 +1,565 @@
+"""
+ホテルIDの対応表をまとめて照合するバッチ処理
+
+(tour_id, airtrip_id) のペアを CSV / JSONL から読み込み、ペアごとの照合結果を
+JSONL (pyarrow があれば Parquet) に書き出す。
+
+- スクレイピング・特徴量の事前計算を行うスレッドと、比較を行うスレッドを分けてパイプライン化する
+- 画像は ImageStore で共有するため、複数のペアに現れるホテルは 1 回だけスクレイピングする
+- 結果は 1 ペアごとに JSONL へ追記するので、中断しても再実行すると未完了のペアから再開する
+- HOTEL_MATCHING_PHASH_INDEX_DIR を設定すると、取得した画像の pHash をインデックスに登録する
+
+使い方:
+    uv run python -m hotel_matching.batch pairs.csv results.jsonl --method phash --threshold 0.9
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+from .hash_index import HashIndex
+from .matcher import Threshold, compare_iter, compare_many, prepare
+from .matchers.phash_matcher import index_phash
+from .matchers.registry import get_matcher
+from .scraper import extract_hotel_images_airtrip, extract_hotel_images_tour
+from .scraper.store import ImageStore, Lease
+
+Pair = Tuple[str, str]
+
+_DEFAULT_IMAGES_DIR = "images"
+_DEFAULT_SCRAPE_WORKERS = 8
+# Parquet に出力する場合、途中経過はこの拡張子を付けた JSONL に保存する
+_PARTIAL_SUFFIX = ".partial.jsonl"
+# 各行に記録する照合条件。途中経過と条件が異なる場合は再開しない
+_PARAM_KEYS = ("method", "threshold", "top_k")
+
+
+def read_pairs(path: str | os.PathLike) -> List[Pair]:
+    """
+    照合するIDのペアを読み込む
+
+    CSV はヘッダー行に tour_id, airtrip_id の列を、JSONL は各行に同名のキーを持つこと。
+    IDが欠けている行は読み飛ばし、重複するペアは 1 つにまとめる
+    """
+    path = Path(path)
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.suffix.lower() == ".jsonl":
+            rows = _read_jsonl_rows(f)
+        else:
+            rows = csv.DictReader(f)
+            if not {"tour_id", "airtrip_id"} <= set(rows.fieldnames or ()):
+                raise ValueError(
+                    f"{path} に tour_id, airtrip_id の列がありません (ヘッダー行が必要です)"
+                )
+        pairs = []
+        for line_number, row in enumerate(rows, start=1):
+            tour_id = str(row.get("tour_id") or "").strip()
+            airtrip_id = str(row.get("airtrip_id") or "").strip()
+            if not tour_id or not airtrip_id:
+                print(f"{path}: {line_number} 件目のIDが欠けているため読み飛ばします")
+                continue
+            pairs.append((tour_id, airtrip_id))
+    return list(dict.fromkeys(pairs))
+
+
+def load_completed(
+    path: str | os.PathLike, params: Optional[Dict[str, Any]] = None
+) -> Set[Pair]:
+    """
+    途中経過の JSONL から、照合が完了したペアを返す
+
+    失敗したペアは完了とみなさず、再実行時にもう一度処理する。
+    中断によって最終行が途中までしか書かれていない場合は、その行を切り詰める
+
+    引数:
+        params: 今回の照合条件 (method, threshold, top_k)。指定すると、
+            異なる条件で書かれた行があれば再開せずに ValueError を送出する
+    """
+    path = Path(path)
+    if not path.exists():
+        return set()
+
+    _truncate_partial_line(path)
+    latest = {}
+    with open(path, encoding="utf-8") as f:
+        for record in _read_jsonl_rows(f):
+            if params is not None and _record_params(record) != params:
+                raise ValueError(
+                    f"{path} は異なる条件で実行した途中経過です "
+                    f"(途中経過: {_record_params(record)}, 今回: {params})。"
+                    "同じ条件で再実行するか、別の出力先を指定してください"
+                )
+            latest[(record["tour_id"], record["airtrip_id"])] = record["status"]
+    return {pair for pair, status in latest.items() if status == "ok"}
+
+
+def run_batch(
+    pairs: List[Pair],
+    output: str | os.PathLike,
+    method: str | List[str],
+    threshold: Threshold,
+    *,
+    store: ImageStore,
+    workers: int = 0,
+    scrape_workers: int = _DEFAULT_SCRAPE_WORKERS,
+    top_k: Optional[int] = None,
+    phash_index: Optional[HashIndex] = None,
+) -> Dict[str, int]:
+    """
+    IDのペアを照合して結果を output に書き出す
+
+    引数:
+        pairs: (tour_id, airtrip_id) のリスト
+        output: 出力ファイル (.jsonl または .parquet)
+        method: マッチング手法名 (リストを渡すと複数の手法で比較する)
+        threshold: 類似度の閾値 (複数の手法では手法名ごとの辞書も指定できる)
+        store: スクレイピングした画像を保存する ImageStore
+        workers: 比較を行うスレッド数 (0 なら CPU 数)
+        scrape_workers: スクレイピングと特徴量の事前計算を行うスレッド数
+        top_k: 指定すると、ペアごとに類似度の上位 top_k 件のマッチ結果だけを出力する
+        phash_index: 指定すると、取得した画像の pHash を登録する (再取得した画像は置き換える)
+
+    戻り値:
+        dict: total (入力のペア数), skipped (前回までに完了していたペア数),
+        succeeded, failed
+    """
+    if top_k is not None and top_k < 1:
+        raise ValueError("top_k は 1 以上で指定してください")
+    methods = [method] if isinstance(method, str) else list(method)
+    for name in methods:
+        # 不明な手法名はすべてのペアが失敗するので、照合を始める前に知らせる
+        get_matcher(name)
+
+    output = Path(output)
+    parquet = output.suffix.lower() == ".parquet"
+    if parquet:
+        # 照合を始める前に、Parquet を書き出せない環境であることを知らせる
+        _import_pyarrow()
+    checkpoint = output.with_name(output.name + _PARTIAL_SUFFIX) if parquet else output
+    checkpoint.parent.mkdir(parents=True, exist_ok=True)
+
+    # JSON に書き出して読み直した値と比べるため、一度 JSON を通しておく
+    params = json.loads(
+        json.dumps({"method": method, "threshold": threshold, "top_k": top_k})
+    )
+    completed = load_completed(checkpoint, params)
+    pending = [pair for pair in pairs if pair not in completed]
+    workers = workers if workers > 0 else (os.cpu_count() or 1)
+
+    # 起動時に一度削除し、実行中はペアを処理し終えるたびに一定間隔で削除する
+    store.collect_garbage()
+    with open(checkpoint, "a", encoding="utf-8") as f:
+        writer = _ResultWriter(f, total=len(pending))
+        _Pipeline(
+            methods=methods,
+            method=method,
+            threshold=threshold,
+            params=params,
+            store=store,
+            writer=writer,
+            workers=workers,
+            scrape_workers=max(1, scrape_workers),
+            top_k=top_k,
+            phash_index=phash_index,
+        ).run(pending)
+
+    if parquet:
+        _write_parquet(checkpoint, output)
+
+    return {
+        "total": len(pairs),
+        "skipped": len(pairs) - len(pending),
+        "succeeded": writer.succeeded,
+        "failed": writer.failed,
+    }
+
+
+class _ResultWriter:
+    """照合結果を 1 ペアずつ追記するスレッドセーフなライター"""
+
+    def __init__(self, f, total: int):
+        self._f = f
+        self._lock = threading.Lock()
+        self.total = total
+        self.succeeded = 0
+        self.failed = 0
+
+    def write(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False, default=_json_default)
+        with self._lock:
+            self._f.write(line + "\n")
+            # 中断しても書き終えたペアは再実行時に読み飛ばせるよう、1 行ごとに書き出す
+            self._f.flush()
+            if record["status"] == "ok":
+                self.succeeded += 1
+            else:
+                self.failed += 1
+            done = self.succeeded + self.failed
+            detail = (
+                f"{record['match_count']} 件一致"
+                if record["status"] == "ok"
+                else f"失敗: {record['error']}"
+            )
+        print(
+            f"[{done}/{self.total}] tour={record['tour_id']} "
+            f"airtrip={record['airtrip_id']}: {detail}"
+        )
+
+
+class _Pipeline:
+    """
+    スクレイピング → 特徴量の事前計算 → 比較 をペアごとに流すパイプライン
+
+    スクレイピングはネットワーク待ち、比較は CPU 処理が中心なので、それぞれ別のスレッドプールで実行する。
+    先行してスクレイピングしたペアの画像がディスクに溜まりすぎないよう、処理中のペア数に上限を設ける
+    """
+
+    def __init__(
+        self,
+        *,
+        methods: List[str],
+        method: str | List[str],
+        threshold: Threshold,
+        params: Dict[str, Any],
+        store: ImageStore,
+        writer: _ResultWriter,
+        workers: int,
+        scrape_workers: int,
+        top_k: Optional[int],
+        phash_index: Optional[HashIndex] = None,
+    ):
+        self.methods = methods
+        self.method = method
+        self.threshold = threshold
+        self.params = params
+        self.store = store
+        self.writer = writer
+        self.workers = workers
+        self.scrape_workers = scrape_workers
+        self.top_k = top_k
+        self.phash_index = phash_index
+        self._slots = threading.BoundedSemaphore(2 * (workers + scrape_workers))
+
+    def run(self, pairs: List[Pair]) -> None:
+        match_pool = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="batch-match"
+        )
+        scrape_pool = ThreadPoolExecutor(
+            max_workers=self.scrape_workers, thread_name_prefix="batch-scrape"
+        )
+        self._match_pool = match_pool
+        try:
+            for pair in pairs:
+                self._slots.acquire()
+                scrape_pool.submit(self._fetch, pair)
+        except KeyboardInterrupt:
+            print("中断しました。再実行すると未完了のペアから再開します")
+            scrape_pool.shutdown(cancel_futures=True)
+            match_pool.shutdown(cancel_futures=True)
+            raise
+        finally:
+            # スクレイピング側が比較を登録し終えてから、比較側の完了を待つ
+            scrape_pool.shutdown()
+            match_pool.shutdown()
+
+    def _fetch(self, pair: Pair) -> None:
+        start = time.perf_counter()
+        leases: List[Lease] = []
+        try:
+            for site, scrape, hotel_id in (
+                ("tour", extract_hotel_images_tour, pair[0]),
+                ("airtrip", extract_hotel_images_airtrip, pair[1]),
+            ):
+                lease = self.store.checkout(site, hotel_id, scrape)
+                leases.append(lease)
+                if not lease.images:
+                    raise RuntimeError(f"{site} の画像を取得できませんでした")
+                self._index_phash(lease.images)
+                for method in self.methods:
+                    try:
+                        prepare(method, lease.images)
+                    except Exception as exc:
+                        # 事前計算に失敗しても比較時に改めて計算されるので処理は続ける
+                        print(f"特徴量の事前計算に失敗しました: {exc}")
+            self._match_pool.submit(self._match, pair, leases, start)
+        except Exception as exc:
+            self._finish(pair, leases, start, error=exc)
+
+    def _index_phash(self, images: List[str]) -> None:
+        if self.phash_index is None:
+            return
+        try:
+            # 古いバージョンの画像は削除されるため、バージョンによらない ID で登録する
+            index_phash(images, self.phash_index, key=self.store.image_key)
+        except Exception as exc:
+            print(f"pHashインデックスの更新に失敗しました: {exc}")
+
+    def _match(self, pair: Pair, leases: List[Lease], start: float) -> None:
+        try:
+            summary = self._compare(leases[0].images, leases[1].images)
+        except Exception as exc:
+            self._finish(pair, leases, start, error=exc)
+            return
+        self._finish(pair, leases, start, summary=summary)
+
+    def _compare(self, images1: List[str], images2: List[str]) -> Dict[str, Any]:
+        """比較して、出力する 1 行分の値にまとめる"""
+        if not isinstance(self.method, str):
+            matches = compare_many(self.method, images1, images2, self.threshold)
+            fused = matches["fused"][: self.top_k]
+            return {
+                "matches": fused,
+                "match_count": len(fused),
+                "results": {
+                    name: method_matches[: self.top_k]
+                    for name, method_matches in matches["results"].items()
+                },
+                "errors": matches["errors"],
+                "stats": matches["stats"],
+            }
+
+        # top_k を指定すると、上位 top_k 件だけを保持しながら比較する
+        stream = compare_iter(
+            self.method, images1, images2, self.threshold, top_k=self.top_k
+        )
+        matches = sorted(stream, key=lambda x: x["similarity"], reverse=True)
+        summary: Dict[str, Any] = {
+            "matches": matches,
+            "match_count": sum(
+                1 for match in matches if match.get("passed_threshold", True)
+            ),
+        }
+        # カスケード型の手法は段階ごとの処理時間と絞り込み件数も残す
+        if stream.stats is not None:
+            summary["stats"] = stream.stats
+        return summary
+
+    def _finish(
+        self,
+        pair: Pair,
+        leases: List[Lease],
+        start: float,
+        *,
+        summary: Optional[Dict[str, Any]] = None,
+        error: Optional[Exception] = None,
+    ) -> None:
+        try:
+            record: Dict[str, Any] = {
+                "tour_id": pair[0],
+                "airtrip_id": pair[1],
+                **self.params,
+                "status": "error" if error is not None else "ok",
+            }
+            if error is not None:
+                record["error"] = str(error)
+            else:
+                record["tour_count"] = len(leases[0].images)
+                record["airtrip_count"] = len(leases[1].images)
+                record.update(summary)
+            record["seconds"] = time.perf_counter() - start
+            self.writer.write(record)
+        finally:
+            for lease in leases:
+                lease.release()
+            self._slots.release()
+            # 長時間の実行でも、解放された古いバージョンの画像が溜まり続けないようにする
+            self.store.collect_garbage_in_background()
+
+
+def _record_params(record: dict) -> Dict[str, Any]:
+    return {key: record[key] for key in _PARAM_KEYS if key in record}
+
+
+def _read_jsonl_rows(f) -> Iterator[dict]:
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def _truncate_partial_line(path: Path) -> None:
+    """改行で終わっていない最終行 (書き込み途中で中断された行) を取り除く"""
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+
+def _json_default(value: Any) -> Any:
+    # NumPy のスカラーなど、json が扱えない数値を Python の値に変換する
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"JSON に変換できない値です: {value!r}")
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet  # noqa: F401
+    except ImportError as exc:
+        raise RuntimeError(
+            "Parquet で出力するには pyarrow が必要です (uv add pyarrow)"
+        ) from exc
+    return pyarrow
+
+
+def _write_parquet(checkpoint: Path, output: Path) -> None:
+    """
+    途中経過の JSONL を Parquet に変換する
+
+    マッチ結果は構造が手法ごとに異なるため、result 列に JSON 文字列として格納する
+    """
+    pa = _import_pyarrow()
+    latest: Dict[Pair, dict] = {}
+    with open(checkpoint, encoding="utf-8") as f:
+        for record in _read_jsonl_rows(f):
+            latest[(record["tour_id"], record["airtrip_id"])] = record
+
+    columns: Dict[str, list] = {
+        "tour_id": [],
+        "airtrip_id": [],
+        "status": [],
+        "match_count": [],
+        "error": [],
+        "seconds": [],
+        "result": [],
+    }
+    for record in latest.values():
+        columns["tour_id"].append(record["tour_id"])
+        columns["airtrip_id"].append(record["airtrip_id"])
+        columns["status"].append(record["status"])
+        columns["match_count"].append(record.get("match_count"))
+        columns["error"].append(record.get("error"))
+        columns["seconds"].append(record.get("seconds"))
+        columns["result"].append(json.dumps(record, ensure_ascii=False))
+
+    schema = pa.schema(
+        [
+            ("tour_id", pa.string()),
+            ("airtrip_id", pa.string()),
+            ("status", pa.string()),
+            ("match_count", pa.int64()),
+            ("error", pa.string()),
+            ("seconds", pa.float64()),
+            ("result", pa.string()),
+        ]
+    )
+    tmp_path = output.with_name(output.name + ".tmp")
+    pa.parquet.write_table(pa.table(columns, schema=schema), tmp_path)
+    os.replace(tmp_path, output)
+
+
+def _parse_threshold(values: List[str]) -> Threshold:
+    """--threshold 0.9 または --threshold phash=0.9 --threshold clip=0.8 を解釈する"""
+    if len(values) == 1 and "=" not in values[0]:
+        return float(values[0])
+    thresholds = {}
+    for value in values:
+        name, sep, number = value.partition("=")
+        if not sep:
+            raise ValueError(
+                "複数の閾値は 手法名=値 の形式で指定してください (例: phash=0.9)"
+            )
+        thresholds[name.strip()] = float(number)
+    return thresholds
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="python -m hotel_matching.batch",
+        description="ホテルIDのペアをまとめて照合し、結果を JSONL / Parquet に書き出します",
+    )
+    parser.add_argument("input", help="tour_id, airtrip_id を持つ CSV または JSONL")
+    parser.add_argument("output", help="出力ファイル (.jsonl または .parquet)")
+    parser.add_argument(
+        "--method",
+        action="append",
+        required=True,
+        help="マッチング手法名 (複数回指定すると複数の手法で比較します)",
+    )
+    parser.add_argument(
+        "--threshold",
+        action="append",
+        required=True,
+        help="類似度の閾値。手法ごとに指定する場合は 手法名=値 を繰り返します",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=0, help="比較を行うスレッド数 (既定: CPU 数)"
+    )
+    parser.add_argument(
+        "--scrape-workers",
+        type=int,
+        default=_DEFAULT_SCRAPE_WORKERS,
+        help=f"スクレイピングを行うスレッド数 (既定: {_DEFAULT_SCRAPE_WORKERS})",
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        default=None,
+        help="ペアごとに出力するマッチ結果の上限 (類似度の上位から。既定: すべて)",
+    )
+    parser.add_argument(
+        "--images-dir",
+        default=os.getenv("HOTEL_MATCHING_IMAGES_DIR", _DEFAULT_IMAGES_DIR),
+        help="スクレイピングした画像の保存先 (既定: images)",
+    )
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = _build_parser().parse_args(argv)
+    load_dotenv()
+    methods = list(dict.fromkeys(args.method))
+    method = methods[0] if len(methods) == 1 else methods
+
+    try:
+        threshold = _parse_threshold(args.threshold)
+        pairs = read_pairs(args.input)
+        store = ImageStore(
+            args.images_dir,
+            ttl_seconds=float(os.getenv("HOTEL_MATCHING_IMAGE_TTL", "3600")),
+            gc_interval_seconds=float(
+                os.getenv("HOTEL_MATCHING_IMAGE_GC_INTERVAL", "300")
+            ),
+            release_grace_seconds=float(
+                os.getenv("HOTEL_MATCHING_IMAGE_RELEASE_GRACE", "600")
+            ),
+        )
+        phash_index_dir = os.getenv("HOTEL_MATCHING_PHASH_INDEX_DIR")
+        summary = run_batch(
+            pairs,
+            args.output,
+            method,
+            threshold,
+            store=store,
+            workers=args.workers,
+            scrape_workers=args.scrape_workers,
+            top_k=args.top_k,
+            phash_index=HashIndex(phash_index_dir) if phash_index_dir else None,
+        )
+    except (OSError, ValueError, RuntimeError) as exc:
+        print(f"エラー: {exc}")
+        return 1
+    except KeyboardInterrupt:
+        return 130
+
+    print(
+        f"完了: {summary['total']} ペア (前回までに完了 {summary['skipped']}, "
+        f"成功 {summary['succeeded']}, 失敗 {summary['failed']})"
+    )
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,352 @@
+"""
+画像の内容ハッシュをキーにした特徴量キャッシュ
+
+各マッチャーが計算したハッシュ値・特徴点・埋め込みを SQLite に保存し、
+同じ画像を再度比較するときは計算を省略する。
+"""
+
+from __future__ import annotations
+
+import atexit
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, Mapping, Optional, TypeVar
+
+T = TypeVar("T")
+
+_DEFAULT_CACHE_DIR = Path.home() / ".cache" / "hotel_matching"
+_DEFAULT_MAX_BYTES = 1024**3
+# 上限を超えたときはこの割合まで削除して、追加のたびに削除が走らないようにする
+_EVICT_TARGET_RATIO = 0.9
+# 参照時刻 (LRU の順序) の更新はまとめて書き込む。件数か経過秒数のどちらかを超えたら書き込む
+_ACCESS_FLUSH_SIZE = 256
+_ACCESS_FLUSH_INTERVAL = 5.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL,
+    expires REAL
+)
+"""
+# 値の合計サイズを保持する。追加のたびに全件を合計し直さないため
+_META_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+)
+"""
+
+
+class FeatureCache:
+    """
+    SQLite をバックエンドにしたサイズ上限付き LRU キャッシュ
+
+    エントリごとに有効期限 (TTL) を指定することもできる。
+
+    接続は操作ごとに開くため、スレッド間・プロセス間で安全に共有できる。
+    読み込みは書き込みロックを取らないため、複数のワーカーから同時に参照できる。
+    参照時刻の更新はプロセス内にためておき、まとめて書き込む
+    """
+
+    def __init__(
+        self, directory: str | os.PathLike, max_bytes: int = _DEFAULT_MAX_BYTES
+    ):
+        self.directory = Path(directory).expanduser()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path = self.directory / "features.sqlite3"
+        self.max_bytes = max_bytes
+        self._access_lock = threading.Lock()
+        self._pending_access: Dict[str, float] = {}
+        self._last_flush = time.monotonic()
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+        finally:
+            conn.close()
+        with self._connect(write=True) as conn:
+            conn.execute(_SCHEMA)
+            conn.execute(_META_SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(entries)")}
+            if "expires" not in columns:
+                # 有効期限に対応する前に作成されたキャッシュを移行する
+                conn.execute("ALTER TABLE entries ADD COLUMN expires REAL")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS entries_accessed ON entries(accessed)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS entries_expires ON entries(expires)"
+            )
+            # 合計サイズを保持する前に作成されたキャッシュは、一度だけ合計を求める
+            conn.execute(
+                "INSERT OR IGNORE INTO meta (name, value)"
+                " SELECT 'total_bytes', COALESCE(SUM(size), 0) FROM entries"
+            )
+
+    def get(self, key: str) -> Optional[Any]:
+        """キーに対応する値を返す。存在しないか期限切れであれば None"""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, expires FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        if row[1] is not None and row[1] <= now:
+            with self._connect(write=True) as conn:
+                self._delete(conn, "key = ? AND expires <= ?", (key, now))
+            return None
+        self._touch(key, now)
+        try:
+            return pickle.loads(row[0])
+        except Exception as exc:
+            print(f"キャッシュ読み込みエラー {key}: {exc}")
+            return None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        値を保存し、必要であれば古いエントリを削除する
+
+        引数:
+            ttl: 有効期限までの秒数 (省略時は期限なし)
+        """
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        with self._connect(write=True) as conn:
+            previous = conn.execute(
+                "SELECT size FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, accessed, expires)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, blob, len(blob), now, expires),
+            )
+            self._add_total(conn, len(blob) - (previous[0] if previous else 0))
+            self._evict(conn)
+
+    def clear(self) -> None:
+        """すべてのエントリを削除する"""
+        with self._access_lock:
+            self._pending_access.clear()
+        with self._connect(write=True) as conn:
+            conn.execute("DELETE FROM entries")
+            conn.execute("UPDATE meta SET value = 0 WHERE name = 'total_bytes'")
+
+    def total_bytes(self) -> int:
+        """保存されている値の合計サイズ"""
+        with self._connect() as conn:
+            return self._total(conn)
+
+    def flush(self) -> None:
+        """ためている参照時刻の更新を書き込む"""
+        with self._access_lock:
+            pending = self._pending_access
+            self._pending_access = {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+        with self._connect(write=True) as conn:
+            self._write_access(conn, pending)
+
+    def _touch(self, key: str, now: float) -> None:
+        with self._access_lock:
+            self._pending_access[key] = now
+            due = (
+                len(self._pending_access) >= _ACCESS_FLUSH_SIZE
+                or time.monotonic() - self._last_flush >= _ACCESS_FLUSH_INTERVAL
+            )
+        if due:
+            try:
+                self.flush()
+            except sqlite3.Error as exc:
+                # 参照時刻は削除の順序にしか使わないので、書き込めなくても値は返す
+                print(f"キャッシュの参照時刻の更新エラー: {exc}")
+
+    @staticmethod
+    def _write_access(conn: sqlite3.Connection, pending: Dict[str, float]) -> None:
+        conn.executemany(
+            "UPDATE entries SET accessed = MAX(accessed, ?) WHERE key = ?",
+            [(accessed, key) for key, accessed in pending.items()],
+        )
+
+    @staticmethod
+    def _total(conn: sqlite3.Connection) -> int:
+        row = conn.execute(
+            "SELECT value FROM meta WHERE name = 'total_bytes'"
+        ).fetchone()
+        return int(row[0]) if row else 0
+
+    @staticmethod
+    def _add_total(conn: sqlite3.Connection, delta: int) -> None:
+        if delta:
+            conn.execute(
+                "UPDATE meta SET value = value + ? WHERE name = 'total_bytes'",
+                (delta,),
+            )
+
+    def _delete(self, conn: sqlite3.Connection, where: str, params: tuple) -> int:
+        """条件に合うエントリを削除して合計サイズを更新する。削除したバイト数を返す"""
+        size = conn.execute(
+            f"SELECT COALESCE(SUM(size), 0) FROM entries WHERE {where}", params
+        ).fetchone()[0]
+        if size:
+            conn.execute(f"DELETE FROM entries WHERE {where}", params)
+            self._add_total(conn, -size)
+        return size
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        total = self._total(conn)
+        if total <= self.max_bytes:
+            return
+
+        total -= self._delete(conn, "expires <= ?", (time.time(),))
+        if total <= self.max_bytes:
+            return
+
+        # 他のスレッドがためている参照時刻も反映してから、古い順に削除する
+        with self._access_lock:
+            pending = self._pending_access
+            self._pending_access = {}
+            self._last_flush = time.monotonic()
+        self._write_access(conn, pending)
+
+        target = self.max_bytes * _EVICT_TARGET_RATIO
+        stale = []
+        freed = 0
+        for key, size in conn.execute(
+            "SELECT key, size FROM entries ORDER BY accessed"
+        ):
+            if total - freed <= target:
+                break
+            stale.append((key,))
+            freed += size
+        conn.executemany("DELETE FROM entries WHERE key = ?", stale)
+        self._add_total(conn, -freed)
+
+    @contextmanager
+    def _connect(self, write: bool = False) -> Iterator[sqlite3.Connection]:
+        # with 文の間を 1 トランザクションとして実行し、終了時に接続を閉じる。
+        # 読み込みだけの場合は書き込みロックを取らない (WAL なので書き込み中も読める)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+
+_CACHE: FeatureCache | None = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_cache() -> FeatureCache | None:
+    """
+    環境変数の設定に従って共有キャッシュを返す
+
+    HOTEL_MATCHING_CACHE=0 のときは None を返し、キャッシュを無効にする
+    """
+    global _CACHE
+    if os.getenv("HOTEL_MATCHING_CACHE", "1") == "0":
+        return None
+
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            directory = os.getenv("HOTEL_MATCHING_CACHE_DIR", str(_DEFAULT_CACHE_DIR))
+            try:
+                max_bytes = int(
+                    os.getenv("HOTEL_MATCHING_CACHE_MAX_BYTES", str(_DEFAULT_MAX_BYTES))
+                )
+            except ValueError:
+                max_bytes = _DEFAULT_MAX_BYTES
+            _CACHE = FeatureCache(directory, max_bytes)
+            # ためている参照時刻の更新を、終了時に書き込む
+            atexit.register(_flush_on_exit, _CACHE)
+    return _CACHE
+
+
+def _flush_on_exit(cache: FeatureCache) -> None:
+    try:
+        cache.flush()
+    except sqlite3.Error as exc:
+        print(f"キャッシュの参照時刻の更新エラー: {exc}")
+
+
+def file_digest(path: str) -> str:
+    """ファイル内容の SHA-256 を返す (更新時刻とサイズが同じ間は再計算しない)"""
+    stat = os.stat(path)
+    return _file_digest(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=4096)
+def _file_digest(path: str, mtime_ns: int, size: int) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def cache_key(
+    image_path: str, method: str, params: Mapping[str, Any] | None = None
+) -> str:
+    """画像内容・手法名・パラメータからキャッシュキーを作る"""
+    encoded = json.dumps(dict(params or {}), sort_keys=True)
+    return f"{method}:{encoded}:{file_digest(image_path)}"
+
+
+def lookup(
+    image_path: str, method: str, params: Mapping[str, Any] | None
+) -> Optional[Any]:
+    """共有キャッシュから値を取り出す。無効化されている・存在しない場合は None"""
+    cache = get_cache()
+    if cache is None:
+        return None
+    try:
+        return cache.get(cache_key(image_path, method, params))
+    except sqlite3.Error as exc:
+        print(f"キャッシュ参照エラー {image_path}: {exc}")
+        return None
+
+
+def store(
+    image_path: str, method: str, params: Mapping[str, Any] | None, value: Any
+) -> None:
+    """共有キャッシュに値を保存する。None は保存しない"""
+    cache = get_cache()
+    if cache is None or value is None:
+        return
+    try:
+        cache.set(cache_key(image_path, method, params), value)
+    except sqlite3.Error as exc:
+        print(f"キャッシュ保存エラー {image_path}: {exc}")
+
+
+def cached(
+    image_path: str,
+    method: str,
+    params: Mapping[str, Any] | None,
+    compute: Callable[[], T],
+) -> T:
+    """
+    キャッシュにあればそれを返し、無ければ compute() の結果を保存して返す
+
+    compute() が None を返した場合は保存しない
+    """
+    value = lookup(image_path, method, params)
+    if value is None:
+        value = compute()
+        store(image_path, method, params, value)
+    return value
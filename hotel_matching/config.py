@@ -0,0 +1,26 @@
+"""
+環境変数から設定値を読み込むユーティリティ
+
+値が未設定または数値として解釈できない場合は既定値を使う。
+"""
+
+from __future__ import annotations
+
+import os
+
+
+def env_int(name: str, default: int, minimum: int) -> int:
+    """環境変数 name を整数として読み込む (minimum 未満は minimum に切り上げる)"""
+    try:
+        value = int(os.getenv(name, str(default)))
+    except ValueError:
+        value = default
+    return max(minimum, value)
+
+
+def env_float(name: str, default: float) -> float:
+    """環境変数 name を浮動小数点数として読み込む"""
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
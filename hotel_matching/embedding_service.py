@@ -0,0 +1,420 @@
+"""
+複数のワーカープロセスで CLIP モデルを共有するための埋め込みサービス
+
+サーバープロセスだけが CLIP モデルを読み込み、各ワーカー (Flask / gunicorn のワーカーなど) は
+Unix ソケット経由で画像パスを送ってエンコードを依頼する。
+ワーカーの数だけモデルを読み込まないため、常駐メモリがワーカー数に比例して増えない。
+
+同時に届いた依頼は、最大 max_batch 枚・最大 max_wait 秒待ってまとめ、1 回の推論でエンコードする。
+
+起動方法:
+    uv run python -m hotel_matching.embedding_service --socket /tmp/hotel_matching_clip.sock
+
+ワーカー側では CLIP_EMBEDDING_SOCKET に同じパスを設定すると clip マッチャーが自動で利用する。
+サーバーに接続できない場合は、これまでどおりワーカー内でモデルを読み込んでエンコードする。
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+from .config import env_float, env_int
+
+_DEFAULT_MAX_BATCH = 64
+_DEFAULT_MAX_WAIT_MS = 10
+_DEFAULT_TIMEOUT = 60.0
+# 接続できなかった後、再接続を試みるまでの秒数 (その間はワーカー内でエンコードする)
+_RETRY_INTERVAL = 30.0
+
+
+_SOCKET_PATH = os.getenv("CLIP_EMBEDDING_SOCKET") or None
+_TIMEOUT = env_float("CLIP_EMBEDDING_TIMEOUT", _DEFAULT_TIMEOUT)
+
+
+# ---------------------------------------------------------------------------
+# クライアント (clip マッチャーから利用する)
+# ---------------------------------------------------------------------------
+
+
+class EmbeddingClient:
+    """
+    埋め込みサービスへの接続
+
+    接続はスレッドごとに持つ。サーバーに接続できない・応答がない場合は None を返し、
+    呼び出し元にワーカー内でのエンコードを任せる
+
+    引数:
+        socket_path: サーバーの Unix ソケットのパス
+        timeout: 1 回の依頼の応答を待つ秒数
+    """
+
+    def __init__(self, socket_path: str, timeout: float = _DEFAULT_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._unavailable_until = 0.0
+
+    def encode(
+        self, paths: List[str], model_name: str, precision: str
+    ) -> Optional[Dict[str, np.ndarray]]:
+        """
+        画像をサーバーでエンコードする
+
+        戻り値:
+            画像パスから正規化済み埋め込みへの辞書 (読み込めなかった画像は含まない)。
+            サーバーを利用できない場合は None
+        """
+        if time.monotonic() < self._unavailable_until:
+            return None
+
+        # サーバーは別のカレントディレクトリで動くため、絶対パスで送る
+        absolute = {os.path.abspath(path): path for path in paths}
+        request = {
+            "op": "encode",
+            "paths": list(absolute),
+            "model_name": model_name,
+            "precision": precision,
+        }
+        response = self._request(request)
+        if response is None:
+            return None
+        if "error" in response:
+            print(f"埋め込みサービスのエラー: {response['error']}")
+            return None
+
+        for path, message in response["errors"].items():
+            print(f"CLIP処理エラー {absolute[path]}: {message}")
+        return {
+            absolute[path]: embedding
+            for path, embedding in zip(response["paths"], response["embeddings"])
+        }
+
+    def stats(self) -> Optional[Dict[str, Any]]:
+        """サーバーの処理件数とバッチの大きさの統計を返す"""
+        return self._request({"op": "stats"})
+
+    def _request(self, request: dict) -> Optional[dict]:
+        conn = getattr(self._local, "conn", None)
+        try:
+            if conn is None:
+                conn = Client(self.socket_path, family="AF_UNIX")
+                self._local.conn = conn
+            conn.send(request)
+            if not conn.poll(self.timeout):
+                raise TimeoutError(f"{self.timeout} 秒以内に応答がありません")
+            return conn.recv()
+        except (OSError, EOFError) as exc:
+            # 次回は接続し直す。サーバーが起動していなければしばらく接続を試みない
+            self._close()
+            if conn is None:
+                self._unavailable_until = time.monotonic() + _RETRY_INTERVAL
+            print(
+                f"埋め込みサービスを利用できません ({exc})。このプロセスでエンコードします"
+            )
+            return None
+
+    def _close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            conn.close()
+
+
+_CLIENT: Optional[EmbeddingClient] = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_client() -> Optional[EmbeddingClient]:
+    """CLIP_EMBEDDING_SOCKET が設定されていればクライアントを返す"""
+    global _CLIENT
+    if _SOCKET_PATH is None:
+        return None
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = EmbeddingClient(_SOCKET_PATH, _TIMEOUT)
+    return _CLIENT
+
+
+def encode_remote(
+    paths: List[str], model_name: str, precision: str
+) -> Optional[Dict[str, np.ndarray]]:
+    """
+    設定されていれば埋め込みサービスで画像をエンコードする
+
+    戻り値:
+        画像パスから埋め込みへの辞書。サービスが設定されていない・利用できない場合は None
+    """
+    client = get_client()
+    if client is None:
+        return None
+    return client.encode(paths, model_name, precision)
+
+
+# ---------------------------------------------------------------------------
+# サーバー
+# ---------------------------------------------------------------------------
+
+
+class _EncodeJob(NamedTuple):
+    key: tuple  # (モデル名, 精度)
+    tensors: list
+    future: Future
+
+
+class _Batcher:
+    """
+    同時に届いたエンコード依頼をまとめて推論するスレッド
+
+    最初の依頼から max_wait 秒以内に届いた同じモデル・精度の依頼を、最大 max_batch 枚までまとめる
+    """
+
+    def __init__(self, max_batch: int, max_wait: float):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: queue.Queue[_EncodeJob] = queue.Queue()
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._images = 0
+        self._requests = 0
+        threading.Thread(target=self._run, name="clip-batcher", daemon=True).start()
+
+    def submit(self, key: tuple, tensors: list) -> Future:
+        future: Future = Future()
+        self._queue.put(_EncodeJob(key, tensors, future))
+        return future
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            batches, images, requests = self._batches, self._images, self._requests
+        return {
+            "requests": requests,
+            "images": images,
+            "batches": batches,
+            "average_batch_size": images / batches if batches else 0.0,
+        }
+
+    def _run(self) -> None:
+        carry: Optional[_EncodeJob] = None
+        while True:
+            first = carry or self._queue.get()
+            carry = None
+            jobs = [first]
+            count = len(first.tensors)
+            deadline = time.monotonic() + self.max_wait
+            while count < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    job = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if job.key != first.key:
+                    # 別のモデル・精度の依頼は次のバッチに回す
+                    carry = job
+                    break
+                jobs.append(job)
+                count += len(job.tensors)
+            self._encode(first.key, jobs)
+
+    def _encode(self, key: tuple, jobs: List[_EncodeJob]) -> None:
+        from .matchers.clip_matcher import encode_tensors, get_model
+
+        tensors = [tensor for job in jobs for tensor in job.tensors]
+        try:
+            model, _ = get_model(*key)
+            embeddings = np.concatenate(
+                [
+                    encode_tensors(model, tensors[i : i + self.max_batch], key[1])
+                    for i in range(0, len(tensors), self.max_batch)
+                ]
+            )
+        except Exception as exc:
+            for job in jobs:
+                job.future.set_exception(exc)
+            return
+
+        with self._lock:
+            self._batches += 1
+            self._images += len(tensors)
+            self._requests += len(jobs)
+        offset = 0
+        for job in jobs:
+            job.future.set_result(embeddings[offset : offset + len(job.tensors)])
+            offset += len(job.tensors)
+
+
+class EmbeddingServer:
+    """
+    Unix ソケットでエンコード依頼を受け付けるサーバー
+
+    画像の読み込みと前処理は接続ごとのスレッドで並行して行い、推論だけを _Batcher でまとめる
+
+    引数:
+        socket_path: 待ち受ける Unix ソケットのパス
+        max_batch: 1 回の推論でまとめる最大枚数
+        max_wait: 依頼をまとめるために待つ最大秒数
+    """
+
+    def __init__(
+        self,
+        socket_path: str,
+        *,
+        max_batch: int = _DEFAULT_MAX_BATCH,
+        max_wait: float = _DEFAULT_MAX_WAIT_MS / 1000,
+    ):
+        self.socket_path = socket_path
+        self._batcher = _Batcher(max(1, max_batch), max(0.0, max_wait))
+        self._listener: Optional[Listener] = None
+
+    def serve_forever(self) -> None:
+        _remove_stale_socket(self.socket_path)
+        # 他のユーザーから依頼を受け付けないよう、ソケットは所有者だけが読み書きできるようにする
+        old_umask = os.umask(0o177)
+        try:
+            self._listener = Listener(self.socket_path, family="AF_UNIX")
+        finally:
+            os.umask(old_umask)
+        print(f"埋め込みサービスを起動しました: {self.socket_path}")
+        try:
+            while True:
+                try:
+                    conn = self._listener.accept()
+                except OSError:
+                    if self._listener is None:
+                        break
+                    raise
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.close()
+            print("埋め込みサービスを停止しました")
+
+    def _handle(self, conn: Connection) -> None:
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    response = self._dispatch(request)
+                except Exception as exc:
+                    response = {"error": str(exc)}
+                try:
+                    conn.send(response)
+                except OSError:
+                    return
+
+    def _dispatch(self, request: dict) -> dict:
+        op = request.get("op")
+        if op == "stats":
+            return self._batcher.stats()
+        if op != "encode":
+            raise ValueError(f"不明な操作 '{op}'")
+
+        from .image_loader import THUMBNAIL_SIZE, load_image
+        from .matchers.clip_matcher import get_model
+
+        key = (request["model_name"], request["precision"])
+        _, preprocess = get_model(*key)
+        paths: List[str] = []
+        tensors = []
+        errors: Dict[str, str] = {}
+        for path in request["paths"]:
+            try:
+                tensors.append(preprocess(load_image(path, THUMBNAIL_SIZE)))
+                paths.append(path)
+            except Exception as exc:
+                errors[path] = str(exc)
+
+        embeddings = (
+            self._batcher.submit(key, tensors).result() if tensors else np.empty((0, 0))
+        )
+        return {"paths": paths, "embeddings": embeddings, "errors": errors}
+
+
+def _remove_stale_socket(socket_path: str) -> None:
+    """前回異常終了したサーバーのソケットファイルを削除する (起動中のサーバーがあればエラー)"""
+    if not os.path.exists(socket_path):
+        return
+    try:
+        Client(socket_path, family="AF_UNIX").close()
+    except OSError:
+        os.unlink(socket_path)
+        return
+    raise RuntimeError(f"{socket_path} で既にサーバーが起動しています")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    load_dotenv()
+    socket_path = os.getenv("CLIP_EMBEDDING_SOCKET") or None
+    parser = argparse.ArgumentParser(
+        prog="python -m hotel_matching.embedding_service",
+        description="CLIP モデルを保持し、ワーカーからのエンコード依頼をまとめて処理します",
+    )
+    parser.add_argument(
+        "--socket",
+        default=socket_path,
+        required=socket_path is None,
+        help="待ち受ける Unix ソケットのパス (既定: CLIP_EMBEDDING_SOCKET)",
+    )
+    parser.add_argument(
+        "--max-batch",
+        type=int,
+        default=env_int("CLIP_EMBEDDING_MAX_BATCH", _DEFAULT_MAX_BATCH, 1),
+        help=f"1 回の推論でまとめる最大枚数 (既定: {_DEFAULT_MAX_BATCH})",
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=env_float("CLIP_EMBEDDING_MAX_WAIT_MS", _DEFAULT_MAX_WAIT_MS),
+        help=f"依頼をまとめるために待つ最大ミリ秒 (既定: {_DEFAULT_MAX_WAIT_MS})",
+    )
+    parser.add_argument(
+        "--preload",
+        action="append",
+        default=[],
+        metavar="MODEL_NAME",
+        help="起動時に読み込むモデル名 (繰り返し指定可)",
+    )
+    args = parser.parse_args(argv)
+
+    server = EmbeddingServer(
+        args.socket, max_batch=args.max_batch, max_wait=args.max_wait_ms / 1000
+    )
+    if args.preload:
+        from .matchers.clip_matcher import preload_models
+
+        preload_models(args.preload)
+
+    # SIGTERM でもソケットファイルを削除して終了する
+    signal.signal(signal.SIGTERM, lambda *_: server.close())
+    try:
+        server.serve_forever()
+    except RuntimeError as exc:
+        print(f"エラー: {exc}")
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,357 @@
+"""
+CLIP 埋め込みをディスク上に蓄積し、類似検索を行うストア
+
+ディレクトリ構成:
+    meta.json         次元数とデータ型
+    vectors.bin       正規化済み埋め込みを行方向に連結した生データ (memmap で参照)
+    ids.jsonl         各行に対応する ID (1 行 1 JSON 文字列)
+    ivf_centroids.npy IVF インデックスのクラスタ中心 (build_ivf 後のみ)
+    ivf_assign.bin    各行が属するクラスタ番号 (int32, build_ivf 後のみ)
+
+追加は各ファイルへの追記だけで行うため、インデックスを作り直す必要はない。
+"""
+
+from __future__ import annotations
+
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+from .jsonl import read_appended
+
+_META_FILE = "meta.json"
+_VECTORS_FILE = "vectors.bin"
+_IDS_FILE = "ids.jsonl"
+_CENTROIDS_FILE = "ivf_centroids.npy"
+_ASSIGN_FILE = "ivf_assign.bin"
+_LOCK_FILE = ".lock"
+
+_DEFAULT_BLOCK_ROWS = 65536
+_DEFAULT_NPROBE = 8
+
+SearchResult = List[Tuple[str, float]]
+
+
+class _InvertedLists(NamedTuple):
+    """IVF のクラスタごとの行番号リスト"""
+
+    version: Tuple[int, int]  # クラスタ中心のファイルの (inode, 更新時刻)
+    centroids: np.ndarray
+    lists: List[np.ndarray]
+    n_rows: int  # リストに登録済みの行数
+
+
+class EmbeddingStore:
+    """
+    memmap した埋め込み行列と ID の対応を持つ追記型ストア
+
+    引数:
+        directory: 保存先ディレクトリ
+        dim: 埋め込みの次元数 (新規作成時のみ必須)
+        dtype: 保存時のデータ型 ("float16" または "float32")
+    """
+
+    def __init__(
+        self,
+        directory: str | os.PathLike,
+        dim: int | None = None,
+        dtype: str = "float16",
+    ):
+        self.directory = Path(directory).expanduser()
+        meta_path = self.directory / _META_FILE
+
+        if meta_path.exists():
+            meta = json.loads(meta_path.read_text())
+            self.dim = int(meta["dim"])
+            self.dtype = np.dtype(meta["dtype"])
+            if dim is not None and dim != self.dim:
+                raise ValueError(f"次元数が一致しません: store={self.dim}, 指定={dim}")
+        else:
+            if dim is None:
+                raise ValueError("新しいストアを作成するには dim の指定が必要です")
+            if np.dtype(dtype) not in (np.float16, np.float32):
+                raise ValueError(f"未対応のデータ型です: {dtype}")
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self.dim = dim
+            self.dtype = np.dtype(dtype)
+            meta_path.write_text(
+                json.dumps({"dim": self.dim, "dtype": self.dtype.name})
+            )
+
+        self._ids: List[str] = []
+        self._ids_offset = 0
+        self._ids_lock = threading.Lock()
+        self._ivf: _InvertedLists | None = None
+        self._ivf_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        path = self.directory / _VECTORS_FILE
+        if not path.exists():
+            return 0
+        return path.stat().st_size // (self.dim * self.dtype.itemsize)
+
+    @property
+    def ids(self) -> List[str]:
+        """各行に対応する ID のリスト"""
+        with self._ids_lock:
+            if len(self._ids) < len(self):
+                # 追記された行だけを読む。書き込み途中の最終行は次回に読む
+                ids, self._ids_offset = read_appended(
+                    self.directory / _IDS_FILE, self._ids_offset
+                )
+                self._ids.extend(ids)
+            return self._ids
+
+    @property
+    def has_ivf(self) -> bool:
+        """IVF インデックスが構築済みかどうか"""
+        return (self.directory / _CENTROIDS_FILE).exists()
+
+    def append(self, ids: Sequence[str], vectors: np.ndarray) -> None:
+        """
+        埋め込みを末尾に追加する
+
+        IVF インデックスが構築済みであれば、追加分も最も近いクラスタに割り当てる
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if len(ids) != len(vectors):
+            raise ValueError("ids と vectors の件数が一致しません")
+        if not len(ids):
+            return
+
+        with self._lock():
+            with open(self.directory / _VECTORS_FILE, "ab") as f:
+                f.write(vectors.astype(self.dtype).tobytes())
+            with open(self.directory / _IDS_FILE, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(str(i), ensure_ascii=False) + "\n" for i in ids)
+            if self.has_ivf:
+                centroids = np.load(self.directory / _CENTROIDS_FILE)
+                assign = np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+                with open(self.directory / _ASSIGN_FILE, "ab") as f:
+                    f.write(assign.tobytes())
+
+    def search(
+        self,
+        queries: np.ndarray,
+        top_k: int = 10,
+        *,
+        nprobe: int | None = None,
+        block_rows: int = _DEFAULT_BLOCK_ROWS,
+    ) -> List[SearchResult]:
+        """
+        内積 (正規化済みならコサイン類似度) の上位 top_k 件を返す
+
+        引数:
+            queries: shape=(Q, D) または (D,) のクエリ埋め込み
+            top_k: 各クエリで返す件数
+            nprobe: 指定すると IVF インデックスで上位 nprobe クラスタだけを探索する
+            block_rows: 全件探索で一度に読み込む行数
+
+        戻り値:
+            クエリごとの [(ID, 類似度), ...] のリスト (類似度の降順)
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        vectors = self._vectors()
+        if vectors is None or top_k <= 0:
+            return [[] for _ in range(len(queries))]
+
+        if nprobe is not None and self.has_ivf:
+            found = [self._search_ivf(vectors, q, top_k, nprobe) for q in queries]
+        else:
+            found = _search_exact(vectors, queries, top_k, block_rows)
+
+        ids = self.ids
+        return [
+            [(ids[i], float(s)) for i, s in zip(rows, scores)] for rows, scores in found
+        ]
+
+    def build_ivf(
+        self,
+        n_lists: int = 256,
+        *,
+        sample_size: int = 20000,
+        iterations: int = 20,
+        seed: int = 0,
+        block_rows: int = _DEFAULT_BLOCK_ROWS,
+    ) -> None:
+        """
+        球面 k-means でクラスタ中心を求め、全行をクラスタに割り当てる
+
+        以降の append では追加分だけが割り当てられる
+        """
+        vectors = self._vectors()
+        if vectors is None:
+            raise ValueError("埋め込みが登録されていません")
+
+        # クラスタ中心の学習はロックの外で行い、割り当てはロックを取ってから全行に対して行う
+        rng = np.random.default_rng(seed)
+        n_rows = len(vectors)
+        sample_rows = np.sort(
+            rng.choice(n_rows, size=min(sample_size, n_rows), replace=False)
+        )
+        sample = np.asarray(vectors[sample_rows], dtype=np.float32)
+        centroids = _spherical_kmeans(
+            sample, min(n_lists, len(sample)), iterations, rng
+        )
+
+        with self._lock():
+            # 学習中に追記された行も割り当てから漏れないよう、読み込み直す
+            vectors = self._vectors()
+            n_rows = len(vectors)
+            tmp_assign = self.directory / (_ASSIGN_FILE + ".tmp")
+            with open(tmp_assign, "wb") as f:
+                for start in range(0, n_rows, block_rows):
+                    block = np.asarray(
+                        vectors[start : start + block_rows], dtype=np.float32
+                    )
+                    f.write(
+                        np.argmax(block @ centroids.T, axis=1)
+                        .astype(np.int32)
+                        .tobytes()
+                    )
+            tmp_centroids = self.directory / (_CENTROIDS_FILE + ".tmp")
+            with open(tmp_centroids, "wb") as f:
+                np.save(f, centroids)
+            os.replace(tmp_centroids, self.directory / _CENTROIDS_FILE)
+            os.replace(tmp_assign, self.directory / _ASSIGN_FILE)
+
+    def _search_ivf(
+        self, vectors: np.memmap, query: np.ndarray, top_k: int, nprobe: int
+    ):
+        ivf = self._inverted_lists()
+        probes = np.argsort(-(ivf.centroids @ query))[:nprobe]
+
+        rows = np.sort(np.concatenate([ivf.lists[p] for p in probes]))
+        rows = rows[rows < len(vectors)]
+        if not len(rows):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        scores = np.asarray(vectors[rows], dtype=np.float32) @ query
+        order = _top_k_order(scores, top_k)
+        return rows[order], scores[order]
+
+    def _inverted_lists(self) -> _InvertedLists:
+        """
+        クラスタごとの行番号リストを返す
+
+        初回と build_ivf で作り直された後は割り当てファイル全体から作り、
+        それ以外は追記された行だけをリストに加える
+        """
+        with self._ivf_lock:
+            ivf = self._ivf
+            version = _file_version(self.directory / _CENTROIDS_FILE)
+            if ivf is None or ivf.version != version:
+                # build_ivf の途中の中心と割り当ての組み合わせを読まないようロックを取る
+                with self._lock():
+                    centroids = np.load(self.directory / _CENTROIDS_FILE)
+                    ivf = self._extend_lists(
+                        _InvertedLists(
+                            version=_file_version(self.directory / _CENTROIDS_FILE),
+                            centroids=centroids,
+                            lists=[np.empty(0, dtype=np.int64)] * len(centroids),
+                            n_rows=0,
+                        )
+                    )
+            else:
+                ivf = self._extend_lists(ivf)
+            self._ivf = ivf
+            return ivf
+
+    def _extend_lists(self, ivf: _InvertedLists) -> _InvertedLists:
+        """割り当てファイルに追記された行をクラスタごとのリストに加える"""
+        path = self.directory / _ASSIGN_FILE
+        n_assigned = path.stat().st_size // np.dtype(np.int32).itemsize
+        if n_assigned <= ivf.n_rows:
+            return ivf
+
+        assign = np.memmap(path, dtype=np.int32, mode="r", shape=(n_assigned,))
+        new_assign = np.asarray(assign[ivf.n_rows :])
+        order = np.argsort(new_assign, kind="stable")
+        clusters, starts = np.unique(new_assign[order], return_index=True)
+        lists = list(ivf.lists)
+        for cluster, rows in zip(clusters, np.split(order, starts[1:])):
+            lists[cluster] = np.concatenate([lists[cluster], rows + ivf.n_rows])
+        return ivf._replace(lists=lists, n_rows=n_assigned)
+
+    def _vectors(self) -> np.memmap | None:
+        n_rows = min(len(self), len(self.ids))
+        if n_rows == 0:
+            return None
+        return np.memmap(
+            self.directory / _VECTORS_FILE,
+            dtype=self.dtype,
+            mode="r",
+            shape=(n_rows, self.dim),
+        )
+
+    @contextmanager
+    def _lock(self) -> Iterator[None]:
+        # 複数プロセスからの同時追記で行と ID がずれないように排他ロックを取る
+        with open(self.directory / _LOCK_FILE, "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _file_version(path: Path) -> Tuple[int, int]:
+    stat = path.stat()
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def _search_exact(vectors: np.memmap, queries: np.ndarray, top_k: int, block_rows: int):
+    """ブロックごとに行列積を取り、クエリごとの上位 top_k を更新していく"""
+    n_queries = len(queries)
+    best_rows = np.empty((n_queries, 0), dtype=np.int64)
+    best_scores = np.empty((n_queries, 0), dtype=np.float32)
+
+    for start in range(0, len(vectors), block_rows):
+        block = np.asarray(vectors[start : start + block_rows], dtype=np.float32)
+        scores = queries @ block.T
+        rows = np.broadcast_to(np.arange(start, start + len(block)), scores.shape)
+
+        merged_scores = np.concatenate([best_scores, scores], axis=1)
+        merged_rows = np.concatenate([best_rows, rows], axis=1)
+        if merged_scores.shape[1] > top_k:
+            keep = np.argpartition(-merged_scores, top_k - 1, axis=1)[:, :top_k]
+            merged_scores = np.take_along_axis(merged_scores, keep, axis=1)
+            merged_rows = np.take_along_axis(merged_rows, keep, axis=1)
+        best_scores, best_rows = merged_scores, merged_rows
+
+    results = []
+    for rows, scores in zip(best_rows, best_scores):
+        order = np.argsort(-scores, kind="stable")
+        results.append((rows[order], scores[order]))
+    return results
+
+
+def _top_k_order(scores: np.ndarray, top_k: int) -> np.ndarray:
+    if len(scores) > top_k:
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def _spherical_kmeans(
+    data: np.ndarray, n_clusters: int, iterations: int, rng: np.random.Generator
+) -> np.ndarray:
+    centroids = data[rng.choice(len(data), size=n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(data @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, data)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        # 空のクラスタは以前の中心をそのまま使う
+        sums[empty] = centroids[empty]
+        norms[empty] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
@@ -0,0 +1,197 @@
+"""
+64 ビット画像ハッシュのマルチインデックスハッシング (MIH) による近傍検索
+
+ハッシュを n_chunks 個のビット列に分割し、チャンクごとにハッシュテーブルを持つ。
+ハミング距離 r 以内の画像は、鳩の巣原理によりいずれかのチャンクで
+距離 r // n_chunks 以内に収まるため、その範囲だけを引けば全件を走査せずに候補が得られる。
+
+ディレクトリ構成:
+    hashes.bin  ハッシュ値 (uint64) を追記した生データ
+    ids.jsonl   各行に対応する ID (1 行 1 JSON 文字列)
+
+同じ ID が複数回追記されている場合は、最後の行のハッシュだけを検索対象にする。
+"""
+
+from __future__ import annotations
+
+import fcntl
+import json
+import os
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import combinations
+from pathlib import Path
+from typing import Dict, Iterator, List, Sequence, Set, Tuple
+
+import numpy as np
+
+from .jsonl import read_appended
+
+_HASHES_FILE = "hashes.bin"
+_IDS_FILE = "ids.jsonl"
+_LOCK_FILE = ".lock"
+_HASH_BITS = 64
+
+
+class HashIndex:
+    """
+    ディスクに永続化される追記型の MIH インデックス
+
+    別プロセスが追記した分は検索時に自動で読み込む。
+    登録済みの ID を別のハッシュで追加すると、古いハッシュは検索されなくなる
+
+    引数:
+        directory: 保存先ディレクトリ
+        n_chunks: ハッシュを分割するチャンク数 (64 の約数)
+    """
+
+    def __init__(self, directory: str | os.PathLike, n_chunks: int = 4):
+        if _HASH_BITS % n_chunks:
+            raise ValueError(f"n_chunks は {_HASH_BITS} の約数で指定してください")
+
+        self.directory = Path(directory).expanduser()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.n_chunks = n_chunks
+        self._chunk_bits = _HASH_BITS // n_chunks
+        self._chunk_mask = (1 << self._chunk_bits) - 1
+
+        self._hashes: List[int] = []
+        self._ids: List[str] = []
+        # ids.jsonl の読み終えた位置と、対応するハッシュをまだ読めていない ID
+        self._ids_offset = 0
+        self._unmatched_ids: List[str] = []
+        # ID ごとの最新の行。置き換えられた行はチャンクのテーブルから取り除く
+        self._latest: Dict[str, int] = {}
+        self._tables: List[Dict[int, List[int]]] = [
+            defaultdict(list) for _ in range(n_chunks)
+        ]
+        self._mutex = threading.Lock()
+        self._sync()
+
+    def __len__(self) -> int:
+        with self._mutex:
+            self._sync()
+            return len(self._latest)
+
+    def add(self, ids: Sequence[str], hashes: Sequence[int]) -> int:
+        """
+        ハッシュを追加する
+
+        登録済みの ID は新しいハッシュで置き換え、同じ ID とハッシュの組は二重に登録しない
+
+        戻り値:
+            新たに登録 (または置き換え) した件数
+        """
+        if len(ids) != len(hashes):
+            raise ValueError("ids と hashes の件数が一致しません")
+
+        with self._mutex, self._lock():
+            self._sync()
+            # 同じ ID が複数含まれる場合は最後のハッシュを使う
+            latest = {str(item_id): int(value) for item_id, value in zip(ids, hashes)}
+            new_ids: List[str] = []
+            new_hashes: List[int] = []
+            for item_id, value in latest.items():
+                row = self._latest.get(item_id)
+                if row is not None and self._hashes[row] == value:
+                    continue
+                new_ids.append(item_id)
+                new_hashes.append(value)
+
+            if not new_ids:
+                return 0
+
+            with open(self.directory / _HASHES_FILE, "ab") as f:
+                f.write(np.array(new_hashes, dtype="<u8").tobytes())
+            with open(self.directory / _IDS_FILE, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(i, ensure_ascii=False) + "\n" for i in new_ids)
+            self._insert(new_ids, new_hashes)
+            return len(new_ids)
+
+    def query(self, value: int, radius: int) -> List[Tuple[str, int]]:
+        """
+        ハミング距離 radius 以内のハッシュを持つ ID を返す
+
+        戻り値:
+            [(ID, ハミング距離), ...] のリスト (距離の昇順)
+        """
+        value = int(value)
+        chunk_radius = radius // self.n_chunks
+
+        with self._mutex:
+            self._sync()
+            candidates: Set[int] = set()
+            for chunk_index, table in enumerate(self._tables):
+                chunk = self._chunk(value, chunk_index)
+                for probe in _neighbors(chunk, chunk_radius, self._chunk_bits):
+                    candidates.update(table.get(probe, ()))
+
+            results = []
+            for row in candidates:
+                distance = (self._hashes[row] ^ value).bit_count()
+                if distance <= radius:
+                    results.append((row, distance))
+
+            results.sort(key=lambda x: (x[1], x[0]))
+            return [(self._ids[row], distance) for row, distance in results]
+
+    def _chunk(self, value: int, chunk_index: int) -> int:
+        return (value >> (chunk_index * self._chunk_bits)) & self._chunk_mask
+
+    def _insert(self, ids: Sequence[str], hashes: Sequence[int]) -> None:
+        start = len(self._hashes)
+        self._ids.extend(ids)
+        self._hashes.extend(hashes)
+        for row, (item_id, value) in enumerate(zip(ids, hashes), start):
+            old_row = self._latest.get(item_id)
+            if old_row is not None:
+                # 再スクレイピングなどで置き換えられた古いハッシュは検索対象から外す
+                old_value = self._hashes[old_row]
+                for chunk_index, table in enumerate(self._tables):
+                    table[self._chunk(old_value, chunk_index)].remove(old_row)
+            self._latest[item_id] = row
+            for chunk_index, table in enumerate(self._tables):
+                table[self._chunk(value, chunk_index)].append(row)
+
+    def _sync(self) -> None:
+        # 他プロセスが追記した行だけを読み込む
+        path = self.directory / _HASHES_FILE
+        if not path.exists():
+            return
+        n_rows = path.stat().st_size // 8
+        if n_rows <= len(self._hashes):
+            return
+
+        start = len(self._hashes)
+        with open(path, "rb") as f:
+            f.seek(start * 8)
+            hashes = np.frombuffer(f.read((n_rows - start) * 8), dtype="<u8").tolist()
+        # 前回の続きから読む。書き込み途中の最終行は次回に読む
+        new_ids, self._ids_offset = read_appended(
+            self.directory / _IDS_FILE, self._ids_offset
+        )
+        ids = self._unmatched_ids + new_ids
+
+        count = min(len(hashes), len(ids))
+        self._unmatched_ids = ids[count:]
+        self._insert(ids[:count], hashes[:count])
+
+    @contextmanager
+    def _lock(self) -> Iterator[None]:
+        with open(self.directory / _LOCK_FILE, "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _neighbors(value: int, radius: int, n_bits: int) -> Iterator[int]:
+    """value からハミング距離 radius 以内のすべての値を列挙する"""
+    for distance in range(radius + 1):
+        for bits in combinations(range(n_bits), distance):
+            flipped = value
+            for bit in bits:
+                flipped ^= 1 << bit
+            yield flipped
@@ -0,0 +1,111 @@
+"""
+各マッチャーで共有する画像読み込みモジュール
+
+同じファイルを手法ごとに何度もデコードしないよう、デコード結果をプロセス内の LRU に保持する。
+JPEG は必要な大きさに応じて縮小デコード (PIL の draft / OpenCV の IMREAD_REDUCED_*) を行い、
+フル解像度の展開を避けてデコード時間とメモリ使用量を減らす。
+
+返す画像・配列は複数の呼び出し元で共有されるため、変更しないこと。
+"""
+
+from __future__ import annotations
+
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import ExifTags, Image
+
+from .lru import SizedLRU
+
+# 平均ハッシュ・pHash・CLIP で共有する縮小版の短辺の最小値 (CLIP の入力 224×224 に合わせる)
+THUMBNAIL_SIZE = 224
+_DEFAULT_MAX_BYTES = 256 * 1024**2
+# OpenCV の縮小デコード (IMREAD_REDUCED_GRAYSCALE_<倍率>) で指定できる倍率
+_REDUCED_FACTORS = (8, 4, 2)
+# 90 度回転して表示する EXIF の向き (Orientation タグの値)
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def _max_bytes_from_env() -> int:
+    try:
+        return int(
+            os.getenv("HOTEL_MATCHING_IMAGE_CACHE_MAX_BYTES", str(_DEFAULT_MAX_BYTES))
+        )
+    except ValueError:
+        return _DEFAULT_MAX_BYTES
+
+
+_CACHE = SizedLRU(_max_bytes_from_env())
+
+
+def load_image(path: str, min_size: int | None = None) -> Image.Image:
+    """
+    画像を RGB の PIL 画像として読み込む
+
+    引数:
+        min_size: 指定すると、縦横ともにこの値以上を保つ範囲で JPEG を縮小デコードする
+            (縮小は 1/2, 1/4, 1/8 の段階で行うため、実際の大きさは指定値以上になる)
+    """
+
+    def load() -> Tuple[Image.Image, int]:
+        with Image.open(path) as img:
+            if min_size is not None:
+                img.draft("RGB", (min_size, min_size))
+            image = img.convert("RGB")
+        return image, image.width * image.height * 3
+
+    return _CACHE.get_or_load(_key(path, "rgb", min_size), load)
+
+
+def load_gray(path: str, min_height: int | None = None) -> Optional[np.ndarray]:
+    """
+    画像をグレースケールの配列として読み込む。読み込めない場合は None
+
+    引数:
+        min_height: 指定すると、高さがこの値以上を保つ範囲で縮小デコードする
+    """
+
+    # OpenCV はハッシュ系の手法では使わないので、グレースケール読み込みを使うときだけ読み込む
+    import cv2
+
+    def load() -> Tuple[Optional[np.ndarray], int]:
+        array = cv2.imread(path, _gray_flag(path, min_height))
+        if array is None:
+            return None, 0
+        array.flags.writeable = False
+        return array, array.nbytes
+
+    return _CACHE.get_or_load(_key(path, "gray", min_height), load)
+
+
+def decode_variant(kind: str, size: int | None) -> str:
+    """特徴量キャッシュのキーに含める、デコード方法を表す文字列"""
+    return f"{kind}-reduced{size}" if size is not None else f"{kind}-full"
+
+
+def clear_cache() -> None:
+    """デコード済み画像の LRU を空にする"""
+    _CACHE.clear()
+
+
+def _key(path: str, kind: str, size: int | None) -> tuple:
+    # 内容が更新されたファイルを古いデコード結果で扱わないよう、更新時刻とサイズを含める
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, kind, size)
+
+
+def _gray_flag(path: str, min_height: int | None) -> int:
+    import cv2
+
+    if min_height is None:
+        return cv2.IMREAD_GRAYSCALE
+    # ヘッダーだけを読んで元の高さを調べ、縮小後も min_height 以上になる最大の倍率を選ぶ。
+    # imread は EXIF の向きに従って回転するので、90 度回転する向き (5〜8) では幅が高さになる
+    with Image.open(path) as img:
+        orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+        height = img.width if orientation in _TRANSPOSED_ORIENTATIONS else img.height
+    for factor in _REDUCED_FACTORS:
+        if height // factor >= min_height:
+            return getattr(cv2, f"IMREAD_REDUCED_GRAYSCALE_{factor}")
+    return cv2.IMREAD_GRAYSCALE
@@ -0,0 +1,35 @@
+"""
+追記型の JSONL ファイルを読み込むユーティリティ
+
+別プロセスが追記している最中のファイルを読むと、最終行が途中までしか書かれていないことがある。
+ここでは改行で終わっている行だけを読み、次回はその続きから読めるよう読み終えた位置を返す。
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from typing import Any, List, Tuple
+
+
+def read_appended(path: str | os.PathLike, offset: int = 0) -> Tuple[List[Any], int]:
+    """
+    offset バイト目以降に追記された行を読み込む
+
+    書き込み途中の最終行は読まずに残す
+
+    戻り値:
+        (各行の JSON を読み込んだ値のリスト, 次回読み始める位置)
+    """
+    try:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        return [], offset
+
+    end = data.rfind(b"\n") + 1
+    records = [
+        json.loads(line) for line in data[:end].decode("utf-8").splitlines() if line
+    ]
+    return records, offset + end
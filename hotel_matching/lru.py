@@ -0,0 +1,102 @@
+"""
+合計バイト数に上限を持つ、スレッドセーフな LRU
+
+デコード済み画像 (image_loader) と読み込み済みの CLIP モデル (clip_matcher) の保持に使う。
+"""
+
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+
+class SizedLRU:
+    """
+    値ごとのバイト数の合計が max_bytes を超えると、最も長く使われていない値から手放す LRU
+
+    同じキーを複数のスレッドが同時に読み込もうとした場合は、1 つのスレッドだけが読み込み、
+    他のスレッドはその結果を使う。
+
+    引数:
+        max_bytes: 保持する値のバイト数の合計の上限
+        keep_latest: True なら、直前に保存した値は上限を超えていても保持する
+            (False では上限より大きい値は保存しない)
+        on_evict: 値を手放したときにそのキーを渡して呼び出す関数
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        *,
+        keep_latest: bool = False,
+        on_evict: Optional[Callable[[Hashable], None]] = None,
+    ):
+        self.max_bytes = max_bytes
+        self._keep_latest = keep_latest
+        self._on_evict = on_evict
+        self._entries: OrderedDict[Hashable, Tuple[Any, int]] = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+        self._loading: Dict[Hashable, threading.Lock] = {}
+
+    def get_or_load(
+        self, key: Hashable, load: Callable[[], Tuple[Any, int]]
+    ) -> Optional[Any]:
+        """キーの値を返す。無ければ load() で (値, バイト数) を求めて保存する (None は保存しない)"""
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        with key_lock:
+            try:
+                # 待っている間に他のスレッドが読み込んでいれば、その結果を使う
+                value = self.get(key)
+                if value is None:
+                    value, size = load()
+                    if value is not None:
+                        self.put(key, value, size)
+                return value
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int) -> None:
+        if size > self.max_bytes and not self._keep_latest:
+            return
+        evicted: List[Hashable] = []
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total -= old[1]
+            self._entries[key] = (value, size)
+            self._total += size
+            # 手放した値も、取得済みの呼び出し元が持つ参照は使い終わるまで有効
+            while self._total > self.max_bytes and (
+                len(self._entries) > 1 or not self._keep_latest
+            ):
+                evicted_key, (_, evicted_size) = self._entries.popitem(last=False)
+                self._total -= evicted_size
+                evicted.append(evicted_key)
+        if self._on_evict is not None:
+            for evicted_key in evicted:
+                self._on_evict(evicted_key)
+
+    def keys(self) -> List[Hashable]:
+        with self._lock:
+            return list(self._entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._total = 0
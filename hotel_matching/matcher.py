@@ -2,28 +2,266 @@
 対応するマッチング関数を実行するラッパーモジュール
 """
 
-from typing import Iterable, List
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Union,
+)
 
-from .matchers.registry import get_matcher
+from .cache import get_cache
+from .matchers.registry import (
+    MatchResult,
+    get_iterator,
+    get_matcher,
+    get_preparer,
+    get_stats_matcher,
+)
+
+Threshold = Union[float, Mapping[str, float]]
 
 
 def compare(
     method: str,
     images1: Iterable[str],
     images2: Iterable[str],
-    threshold: float,
+    threshold: Threshold,
 ) -> List[dict]:
     """
     指定されたマッチング手法で画像を比較します
 
+    複数の手法で比較する場合は compare_many を使います。
+
     引数:
         method: 使用するマッチング手法名
         images1: 1つ目の画像パスのイテラブル
         images2: 2つ目の画像パスのイテラブル
-        threshold: 類似度の閾値 (0〜1)
+        threshold: 類似度の閾値 (0〜1)。手法名ごとの辞書も指定できる (method の値を使う)
 
     戻り値:
         list[dict]: マッチ結果のリスト
     """
     matcher = get_matcher(method)
-    return matcher(images1, images2, threshold)
+    return matcher(images1, images2, _threshold_for(method, threshold))
+
+
+class MatchStream:
+    """
+    compare_iter が返すマッチ結果のイテレーター
+
+    カスケード型の手法などが段階ごとの統計を持つ場合、stats から参照できる
+    """
+
+    def __init__(
+        self,
+        source: Iterable[dict],
+        top_k: Optional[int] = None,
+        stats: Optional[Dict[str, Any]] = None,
+    ):
+        self.stats = stats
+        self._iterator = self._iterate(source, top_k)
+
+    def __iter__(self) -> Iterator[dict]:
+        return self._iterator
+
+    def __next__(self) -> dict:
+        return next(self._iterator)
+
+    def _iterate(self, source: Iterable[dict], top_k: Optional[int]) -> Iterator[dict]:
+        if top_k is None:
+            yield from source
+        else:
+            # ヒープで上位 top_k 件だけを保持するので、メモリ使用量は結果の総数によらない
+            yield from heapq.nlargest(top_k, source, key=lambda x: x["similarity"])
+
+
+def compare_iter(
+    method: str,
+    images1: Iterable[str],
+    images2: Iterable[str],
+    threshold: Threshold,
+    *,
+    top_k: Optional[int] = None,
+) -> MatchStream:
+    """
+    指定されたマッチング手法で画像を比較し、マッチ結果を 1 件ずつ返します
+
+    逐次出力に対応した手法 (hash / phash / feature / clip) は、全ペアの比較を待たずに
+    見つけた結果から順に返します (この場合は類似度順になりません)。
+    それ以外の手法は compare() と同じ結果を類似度の降順に返します。
+
+    引数:
+        method: 使用するマッチング手法名
+        threshold: 類似度の閾値 (0〜1)。手法名ごとの辞書も指定できる (method の値を使う)
+        top_k: 指定すると類似度の上位 top_k 件だけを保持し、すべて比較した後に類似度の降順で返す
+
+    戻り値:
+        MatchStream: マッチ結果のイテレーター
+    """
+    if top_k is not None and top_k < 0:
+        raise ValueError("top_k は 0 以上で指定してください")
+
+    threshold = _threshold_for(method, threshold)
+    iterator = get_iterator(method)
+    if iterator is not None:
+        return MatchStream(iterator(images1, images2, threshold), top_k)
+
+    stats_matcher = get_stats_matcher(method)
+    if stats_matcher is not None:
+        result = stats_matcher(images1, images2, threshold)
+        return MatchStream(result.matches, top_k, result.stats)
+
+    return MatchStream(get_matcher(method)(images1, images2, threshold), top_k)
+
+
+def compare_many(
+    methods: Sequence[str],
+    images1: Iterable[str],
+    images2: Iterable[str],
+    threshold: Threshold,
+) -> Dict[str, Any]:
+    """
+    複数のマッチング手法で画像を並行して比較し、手法ごとの結果と統合スコアを返します
+
+    画像のデコード結果と特徴量は共有されるため、同じ画像を手法ごとに読み直すことはありません。
+    一部の手法が失敗しても他の手法の結果は返し、すべて失敗した場合のみ例外を送出します。
+
+    引数:
+        methods: 使用するマッチング手法名のリスト
+        threshold: 全手法共通の閾値、または手法名ごとの閾値の辞書
+
+    戻り値:
+        dict:
+            results: 手法名ごとのマッチ結果のリスト
+            fused: 画像ペアごとに、一致と判定した手法の割合 (score) を付けた統合結果
+            errors: 失敗した手法名とエラーメッセージ
+            stats: 統計を返す手法 (カスケード型など) の手法名ごとの統計
+    """
+    methods = list(dict.fromkeys(methods))
+    if not methods:
+        raise ValueError("マッチング手法が指定されていません")
+    matchers = {method: _matcher_with_stats(method) for method in methods}
+    thresholds = {method: _threshold_for(method, threshold) for method in methods}
+
+    images1 = list(images1)
+    images2 = list(images2)
+
+    results: Dict[str, List[dict]] = {}
+    stats: Dict[str, Dict[str, Any]] = {}
+    errors: Dict[str, str] = {}
+    first_error = None
+    with ThreadPoolExecutor(
+        max_workers=len(methods), thread_name_prefix="compare"
+    ) as pool:
+        futures = {
+            method: pool.submit(matchers[method], images1, images2, thresholds[method])
+            for method in methods
+        }
+        for method, future in futures.items():
+            try:
+                result = future.result()
+            except Exception as exc:
+                # 依存パッケージやモデルの読み込みなど、どの例外でも他の手法の結果は返す
+                print(f"{method} による比較に失敗しました: {exc}")
+                errors[method] = str(exc)
+                first_error = first_error or exc
+                continue
+            results[method] = result.matches
+            if result.stats:
+                stats[method] = result.stats
+
+    if not results:
+        raise first_error
+
+    return {
+        "results": results,
+        "fused": _fuse(results),
+        "errors": errors,
+        "stats": stats,
+    }
+
+
+def prepare(method: str, images: Iterable[str]) -> None:
+    """
+    指定されたマッチング手法で使う画像ごとの特徴量を事前に計算する
+
+    計算結果は共有キャッシュに保存され、後続の compare() で再利用される。
+    キャッシュが無効な場合や、事前計算できない手法では何もしない。
+
+    引数:
+        method: 使用するマッチング手法名
+        images: 画像パスのイテラブル
+    """
+    preparer = get_preparer(method)
+    if preparer is None or get_cache() is None:
+        return
+    preparer(images)
+
+
+def _matcher_with_stats(
+    method: str,
+) -> Callable[[List[str], List[str], float], MatchResult]:
+    """手法のマッチャーを、統計 (持たない手法は空の辞書) も返す関数として取得する"""
+    stats_matcher = get_stats_matcher(method)
+    if stats_matcher is not None:
+        return stats_matcher
+
+    matcher = get_matcher(method)
+    return lambda images1, images2, threshold: MatchResult(
+        matcher(images1, images2, threshold), {}
+    )
+
+
+def _threshold_for(method: str, threshold: Threshold) -> float:
+    if isinstance(threshold, Mapping):
+        try:
+            return float(threshold[method])
+        except KeyError as exc:
+            raise ValueError(f"手法 '{method}' の閾値が指定されていません") from exc
+    return float(threshold)
+
+
+def _fuse(results: Mapping[str, List[dict]]) -> List[dict]:
+    """
+    手法ごとの結果を画像ペア単位でまとめる
+
+    score (と similarity) は一致と判定した手法数 / 結果が得られた手法数
+    """
+    pairs: Dict[tuple, Dict[str, Any]] = {}
+    for method, matches in results.items():
+        for match in matches:
+            if not match.get("passed_threshold", True):
+                continue
+            key = (match["image1"], match["image2"])
+            entry = pairs.setdefault(
+                key,
+                {
+                    "image1": match["image1"],
+                    "image2": match["image2"],
+                    "methods": [],
+                    "similarities": {},
+                },
+            )
+            if method not in entry["similarities"]:
+                entry["methods"].append(method)
+                entry["similarities"][method] = float(match["similarity"])
+
+    fused = []
+    for entry in pairs.values():
+        entry["score"] = len(entry["methods"]) / len(results)
+        entry["similarity"] = entry["score"]
+        entry["method"] = "fused"
+        fused.append(entry)
+
+    fused.sort(
+        key=lambda x: (x["score"], sum(x["similarities"].values())), reverse=True
+    )
+    return fused
@@ -0,0 +1,281 @@
+"""
+安価な手法から順に候補を絞り込むカスケード型のマッチング関数
+
+1. pHash: ほぼ同一のペアをその場で一致とし、明らかに異なるペアを除外する
+2. CLIP: 残ったペアを埋め込みの類似度で順位付けし、上位 top_k 件だけを残す
+3. 検証: 残ったペアだけを ORB+RANSAC (feature) または Gemini で検証する
+
+全組み合わせに対して高コストな手法を実行しないため、大きな画像群ほど処理量の削減効果が大きい。
+"""
+
+from __future__ import annotations
+
+import os
+import time
+from typing import Any, Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from ..config import env_float, env_int
+from .clip_matcher import embed_images, prepare_clip
+from .feature_matcher import compare_feature_pairs
+from .hamming import hamming_matrix, pack_hashes
+from .phash_matcher import hash_images, prepare_phash
+from .registry import MatchResult
+
+METHOD_NAME = "cascade"
+VERIFIERS = ("feature", "gemini", "none")
+
+
+# pHash の類似度がこの値以上なら、後段を省略して一致とする
+_ACCEPT_SIMILARITY = env_float("CASCADE_PHASH_ACCEPT", 0.95)
+# pHash の類似度がこの値未満なら、明らかに異なるペアとして除外する
+_REJECT_SIMILARITY = env_float("CASCADE_PHASH_REJECT", 0.4)
+# CLIP の類似度がこの値未満のペアは検証に回さない
+_CLIP_MIN_SIMILARITY = env_float("CASCADE_CLIP_MIN", 0.5)
+# 検証段階に回すペア数の上限
+_TOP_K = env_int("CASCADE_TOP_K", 20, 1)
+_VERIFIER = os.getenv("CASCADE_VERIFIER", "feature")
+
+
+def compare_cascade(
+    images1: Iterable[str],
+    images2: Iterable[str],
+    threshold: float,
+    **options: Any,
+) -> List[dict]:
+    """
+    pHash → CLIP → 検証の順に候補を絞り込みながら画像を比較する
+
+    引数は compare_cascade_with_stats と同じ。段階ごとの統計が必要な場合はそちらを使う
+
+    戻り値:
+        list[dict]: 類似度の降順に並んだマッチ結果
+    """
+    return compare_cascade_with_stats(images1, images2, threshold, **options).matches
+
+
+def compare_cascade_with_stats(
+    images1: Iterable[str],
+    images2: Iterable[str],
+    threshold: float,
+    *,
+    accept_similarity: float = _ACCEPT_SIMILARITY,
+    reject_similarity: float = _REJECT_SIMILARITY,
+    clip_min_similarity: float = _CLIP_MIN_SIMILARITY,
+    top_k: int = _TOP_K,
+    verifier: str = _VERIFIER,
+) -> MatchResult:
+    """
+    pHash → CLIP → 検証の順に候補を絞り込みながら画像を比較する
+
+    引数:
+        threshold: 検証段階の手法に渡す類似度の閾値
+        accept_similarity: pHash でそのまま一致とする類似度
+        reject_similarity: pHash で除外する類似度 (これ未満を除外)
+        clip_min_similarity: CLIP で検証に回す最小の類似度
+        top_k: 検証段階に回すペア数の上限
+        verifier: 検証に使う手法 ("feature", "gemini", "none" は CLIP の類似度で判定)
+
+    戻り値:
+        MatchResult: 類似度の降順に並んだマッチ結果と、段階ごとの処理時間と絞り込み件数。
+        各結果の stage に一致と判定した段階を記録する
+    """
+    if verifier not in VERIFIERS:
+        raise ValueError(f"不明な検証手法 '{verifier}'")
+
+    total_start = time.perf_counter()
+    stats: Dict[str, Any] = {}
+
+    # 1. pHash による即時判定と除外
+    start = time.perf_counter()
+    hashes1 = hash_images(images1)
+    hashes2 = hash_images(images2)
+    paths1, packed1 = pack_hashes(hashes1)
+    paths2, packed2 = pack_hashes(hashes2)
+    accepted: List[dict] = []
+    survivors: List[Tuple[int, int]] = []
+    phash_similarities = np.zeros((len(paths1), len(paths2)))
+    if paths1 and paths2:
+        hash_bits = next(iter(hashes1.values())).hash.size
+        phash_similarities = 1 - hamming_matrix(packed1, packed2) / hash_bits
+        rows, cols = np.nonzero(phash_similarities >= accept_similarity)
+        for i, j in zip(rows.tolist(), cols.tolist()):
+            accepted.append(
+                _build_match(
+                    paths1[i],
+                    paths2[j],
+                    {"similarity": float(phash_similarities[i, j])},
+                    "phash",
+                    float(phash_similarities[i, j]),
+                )
+            )
+        rows, cols = np.nonzero(
+            (phash_similarities >= reject_similarity)
+            & (phash_similarities < accept_similarity)
+        )
+        survivors = list(zip(rows.tolist(), cols.tolist()))
+
+    pair_count = len(paths1) * len(paths2)
+    stats["pairs"] = pair_count
+    stats["phash"] = {
+        "input": pair_count,
+        "accepted": len(accepted),
+        "rejected": pair_count - len(accepted) - len(survivors),
+        "passed": len(survivors),
+        "seconds": time.perf_counter() - start,
+    }
+
+    # 2. CLIP による順位付け
+    start = time.perf_counter()
+    ranked = _rank_with_clip(paths1, paths2, survivors, clip_min_similarity)
+    candidates = ranked[:top_k]
+    stats["clip"] = {
+        "input": len(survivors),
+        "rejected": len(survivors) - len(ranked),
+        "pruned": len(ranked) - len(candidates),
+        "passed": len(candidates),
+        "seconds": time.perf_counter() - start,
+    }
+
+    # 3. 残ったペアだけを高コストな手法で検証
+    start = time.perf_counter()
+    verified = _verify(
+        candidates, paths1, paths2, phash_similarities, threshold, verifier
+    )
+    stats["verify"] = {
+        "method": verifier,
+        "input": len(candidates),
+        "matched": len(verified),
+        "seconds": time.perf_counter() - start,
+    }
+    stats["total_seconds"] = time.perf_counter() - total_start
+
+    matches = accepted + verified
+    matches.sort(key=lambda x: x["similarity"], reverse=True)
+    return MatchResult(matches, stats)
+
+
+def prepare_cascade(images: Iterable[str]) -> None:
+    """前段で使う pHash と CLIP 埋め込みを事前に計算してキャッシュへ保存する"""
+    images = list(images)
+    prepare_phash(images)
+    prepare_clip(images)
+
+
+def _rank_with_clip(
+    paths1: List[str],
+    paths2: List[str],
+    pairs: List[Tuple[int, int]],
+    min_similarity: float,
+) -> List[Tuple[int, int, float]]:
+    """ペアを CLIP の類似度の降順に並べる (min_similarity 未満と埋め込めない画像は除く)"""
+    if not pairs:
+        return []
+
+    # 候補ペアに含まれる画像だけを埋め込む
+    rows = sorted({i for i, _ in pairs})
+    cols = sorted({j for _, j in pairs})
+    embedded1, embeddings1 = embed_images([paths1[i] for i in rows])
+    embedded2, embeddings2 = embed_images([paths2[j] for j in cols])
+    row_of = {path: n for n, path in enumerate(embedded1)}
+    col_of = {path: n for n, path in enumerate(embedded2)}
+
+    valid = [(i, j) for i, j in pairs if paths1[i] in row_of and paths2[j] in col_of]
+    if not valid:
+        return []
+
+    index1 = np.array([row_of[paths1[i]] for i, _ in valid])
+    index2 = np.array([col_of[paths2[j]] for _, j in valid])
+    # 埋め込みは正規化済みなので内積がコサイン類似度になる
+    similarities = np.einsum("ij,ij->i", embeddings1[index1], embeddings2[index2])
+
+    order = np.argsort(-similarities, kind="stable")
+    return [
+        (valid[n][0], valid[n][1], float(similarities[n]))
+        for n in order.tolist()
+        if similarities[n] >= min_similarity
+    ]
+
+
+def _verify(
+    candidates: List[Tuple[int, int, float]],
+    paths1: List[str],
+    paths2: List[str],
+    phash_similarities: np.ndarray,
+    threshold: float,
+    verifier: str,
+) -> List[dict]:
+    if not candidates:
+        return []
+
+    scores = {
+        (paths1[i], paths2[j]): (float(phash_similarities[i, j]), clip_similarity)
+        for i, j, clip_similarity in candidates
+    }
+
+    if verifier == "none":
+        results = [
+            ({"similarity": clip_similarity}, paths1[i], paths2[j])
+            for i, j, clip_similarity in candidates
+            if clip_similarity >= threshold
+        ]
+        stage = "clip"
+    elif verifier == "feature":
+        results = [
+            (match, path1, path2)
+            for path1, path2, match in compare_feature_pairs(list(scores), threshold)
+        ]
+        stage = "feature"
+    else:
+        results = _verify_with_gemini(list(scores), threshold)
+        stage = "gemini"
+
+    matches = []
+    for result, path1, path2 in results:
+        phash_similarity, clip_similarity = scores[(path1, path2)]
+        match = _build_match(path1, path2, result, stage, phash_similarity)
+        match["clip_similarity"] = clip_similarity
+        matches.append(match)
+    return matches
+
+
+def _verify_with_gemini(
+    pairs: List[Tuple[str, str]], threshold: float
+) -> List[Tuple[dict, str, str]]:
+    # API キーなどの設定を読み込むため、Gemini を使うときだけ読み込む
+    from .gemini_matcher import compare_gemini_pairs
+
+    try:
+        # 候補は選択済みなので、ペアを選び直さずにそのまま判定させる
+        results = compare_gemini_pairs(pairs, threshold)
+    except RuntimeError as exc:
+        print(f"カスケードの Gemini 検証に失敗しました: {exc}")
+        return []
+
+    return [
+        (result, path1, path2)
+        for path1, path2, result in results
+        if result.get("passed_threshold")
+    ]
+
+
+def _build_match(
+    path1: str,
+    path2: str,
+    result: dict,
+    stage: str,
+    phash_similarity: float,
+) -> dict:
+    match = {key: value for key, value in result.items() if key != "method"}
+    match.update(
+        {
+            "image1": os.path.basename(path1),
+            "image2": os.path.basename(path2),
+            "similarity": float(result["similarity"]),
+            "phash_similarity": phash_similarity,
+            "stage": stage,
+            "method": METHOD_NAME,
+        }
+    )
+    return match
@@ -3,19 +3,57 @@
 from __future__ import annotations
 
 import os
-from pathlib import Path
-from typing import Iterable, List
+from typing import Dict, Iterable, Iterator, List, Tuple
 
 import clip
+import numpy as np
 import torch
-from PIL import Image
+
+from ..cache import lookup, store
+from ..embedding_service import encode_remote
+from ..embedding_store import EmbeddingStore
+from ..image_loader import THUMBNAIL_SIZE, decode_variant, load_image
+from ..lru import SizedLRU
 
 METHOD_NAME = "clip"
 _DEFAULT_MODEL_NAME = "ViT-B/32"
+_DEFAULT_BATCH_SIZE = 32
+_DECODE_VARIANT = decode_variant("rgb", THUMBNAIL_SIZE)
+
+_DEFAULT_MODEL_CACHE_MAX_BYTES = 2 * 1024**3
+# iter_clip で一度に類似度を計算する行数
+_SIMILARITY_BLOCK_ROWS = 256
+# 推論の精度: fp32 (既定) / int8 (Linear 層の動的量子化、CPU のみ) / bf16 (bfloat16 の autocast)
+PRECISIONS = ("fp32", "int8", "bf16")
+_DEFAULT_PRECISION = os.getenv("CLIP_PRECISION", "fp32")
 
 _DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-_MODEL = None
-_PREPROCESS = None
+
+# 推論に使うスレッド数 (未設定なら torch の既定値)
+_NUM_THREADS = os.getenv("CLIP_NUM_THREADS")
+if _NUM_THREADS:
+    try:
+        torch.set_num_threads(max(1, int(_NUM_THREADS)))
+    except ValueError:
+        print(f"CLIP_NUM_THREADS の値が不正です: {_NUM_THREADS}")
+
+
+def _max_bytes_from_env() -> int:
+    try:
+        return int(
+            os.getenv("CLIP_MODEL_CACHE_MAX_BYTES", str(_DEFAULT_MODEL_CACHE_MAX_BYTES))
+        )
+    except ValueError:
+        return _DEFAULT_MODEL_CACHE_MAX_BYTES
+
+
+# 重みの合計バイト数が上限を超えると、最も長く使われていないモデルから手放す
+# (直前に読み込んだモデルは上限を超えていても保持する)
+_MODELS = SizedLRU(
+    _max_bytes_from_env(),
+    keep_latest=True,
+    on_evict=lambda key: print(f"CLIPモデル {key} をキャッシュから外しました"),
+)
 
 
 def compare_clip(
@@ -24,60 +62,327 @@ def compare_clip(
     threshold: float,
     *,
     model_name: str = _DEFAULT_MODEL_NAME,
+    batch_size: int = _DEFAULT_BATCH_SIZE,
+    precision: str = _DEFAULT_PRECISION,
 ) -> List[dict]:
-    """CLIP を用いて 2 つの画像群の類似度を評価する"""
-    model, preprocess = _get_model(model_name)
-
-    embeddings1 = _encode_images(images1, model, preprocess)
-    embeddings2 = _encode_images(images2, model, preprocess)
-
-    matches = []
-    for img1_path, emb1 in embeddings1.items():
-        for img2_path, emb2 in embeddings2.items():
-            similarity = _cosine_similarity(emb1, emb2)
-
-            if similarity >= threshold:
-                matches.append(
-                    {
-                        "image1": os.path.basename(img1_path),
-                        "image2": os.path.basename(img2_path),
-                        "similarity": float(similarity),
-                        "method": METHOD_NAME,
-                        "clip_model": model_name,
-                    }
-                )
+    """
+    CLIP を用いて 2 つの画像群の類似度を評価する
 
+    引数:
+        precision: 推論の精度 ("fp32", "int8", "bf16")。
+            int8 / bf16 は CPU での推論が速くなる代わりに、埋め込みが fp32 からわずかにずれる
+    """
+    matches = list(
+        iter_clip(
+            images1,
+            images2,
+            threshold,
+            model_name=model_name,
+            batch_size=batch_size,
+            precision=precision,
+        )
+    )
     matches.sort(key=lambda x: x["similarity"], reverse=True)
     return matches
 
 
-def _get_model(model_name: str):
-    global _MODEL, _PREPROCESS
+def iter_clip(
+    images1: Iterable[str],
+    images2: Iterable[str],
+    threshold: float,
+    *,
+    model_name: str = _DEFAULT_MODEL_NAME,
+    batch_size: int = _DEFAULT_BATCH_SIZE,
+    precision: str = _DEFAULT_PRECISION,
+) -> Iterator[dict]:
+    """compare_clip と同じ比較を行い、マッチ結果を images1 の順に返す (類似度順ではない)"""
+    paths1, embeddings1 = _encode_images(images1, batch_size, model_name, precision)
+    paths2, embeddings2 = _encode_images(images2, batch_size, model_name, precision)
+
+    if not paths1 or not paths2:
+        return
+
+    names2 = [os.path.basename(p) for p in paths2]
+    for start in range(0, len(paths1), _SIMILARITY_BLOCK_ROWS):
+        # 特徴量を正規化しているので行列積がそのままコサイン類似度になる
+        block = embeddings1[start : start + _SIMILARITY_BLOCK_ROWS] @ embeddings2.T
+        for img1_path, similarities in zip(paths1[start:], block.tolist()):
+            img1_name = os.path.basename(img1_path)
+            for img2_name, similarity in zip(names2, similarities):
+                if similarity < threshold:
+                    continue
+                yield {
+                    "image1": img1_name,
+                    "image2": img2_name,
+                    "similarity": float(similarity),
+                    "method": METHOD_NAME,
+                    "clip_model": model_name,
+                    "clip_precision": precision,
+                }
+
+
+def embed_images(
+    image_paths: Iterable[str],
+    *,
+    model_name: str = _DEFAULT_MODEL_NAME,
+    batch_size: int = _DEFAULT_BATCH_SIZE,
+    precision: str = _DEFAULT_PRECISION,
+) -> Tuple[List[str], np.ndarray]:
+    """
+    画像群を正規化済み CLIP 埋め込みに変換する
+
+    戻り値:
+        (読み込めた画像パスのリスト, shape=(N, D) の float32 配列)
+    """
+    paths, embeddings = _encode_images(image_paths, batch_size, model_name, precision)
+    return paths, embeddings.numpy()
+
+
+def prepare_clip(
+    images: Iterable[str],
+    *,
+    model_name: str = _DEFAULT_MODEL_NAME,
+    batch_size: int = _DEFAULT_BATCH_SIZE,
+    precision: str = _DEFAULT_PRECISION,
+) -> None:
+    """埋め込みを事前に計算してキャッシュへ保存する"""
+    embed_images(
+        images, model_name=model_name, batch_size=batch_size, precision=precision
+    )
+
+
+def search_clip(
+    images: Iterable[str],
+    store: EmbeddingStore,
+    *,
+    top_k: int = 10,
+    nprobe: int | None = None,
+    model_name: str = _DEFAULT_MODEL_NAME,
+    batch_size: int = _DEFAULT_BATCH_SIZE,
+    precision: str = _DEFAULT_PRECISION,
+) -> List[dict]:
+    """
+    埋め込みストアに登録済みの画像から、各画像に類似するものを上位 top_k 件ずつ探す
+
+    引数:
+        images: 検索元の画像パスのイテラブル
+        store: embed_images の出力を登録した EmbeddingStore
+        top_k: 画像ごとに返す件数
+        nprobe: 指定すると IVF インデックスによる近似探索を行う
+
+    戻り値:
+        list[dict]: 類似度の降順に並んだ検索結果
+    """
+    paths, embeddings = embed_images(
+        images, model_name=model_name, batch_size=batch_size, precision=precision
+    )
+    if not paths:
+        return []
+
+    results = []
+    for img_path, hits in zip(paths, store.search(embeddings, top_k, nprobe=nprobe)):
+        for item_id, similarity in hits:
+            results.append(
+                {
+                    "image1": os.path.basename(img_path),
+                    "id": item_id,
+                    "similarity": similarity,
+                    "method": METHOD_NAME,
+                    "clip_model": model_name,
+                }
+            )
+
+    results.sort(key=lambda x: x["similarity"], reverse=True)
+    return results
 
-    if _MODEL is None or _PREPROCESS is None:
+
+def preload_models(
+    model_names: Iterable[str] = (_DEFAULT_MODEL_NAME,),
+    *,
+    precision: str = _DEFAULT_PRECISION,
+) -> None:
+    """
+    CLIP モデルを読み込んでキャッシュしておく (最初の比較でのモデル読み込みを避けるため)
+
+    引数:
+        model_names: 読み込むモデル名 (例: ["ViT-B/32", "ViT-L/14"])
+        precision: 推論の精度 (int8 は量子化済みのモデルを用意する)
+    """
+    for model_name in model_names:
+        get_model(model_name, precision)
+
+
+def loaded_models() -> List[Tuple[str, str]]:
+    """
+    キャッシュに保持しているモデルの (モデル名, 重みの形式) のリスト
+
+    古く使われたものから順に並ぶ。bf16 は fp32 の重みを共有するため、重みの形式は fp32 か int8
+    """
+    return list(_MODELS.keys())
+
+
+def get_model(model_name: str, precision: str = _DEFAULT_PRECISION):
+    """
+    モデルと前処理関数の組を返す (読み込み済みでなければ読み込んでキャッシュする)
+
+    例外:
+        ValueError: 不明な精度、または GPU で int8 を指定した場合
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(
+            f"不明な精度 '{precision}' ({', '.join(PRECISIONS)} のいずれか)"
+        )
+    if precision == "int8" and _DEVICE != "cpu":
+        raise ValueError("int8 の量子化は CPU での推論でのみ利用できます")
+
+    # bf16 は推論時に autocast するだけなので、fp32 のモデルを共有する
+    weights = "int8" if precision == "int8" else "fp32"
+
+    def load():
         model, preprocess = clip.load(model_name, device=_DEVICE)
         model.eval()
-        _MODEL = model
-        _PREPROCESS = preprocess
+        if weights == "int8":
+            # 画像エンコーダーの Linear 層の重みを int8 に量子化する (活性は推論時に動的に量子化)
+            torch.ao.quantization.quantize_dynamic(
+                model.visual, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+        return (model, preprocess), _model_bytes(model)
+
+    return _MODELS.get_or_load((model_name, weights), load)
+
+
+def _model_bytes(model: torch.nn.Module) -> int:
+    """
+    重みのバイト数を state_dict から求める
+
+    動的量子化した Linear 層の int8 の重みはパラメータやバッファではなく、
+    state_dict の _packed_params に (重み, バイアス) のタプルとして入るため、タプルの中も数える
+    """
+    seen = set()
+    total = 0
+    pending = list(model.state_dict().values())
+    while pending:
+        value = pending.pop()
+        if isinstance(value, (tuple, list)):
+            pending.extend(value)
+        elif isinstance(value, torch.Tensor) and value.numel() > 0:
+            # 同じ記憶領域を共有する重みは 1 回だけ数える
+            if value.data_ptr() in seen:
+                continue
+            seen.add(value.data_ptr())
+            total += value.numel() * value.element_size()
+    return total
+
 
-    return _MODEL, _PREPROCESS
+def encode_tensors(
+    model, tensors: List[torch.Tensor], precision: str = _DEFAULT_PRECISION
+) -> np.ndarray:
+    """前処理済みの画像テンソルを 1 回の推論でエンコードし、正規化済みの埋め込みを返す"""
+    batch = torch.stack(tensors).to(_DEVICE)
+    with (
+        torch.inference_mode(),
+        torch.autocast(
+            device_type=_DEVICE, dtype=torch.bfloat16, enabled=precision == "bf16"
+        ),
+    ):
+        features = model.encode_image(batch)
+    return torch.nn.functional.normalize(features.float(), dim=-1).cpu().numpy()
 
 
-def _encode_images(image_paths: Iterable[str], model, preprocess):
-    embeddings = {}
+def _encode_images(
+    image_paths: Iterable[str],
+    batch_size: int = _DEFAULT_BATCH_SIZE,
+    model_name: str = _DEFAULT_MODEL_NAME,
+    precision: str = _DEFAULT_PRECISION,
+) -> Tuple[List[str], torch.Tensor]:
+    """
+    画像をバッチ単位でエンコードし、正規化済み埋め込み行列を返す
+
+    キャッシュ済みの画像はエンコードを省略し、同じパスが複数回含まれていても 1 回だけエンコードする
+    (戻り値には渡された順・回数のまま含まれる)。
+    埋め込みサービス (CLIP_EMBEDDING_SOCKET) が起動していればエンコードを任せ、
+    起動していなければこのプロセスでモデルを読み込んでエンコードする
+
+    戻り値:
+        (読み込めた画像パスのリスト, shape=(N, D) の埋め込み行列)
+    """
+    params = {"model_name": model_name, "decode": _DECODE_VARIANT}
+    if precision != "fp32":
+        # 精度によって埋め込みがわずかに異なるため、fp32 とは別にキャッシュする
+        params["precision"] = precision
+    image_paths = list(image_paths)
+    embeddings: Dict[str, np.ndarray] = {}
+    pending: List[str] = []
+
+    for img_path in dict.fromkeys(image_paths):
+        try:
+            cached_embedding = lookup(img_path, METHOD_NAME, params)
+        except Exception as exc:
+            print(f"CLIP処理エラー {img_path}: {exc}")
+            continue
+        if cached_embedding is not None:
+            embeddings[img_path] = cached_embedding
+        else:
+            pending.append(img_path)
+
+    if pending:
+        remote = encode_remote(pending, model_name, precision)
+        if remote is not None:
+            for img_path in pending:
+                if img_path in remote:
+                    embeddings[img_path] = remote[img_path]
+                    store(img_path, METHOD_NAME, params, remote[img_path])
+        else:
+            _encode_local(
+                pending, batch_size, model_name, precision, params, embeddings
+            )
+
+    ordered = [p for p in image_paths if p in embeddings]
+    if not ordered:
+        return ordered, torch.empty((0, 0))
+    return ordered, torch.from_numpy(np.stack([embeddings[p] for p in ordered]))
+
+
+def _encode_local(
+    image_paths: List[str],
+    batch_size: int,
+    model_name: str,
+    precision: str,
+    params: dict,
+    embeddings: Dict[str, np.ndarray],
+) -> None:
+    model, preprocess = get_model(model_name, precision)
+    batch_paths: List[str] = []
+    batch_tensors: List[torch.Tensor] = []
+
     for img_path in image_paths:
         try:
-            image = preprocess(Image.open(Path(img_path))).unsqueeze(0).to(_DEVICE)
-            with torch.no_grad():
-                features = model.encode_image(image)
-            normalized = torch.nn.functional.normalize(features, dim=-1).cpu()
-            embeddings[img_path] = normalized
+            batch_tensors.append(preprocess(load_image(img_path, THUMBNAIL_SIZE)))
+            batch_paths.append(img_path)
         except Exception as exc:
             print(f"CLIP処理エラー {img_path}: {exc}")
-    return embeddings
+            continue
+
+        if len(batch_tensors) >= batch_size:
+            _encode_batch(
+                batch_paths, batch_tensors, model, params, embeddings, precision
+            )
+            batch_paths, batch_tensors = [], []
+
+    if batch_tensors:
+        _encode_batch(batch_paths, batch_tensors, model, params, embeddings, precision)
+
 
+def _encode_batch(
+    paths: List[str],
+    tensors: List[torch.Tensor],
+    model,
+    params: dict,
+    embeddings: Dict[str, np.ndarray],
+    precision: str = _DEFAULT_PRECISION,
+) -> None:
+    normalized = encode_tensors(model, tensors, precision)
 
-def _cosine_similarity(embedding1: torch.Tensor, embedding2: torch.Tensor) -> float:
-    # 特徴量を正規化しているので内積がそのままコサイン類似度になる
-    similarity = torch.matmul(embedding1, embedding2.T).item()
-    return similarity
+    for path, embedding in zip(paths, normalized):
+        embeddings[path] = embedding
+        store(path, METHOD_NAME, params, embedding)
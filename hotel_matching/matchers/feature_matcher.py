@@ -2,14 +2,50 @@
 
 from __future__ import annotations
 
+import math
 import os
-from typing import Iterable, List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Protocol,
+    Tuple,
+)
 
 import cv2
 import numpy as np
 
+from ..cache import cached
+from ..image_loader import decode_variant, load_gray
+
 
 METHOD_NAME = "feature"
+# 特徴点抽出前に揃える画像の高さ
+_DEFAULT_TARGET_HEIGHT = 480
+# ペア検証の並列数 (0 以下で CPU コア数)
+try:
+    _DEFAULT_WORKERS = int(os.getenv("FEATURE_MATCH_WORKERS", "0"))
+except ValueError:
+    _DEFAULT_WORKERS = 0
+_SHARDS_PER_WORKER = 4
+# 記述子の対応付けに使う方式 (MATCHER_BACKENDS のいずれか)
+_DEFAULT_MATCHER_BACKEND = os.getenv("FEATURE_MATCHER_BACKEND", "bf")
+MATCHER_BACKENDS = ("bf", "flann")
+# FLANN の LSH インデックスのパラメータ (algorithm=6 が LSH)
+_LSH_INDEX_PARAMS = {
+    "algorithm": 6,
+    "table_number": 6,
+    "key_size": 12,
+    "multi_probe_level": 1,
+}
+_LSH_SEARCH_PARAMS = {"checks": 32}
+_LSH_SEED = 0
 
 
 def compare_feature(
@@ -20,106 +56,419 @@ def compare_feature(
     orb_nfeatures: int = 1000,
     ratio_test: float = 0.75,
     ransac_reproj_threshold: float = 5.0,
+    target_height: int = _DEFAULT_TARGET_HEIGHT,
+    workers: int = _DEFAULT_WORKERS,
+    matcher_backend: str = _DEFAULT_MATCHER_BACKEND,
 ) -> List[dict]:
-    matches = []
+    """
+    ORB + RANSAC で 2 つの画像群の全組み合わせを比較する
+
+    ペアの検証は workers 個のスレッドに分割して並列に実行する
+    (OpenCV の処理中は GIL が解放される)。結果は逐次実行と同じ順序になる。
+
+    引数:
+        workers: 並列数 (0 以下で CPU コア数、1 で逐次実行)
+        matcher_backend: 記述子の対応付け方式
+            ("bf" は総当たり、"flann" は画像ごとの LSH インデックスによる近似探索)
+    """
+    matches = list(
+        iter_feature(
+            images1,
+            images2,
+            threshold,
+            orb_nfeatures=orb_nfeatures,
+            ratio_test=ratio_test,
+            ransac_reproj_threshold=ransac_reproj_threshold,
+            target_height=target_height,
+            workers=workers,
+            matcher_backend=matcher_backend,
+        )
+    )
+    matches.sort(key=lambda x: x["similarity"], reverse=True)
+    return matches
 
+
+def iter_feature(
+    images1: Iterable[str],
+    images2: Iterable[str],
+    threshold: float,
+    *,
+    orb_nfeatures: int = 1000,
+    ratio_test: float = 0.75,
+    ransac_reproj_threshold: float = 5.0,
+    target_height: int = _DEFAULT_TARGET_HEIGHT,
+    workers: int = _DEFAULT_WORKERS,
+    matcher_backend: str = _DEFAULT_MATCHER_BACKEND,
+) -> Iterator[dict]:
+    """
+    compare_feature と同じ比較を行い、マッチ結果を検証が終わった分から返す
+
+    結果は images1 × images2 の順に並び、類似度順にはならない
+    """
+    orb = cv2.ORB_create(nfeatures=orb_nfeatures)
+
+    # 特徴点抽出は画像ごとに 1 回だけ行い、全ペアで使い回す
+    params = _feature_params(orb_nfeatures, target_height)
+    features1 = _extract_features(images1, orb, params)
+    features2 = _extract_features(images2, orb, params)
+
+    pairs = [
+        (img1_path, img2_path) for img1_path in features1 for img2_path in features2
+    ]
+    for _, _, match in _iter_match_pairs(
+        pairs,
+        features1,
+        features2,
+        threshold,
+        ratio_test,
+        ransac_reproj_threshold,
+        workers,
+        matcher_backend,
+    ):
+        yield match
+
+
+def compare_feature_pairs(
+    pairs: Iterable[Tuple[str, str]],
+    threshold: float,
+    *,
+    orb_nfeatures: int = 1000,
+    ratio_test: float = 0.75,
+    ransac_reproj_threshold: float = 5.0,
+    target_height: int = _DEFAULT_TARGET_HEIGHT,
+    workers: int = _DEFAULT_WORKERS,
+    matcher_backend: str = _DEFAULT_MATCHER_BACKEND,
+) -> List[Tuple[str, str, dict]]:
+    """
+    全組み合わせではなく、指定した画像ペアだけを特徴点マッチングで検証する
+
+    引数:
+        pairs: (1つ目の画像パス, 2つ目の画像パス) のイテラブル
+
+    戻り値:
+        (1つ目の画像パス, 2つ目の画像パス, マッチ結果) のリスト。
+        閾値以上のペアだけを類似度の降順に並べる
+    """
+    pairs = list(pairs)
     orb = cv2.ORB_create(nfeatures=orb_nfeatures)
-    bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+    params = _feature_params(orb_nfeatures, target_height)
+    features1 = _extract_features(dict.fromkeys(p for p, _ in pairs), orb, params)
+    features2 = _extract_features(dict.fromkeys(p for _, p in pairs), orb, params)
+
+    pairs = [(p1, p2) for p1, p2 in pairs if p1 in features1 and p2 in features2]
+    matches = list(
+        _iter_match_pairs(
+            pairs,
+            features1,
+            features2,
+            threshold,
+            ratio_test,
+            ransac_reproj_threshold,
+            workers,
+            matcher_backend,
+        )
+    )
+    matches.sort(key=lambda x: x[2]["similarity"], reverse=True)
+    return matches
 
-    for img1_path in images1:
-        for img2_path in images2:
-            try:
-                img1 = cv2.imread(img1_path, cv2.IMREAD_GRAYSCALE)
-                img2 = cv2.imread(img2_path, cv2.IMREAD_GRAYSCALE)
 
-                if img1 is None or img2 is None:
-                    print(f"画像読み込みエラー: {img1_path} or {img2_path}")
-                    continue
+def prepare_feature(
+    images: Iterable[str],
+    *,
+    orb_nfeatures: int = 1000,
+    target_height: int = _DEFAULT_TARGET_HEIGHT,
+) -> None:
+    """特徴点と記述子を事前に計算してキャッシュへ保存する"""
+    orb = cv2.ORB_create(nfeatures=orb_nfeatures)
+    params = _feature_params(orb_nfeatures, target_height)
+    _extract_features(images, orb, params)
 
-                img1_resized, img2_resized = _resize_pair(img1, img2)
 
-                kp1, des1 = orb.detectAndCompute(img1_resized, None)
-                kp2, des2 = orb.detectAndCompute(img2_resized, None)
+def _iter_match_pairs(
+    pairs: List[Tuple[str, str]],
+    features1: dict,
+    features2: dict,
+    threshold: float,
+    ratio_test: float,
+    ransac_reproj_threshold: float,
+    workers: int,
+    matcher_backend: str,
+) -> Iterator[Tuple[str, str, dict]]:
+    """ペアを検証し、閾値以上のペアを (画像パス, 画像パス, マッチ結果) として pairs の順に返す"""
+    if matcher_backend not in MATCHER_BACKENDS:
+        raise ValueError(f"不明な特徴点マッチング方式 '{matcher_backend}'")
+    if not pairs:
+        return
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(pairs))
+
+    match_shard = partial(
+        _match_shard,
+        features1=features1,
+        features2=features2,
+        threshold=threshold,
+        ratio_test=ratio_test,
+        ransac_reproj_threshold=ransac_reproj_threshold,
+    )
+    train_keys = [img2_path for _, img2_path in pairs]
+
+    # 処理時間のばらつきを均すため、ワーカー数より細かく分割して順に割り当てる
+    # (逐次実行でも分割し、検証が終わったシャードから結果を返す)
+    size = math.ceil(len(pairs) / (max(workers, 1) * _SHARDS_PER_WORKER))
+    shards = [pairs[i : i + size] for i in range(0, len(pairs), size)]
+    if workers <= 1:
+        shared = (
+            _LshKnn.build(train_keys, features2)
+            if matcher_backend == "flann"
+            else _BruteForceKnn()
+        )
+        for shard in shards:
+            yield from match_shard(shard, get_knn=_knn_factory(shared))
+        return
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="feature") as pool:
+        # LSH インデックスは分割前に train 側の画像ごとに 1 回だけ (並列に) 作り、全スレッドで共有する
+        # (作成後は検索だけなので、ロックなしで同時に使える)
+        lsh = (
+            _LshKnn.build(train_keys, features2, pool.map)
+            if matcher_backend == "flann"
+            else None
+        )
+        get_knn = _knn_factory(lsh)
+        # map は入力順に結果を返すので、連結すると逐次実行と同じ順序になる。
+        # 途中で読むのをやめた場合、未着手のシャードは取り消される
+        for result in pool.map(partial(match_shard, get_knn=get_knn), shards):
+            yield from result
+
+
+def _knn_factory(shared: Optional[_Knn]) -> Callable[[], _Knn]:
+    """shared があれば全スレッドで共有し、なければ BFMatcher をスレッドごとに作って使い回す"""
+    local = threading.local()
+
+    def get_knn() -> _Knn:
+        if shared is not None:
+            return shared
+        if not hasattr(local, "knn"):
+            local.knn = _BruteForceKnn()
+        return local.knn
+
+    return get_knn
+
+
+def _match_shard(
+    pairs: List[Tuple[str, str]],
+    *,
+    get_knn: Callable[[], _Knn],
+    features1: dict,
+    features2: dict,
+    threshold: float,
+    ratio_test: float,
+    ransac_reproj_threshold: float,
+) -> List[Tuple[str, str, dict]]:
+    matches = []
+    knn = get_knn()
+
+    for img1_path, img2_path in pairs:
+        pts1, des1 = features1[img1_path]
+        pts2, des2 = features2[img2_path]
+        try:
+            query_idx, train_idx, distances = _apply_ratio_test(
+                knn(img2_path, des1, des2), ratio_test
+            )
+
+            if len(query_idx) < 4:
+                continue
+
+            similarity, stats = _evaluate_matches(
+                pts1[query_idx],
+                pts2[train_idx],
+                distances,
+                ransac_reproj_threshold,
+            )
+
+            if similarity >= threshold:
+                match = {
+                    "image1": os.path.basename(img1_path),
+                    "image2": os.path.basename(img2_path),
+                    "similarity": float(similarity),
+                    **stats,
+                    "method": METHOD_NAME,
+                }
+                matches.append((img1_path, img2_path, match))
+
+        except Exception as exc:
+            print(f"特徴点マッチングエラー {img1_path} vs {img2_path}: {exc}")
 
-                if des1 is None or des2 is None or len(des1) < 2 or len(des2) < 2:
-                    continue
+    return matches
 
-                knn_matches = bf.knnMatch(des1, des2, k=2)
-                good_matches = _apply_ratio_test(knn_matches, ratio_test)
 
-                if len(good_matches) < 4:
-                    continue
+class _Knn(Protocol):
+    def __call__(
+        self, train_key: str, des1: np.ndarray, des2: np.ndarray
+    ) -> np.ndarray:
+        """
+        des1 の各記述子に対する des2 の上位 2 件を返す
+
+        戻り値:
+            shape=(N, 4) の配列 (query 側の番号, 1 位の train 側の番号, 1 位の距離, 2 位の距離)
+        """
+        ...
+
+
+class _BruteForceKnn:
+    """総当たり (BFMatcher) による対応付け"""
+
+    def __init__(self):
+        self._matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+
+    def __call__(
+        self, train_key: str, des1: np.ndarray, des2: np.ndarray
+    ) -> np.ndarray:
+        knn_matches = self._matcher.knnMatch(des1, des2, k=2)
+        # DMatch からの値の取り出しだけを 1 回の走査で行い、判定は配列演算で行う
+        return np.array(
+            [
+                (m.queryIdx, m.trainIdx, m.distance, n.distance)
+                for m, n in (pair for pair in knn_matches if len(pair) == 2)
+            ],
+            dtype=np.float64,
+        ).reshape(-1, 4)
+
+
+class _LshKnn:
+    """
+    FLANN の LSH インデックスによる近似的な対応付け
+
+    インデックスは build で train 側の画像ごとに 1 回だけ作り、他の画像との比較で使い回す
+    """
+
+    def __init__(self, indexes: Dict[str, Tuple[cv2.flann_Index, np.ndarray]]):
+        # flann_Index が参照する記述子を解放しないよう、インデックスと一緒に保持する
+        self._indexes = indexes
+
+    @classmethod
+    def build(
+        cls,
+        train_keys: Iterable[str],
+        features: dict,
+        map_func: Callable = map,
+    ) -> "_LshKnn":
+        """train_keys の各画像のインデックスを作る (map_func にスレッドプールの map を渡すと並列に作る)"""
+        keys = list(dict.fromkeys(train_keys))
+        entries = map_func(_build_lsh_index, [features[key][1] for key in keys])
+        return cls(dict(zip(keys, entries)))
+
+    def __call__(
+        self, train_key: str, des1: np.ndarray, des2: np.ndarray
+    ) -> np.ndarray:
+        index, _ = self._indexes[train_key]
+        indices, distances = index.knnSearch(des1, 2, params=_LSH_SEARCH_PARAMS)
+        # 近傍が 2 件見つからなかった記述子は -1 になるので除く
+        found = np.flatnonzero((indices >= 0).all(axis=1))
+        return np.column_stack(
+            [found, indices[found, 0], distances[found, 0], distances[found, 1]]
+        ).astype(np.float64)
+
+
+def _build_lsh_index(descriptors: np.ndarray) -> Tuple[cv2.flann_Index, np.ndarray]:
+    # LSH のビット選択は OpenCV の乱数 (スレッドごと) で決まるため、
+    # シードを固定して同じ画像からは常に同じインデックスを作る
+    cv2.setRNGSeed(_LSH_SEED)
+    return cv2.flann_Index(descriptors, _LSH_INDEX_PARAMS), descriptors
+
+
+def _feature_params(orb_nfeatures: int, target_height: int) -> dict:
+    return {
+        "orb_nfeatures": orb_nfeatures,
+        "target_height": target_height,
+        "decode": decode_variant("gray", target_height),
+    }
 
-                similarity, stats = _evaluate_matches(
-                    good_matches, kp1, kp2, ransac_reproj_threshold
-                )
 
-                if similarity >= threshold:
-                    matches.append(
-                        {
-                            "image1": os.path.basename(img1_path),
-                            "image2": os.path.basename(img2_path),
-                            "similarity": float(similarity),
-                            **stats,
-                            "method": METHOD_NAME,
-                        }
-                    )
+def _extract_features(image_paths: Iterable[str], orb, params: dict):
+    """画像ごとの特徴点座標と記述子を、キャッシュを参照しながら求める"""
+    features = {}
+    for img_path in image_paths:
+        try:
+            result = cached(
+                img_path,
+                METHOD_NAME,
+                params,
+                lambda: _detect_features(img_path, orb, params["target_height"]),
+            )
+            if result is not None:
+                features[img_path] = result
+        except Exception as exc:
+            print(f"特徴点抽出エラー {img_path}: {exc}")
+    return features
 
-            except Exception as exc:
-                print(f"特徴点マッチングエラー {img1_path} vs {img2_path}: {exc}")
 
-    matches.sort(key=lambda x: x["similarity"], reverse=True)
-    return matches
+def _detect_features(img_path: str, orb, target_height: int):
+    """画像を読み込み、共通の高さに揃えて ORB の特徴点と記述子を計算する"""
+    img = load_gray(img_path, target_height)
+    if img is None:
+        print(f"画像読み込みエラー: {img_path}")
+        return None
 
+    img_resized = _resize_with_aspect_ratio(img, target_height)
+    keypoints, descriptors = orb.detectAndCompute(img_resized, None)
 
-def _resize_pair(img1, img2):
-    h1, _ = img1.shape[:2]
-    h2, _ = img2.shape[:2]
-    target_height = min(h1, h2)
-    return (
-        _resize_with_aspect_ratio(img1, target_height),
-        _resize_with_aspect_ratio(img2, target_height),
-    )
+    if descriptors is None or len(descriptors) < 2:
+        return None
+
+    # cv2.KeyPoint は保存できないので座標だけを配列で保持する
+    points = np.float32([kp.pt for kp in keypoints])
+    return points, descriptors
 
 
 def _resize_with_aspect_ratio(img, target_height):
     h, w = img.shape[:2]
     aspect_ratio = w / h
     new_width = int(target_height * aspect_ratio)
-    return cv2.resize(img, (new_width, target_height), interpolation=cv2.INTER_AREA)
+    interpolation = cv2.INTER_AREA if target_height < h else cv2.INTER_LINEAR
+    return cv2.resize(img, (new_width, target_height), interpolation=interpolation)
 
 
-def _apply_ratio_test(knn_matches, ratio_test):
-    good_matches = []
-    for match_pair in knn_matches:
-        if len(match_pair) == 2:
-            m, n = match_pair
-            if m.distance < ratio_test * n.distance:
-                good_matches.append(m)
-    return good_matches
+def _apply_ratio_test(knn_values: np.ndarray, ratio_test: float):
+    """
+    比率テストを通過した対応点を配列で返す
 
+    引数:
+        knn_values: _Knn が返す shape=(N, 4) の配列
 
-def _evaluate_matches(good_matches, kp1, kp2, ransac_reproj_threshold):
-    src_pts = np.float32([kp1[m.queryIdx].pt for m in good_matches]).reshape(-1, 1, 2)
-    dst_pts = np.float32([kp2[m.trainIdx].pt for m in good_matches]).reshape(-1, 1, 2)
+    戻り値:
+        (query 側の特徴点番号, train 側の特徴点番号, 距離) の配列
+    """
+    good = knn_values[knn_values[:, 2] < ratio_test * knn_values[:, 3]]
+    return good[:, 0].astype(np.intp), good[:, 1].astype(np.intp), good[:, 2]
 
-    M, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, ransac_reproj_threshold)
+
+def _evaluate_matches(src_pts, dst_pts, distances, ransac_reproj_threshold):
+    """対応点の座標 (n, 2) と距離から RANSAC のインライアを求めて類似度を計算する"""
+    M, mask = cv2.findHomography(
+        src_pts.reshape(-1, 1, 2),
+        dst_pts.reshape(-1, 1, 2),
+        cv2.RANSAC,
+        ransac_reproj_threshold,
+    )
 
     if mask is None:
         return 0.0, {}
 
-    inliers = [good_matches[i] for i in range(len(good_matches)) if mask[i]]
+    inlier_distances = distances[mask.ravel().astype(bool)]
+    inlier_count = len(inlier_distances)
 
-    if len(inliers) == 0:
+    if inlier_count == 0:
         return 0.0, {}
 
-    avg_distance = sum(m.distance for m in inliers) / len(inliers)
+    avg_distance = float(inlier_distances.mean())
     similarity = 1 / (1 + avg_distance)
-    inlier_ratio = len(inliers) / len(good_matches)
+    inlier_ratio = inlier_count / len(distances)
 
     return similarity, {
-        "inlier_count": len(inliers),
-        "total_matches": len(good_matches),
+        "inlier_count": inlier_count,
+        "total_matches": len(distances),
         "inlier_ratio": float(inlier_ratio),
-        "avg_distance": float(avg_distance),
+        "avg_distance": avg_distance,
     }
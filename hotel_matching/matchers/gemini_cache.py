@@ -0,0 +1,101 @@
+"""
+Gemini の判定結果を画像ペアの内容ハッシュで保存するキャッシュ
+
+キーは両画像の SHA-256・モデル名・プロンプトのバージョンから作るため、
+同じ画像ペアを再度判定するときは API を呼ばずに前回の判定を返す。
+判定結果は特徴量キャッシュと同じ SQLite に有効期限付きで保存する。
+"""
+
+from __future__ import annotations
+
+import sqlite3
+import threading
+from typing import Dict, Optional
+
+from ..cache import file_digest, get_cache
+
+_KEY_PREFIX = "gemini-verdict"
+
+
+class VerdictCacheStats:
+    """キャッシュのヒット・ミス数と、ミス時の API 呼び出し時間の累計"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._hits = 0
+            self._misses = 0
+            self._miss_seconds = 0.0
+
+    def record_hit(self) -> None:
+        with self._lock:
+            self._hits += 1
+
+    def record_miss(self, seconds: float) -> None:
+        with self._lock:
+            self._misses += 1
+            self._miss_seconds += seconds
+
+    def snapshot(self) -> Dict[str, float]:
+        """
+        現在の集計値を返す
+
+        estimated_saved_seconds はヒット数 × ミス時の平均応答時間で見積もった短縮時間
+        """
+        with self._lock:
+            hits, misses, miss_seconds = self._hits, self._misses, self._miss_seconds
+        total = hits + misses
+        average = miss_seconds / misses if misses else 0.0
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+            "api_seconds": miss_seconds,
+            "average_api_seconds": average,
+            "estimated_saved_seconds": hits * average,
+        }
+
+
+STATS = VerdictCacheStats()
+
+
+def verdict_key(
+    tour_path: str, airtrip_path: str, model_name: str, prompt_version: str
+) -> str:
+    """画像ペアの内容・モデル名・プロンプトのバージョンからキャッシュキーを作る"""
+    return (
+        f"{_KEY_PREFIX}:{model_name}:{prompt_version}:"
+        f"{file_digest(tour_path)}:{file_digest(airtrip_path)}"
+    )
+
+
+def get_verdict(key: str) -> Optional[dict]:
+    """保存済みの判定結果を返す。無効化されている・存在しない・期限切れの場合は None"""
+    cache = get_cache()
+    if cache is None:
+        return None
+    try:
+        value = cache.get(key)
+    except sqlite3.Error as exc:
+        print(f"Gemini 判定キャッシュ参照エラー {key}: {exc}")
+        return None
+    return value if isinstance(value, dict) else None
+
+
+def put_verdict(key: str, result: dict, ttl: float) -> None:
+    """判定結果を ttl 秒の有効期限付きで保存する。ttl が 0 以下なら保存しない"""
+    cache = get_cache()
+    if cache is None or ttl <= 0:
+        return
+    try:
+        cache.set(key, result, ttl=ttl)
+    except sqlite3.Error as exc:
+        print(f"Gemini 判定キャッシュ保存エラー {key}: {exc}")
+
+
+def get_verdict_cache_stats() -> Dict[str, float]:
+    """プロセス内で集計した判定キャッシュのヒット率と短縮時間を返す"""
+    return STATS.snapshot()
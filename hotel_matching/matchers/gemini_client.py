@@ -0,0 +1,251 @@
+"""
+Gemini 呼び出しのクライアント抽象と並列ディスパッチャ
+
+GeminiClient を実装したクライアント (実 API / ローカルのフェイク) を
+GeminiDispatcher に渡すと、同時実行数・レート制限・タイムアウト・リトライを適用して呼び出す。
+同時実行数とレート制限は、複数のディスパッチャで共有するオブジェクトを渡すことができる。
+"""
+
+from __future__ import annotations
+
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Protocol, Sequence, Tuple
+
+import google.generativeai as genai
+from PIL import Image
+
+Parts = Sequence[object]
+
+# リトライする HTTP ステータス (タイムアウト・レート制限・サーバー側の一時的なエラー)
+_TRANSIENT_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class GeminiClient(Protocol):
+    """プロンプトの parts を受け取り、モデルのテキスト応答を返すクライアント"""
+
+    # 判定キャッシュのキーに使うモデル名
+    model_name: str
+
+    def generate(self, parts: Parts, timeout: float) -> str: ...
+
+
+class GenaiClient:
+    """google.generativeai を使う実 API クライアント"""
+
+    def __init__(self, model_name: str, api_key: Optional[str]):
+        if not api_key:
+            raise RuntimeError("環境変数 GEMINI_API_KEY が設定されていません。")
+
+        genai.configure(api_key=api_key)
+        self.model_name = model_name
+        self._model = genai.GenerativeModel(model_name)
+
+    def generate(self, parts: Parts, timeout: float) -> str:
+        response = self._model.generate_content(
+            list(parts), request_options={"timeout": timeout}
+        )
+        text = getattr(response, "text", None)
+        if not text:
+            raise RuntimeError("Gemini API からテキスト応答が得られませんでした。")
+        return text
+
+
+class FakeGeminiClient:
+    """
+    ネットワークを使わずに応答を返すテスト・負荷検証用のクライアント
+
+    parts に含まれる画像の平均ハッシュの近さをスコアとして返す。
+
+    引数:
+        latency: 1 回の呼び出しにかかる秒数
+        failure_rate: 一時的なエラーを発生させる確率 (0〜1)
+        seed: 乱数のシード
+    """
+
+    model_name = "fake"
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        failure_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def generate(self, parts: Parts, timeout: float) -> str:
+        with self._lock:
+            self.calls += 1
+            fail = self._random.random() < self.failure_rate
+
+        if self.latency > timeout:
+            time.sleep(timeout)
+            raise TimeoutError("フェイククライアントがタイムアウトしました")
+        time.sleep(self.latency)
+        if fail:
+            raise ConnectionError("フェイククライアントの一時的なエラー")
+
+        images = [part for part in parts if isinstance(part, Image.Image)]
+        scores = [_fake_score(a, b) for a, b in zip(images[::2], images[1::2])]
+        results = [
+            {
+                "score": score,
+                "decision": "same" if score >= 0.9 else "different",
+                "reason": "フェイククライアントによる判定",
+            }
+            for score in scores
+        ]
+        return json.dumps(results[0] if len(results) == 1 else results)
+
+
+class TokenBucket:
+    """
+    トークンバケット方式のレート制限
+
+    引数:
+        rate: 1 秒あたりに補充するトークン数
+        capacity: バケットの容量 (瞬間的に許容するリクエスト数)
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """トークンを 1 つ取得する。足りなければ補充されるまで待つ"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_transient_error(exc: Exception) -> bool:
+    """
+    リトライすれば成功する見込みのあるエラーかどうか
+
+    タイムアウト・接続エラーと、429 / 5xx 応答 (google.api_core の例外の code) を一時的なエラーとみなす。
+    認証エラーや不正な引数などはリトライしても失敗するため対象外
+    """
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    code = getattr(exc, "code", None)
+    return isinstance(code, int) and code in _TRANSIENT_STATUSES
+
+
+class GeminiDispatcher:
+    """
+    複数のリクエストを並列に送信する
+
+    引数:
+        client: 呼び出しに使うクライアント
+        max_in_flight: 同時に送信するリクエスト数の上限
+        requests_per_minute: 1 分あたりのリクエスト数の上限 (0 以下で無制限)
+        timeout: 1 回の呼び出しのタイムアウト秒数
+        max_retries: 一時的なエラー (is_transient_error) での最大リトライ回数
+        backoff: リトライ間隔の基準秒数 (backoff * 2 ** n にジッターを加える)
+        rate_limiter: 指定するとレート制限にこのバケットを使う (requests_per_minute は無視)
+        in_flight: 指定すると同時実行数の制限にこのセマフォを使う。
+            複数のディスパッチャで共有すると、それらの合計で上限が守られる
+    """
+
+    def __init__(
+        self,
+        client: GeminiClient,
+        *,
+        max_in_flight: int = 4,
+        requests_per_minute: float = 60,
+        timeout: float = 60,
+        max_retries: int = 3,
+        backoff: float = 1.0,
+        sleep: Callable[[float], None] = time.sleep,
+        rate_limiter: Optional[TokenBucket] = None,
+        in_flight: Optional[threading.Semaphore] = None,
+    ):
+        self.client = client
+        self.max_in_flight = max(1, max_in_flight)
+        self.timeout = timeout
+        self.max_retries = max(0, max_retries)
+        self.backoff = backoff
+        self._sleep = sleep
+        if rate_limiter is not None:
+            self._bucket: Optional[TokenBucket] = rate_limiter
+        elif requests_per_minute > 0:
+            self._bucket = TokenBucket(requests_per_minute / 60, self.max_in_flight)
+        else:
+            self._bucket = None
+        self._in_flight = (
+            in_flight
+            if in_flight is not None
+            else threading.BoundedSemaphore(self.max_in_flight)
+        )
+        # 直前の run で各リクエストにかかった秒数 (リトライ・待ち時間を含む)
+        self.elapsed: List[float] = []
+
+    def run(self, requests: Sequence[Parts]) -> List[str | Exception]:
+        """
+        リクエストを並列に送信し、入力と同じ順序で結果を返す
+
+        戻り値:
+            各リクエストの応答テキスト。リトライしても失敗した場合はその例外
+        """
+        if not requests:
+            self.elapsed = []
+            return []
+        workers = min(self.max_in_flight, len(requests))
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="gemini"
+        ) as pool:
+            timed = list(pool.map(self._timed_call, requests))
+        self.elapsed = [elapsed for _, elapsed in timed]
+        return [result for result, _ in timed]
+
+    def _timed_call(self, parts: Parts) -> Tuple[str | Exception, float]:
+        start = time.perf_counter()
+        result = self._call_with_retry(parts)
+        return result, time.perf_counter() - start
+
+    def _call_with_retry(self, parts: Parts) -> str | Exception:
+        attempt = 0
+        while True:
+            if self._bucket is not None:
+                self._bucket.acquire()
+            try:
+                with self._in_flight:
+                    return self.client.generate(parts, self.timeout)
+            except Exception as exc:
+                if attempt >= self.max_retries or not is_transient_error(exc):
+                    return exc
+                delay = self.backoff * 2**attempt
+                attempt += 1
+                print(f"Gemini 呼び出しに失敗しました (再試行 {attempt}): {exc}")
+                self._sleep(delay + random.uniform(0, delay / 2))
+
+
+def _fake_score(image1: Image.Image, image2: Image.Image) -> float:
+    small1 = image1.convert("L").resize((8, 8))
+    small2 = image2.convert("L").resize((8, 8))
+    pixels1 = list(small1.getdata())
+    pixels2 = list(small2.getdata())
+    mean1 = sum(pixels1) / len(pixels1)
+    mean2 = sum(pixels2) / len(pixels2)
+    bits1 = [p > mean1 for p in pixels1]
+    bits2 = [p > mean2 for p in pixels2]
+    return sum(a == b for a, b in zip(bits1, bits2)) / len(bits1)
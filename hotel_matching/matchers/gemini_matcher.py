@@ -4,28 +4,85 @@ from __future__ import annotations
 
 import json
 import os
+import threading
 from pathlib import Path
-from typing import Iterable, List
+from typing import Iterable, List, NamedTuple, Tuple
 
-import google.generativeai as genai
+import numpy as np
 from dotenv import load_dotenv
 from PIL import Image
 
+from ..config import env_float, env_int
+from ..image_loader import load_image
+from .gemini_cache import STATS, get_verdict, put_verdict, verdict_key
+from .gemini_client import (
+    FakeGeminiClient,
+    GeminiClient,
+    GeminiDispatcher,
+    GenaiClient,
+    TokenBucket,
+)
+from .hamming import hamming_matrix, pack_hashes
+from .phash_matcher import hash_images
+
 METHOD_NAME = "gemini"
 _DEFAULT_MODEL = "gemini-2.5-flash"
 _DEFAULT_TOP_N = 3
+_DEFAULT_CACHE_TTL = 7 * 24 * 60 * 60
+# 送信する画像の短辺の最小値 (これ以上を保つ範囲で縮小デコードしてから送る)
+_IMAGE_SIZE = 1024
+PAIR_SELECTIONS = ("phash", "clip", "zip")
 
 load_dotenv()
 
+
 _MODEL_NAME = os.getenv("GEMINI_MODEL", _DEFAULT_MODEL)
 _API_KEY = os.getenv("GEMINI_API_KEY")
-try:
-    _TOP_N_IMAGES = int(os.getenv("GEMINI_TOP_N", str(_DEFAULT_TOP_N)))
-except ValueError:
-    _TOP_N_IMAGES = _DEFAULT_TOP_N
-_TOP_N_IMAGES = max(1, _TOP_N_IMAGES)
+# "fake" を指定するとネットワークを使わないフェイククライアントで動作する
+_BACKEND = os.getenv("GEMINI_BACKEND", "genai")
+_TOP_N_IMAGES = env_int("GEMINI_TOP_N", _DEFAULT_TOP_N, 1)
+_MAX_IN_FLIGHT = env_int("GEMINI_MAX_IN_FLIGHT", 4, 1)
+_REQUESTS_PER_MINUTE = env_float("GEMINI_RPM", 60)
+_TIMEOUT = env_float("GEMINI_TIMEOUT", 60)
+_MAX_RETRIES = env_int("GEMINI_MAX_RETRIES", 3, 0)
+# 問い合わせるペアの選び方 (PAIR_SELECTIONS のいずれか)
+_PAIR_SELECTION = os.getenv("GEMINI_PAIR_SELECTION", "phash")
+# 1 回の問い合わせにまとめるペア数
+_PAIRS_PER_REQUEST = env_int("GEMINI_PAIRS_PER_REQUEST", 1, 1)
+# 判定結果をキャッシュする秒数 (0 でキャッシュしない)
+_CACHE_TTL = env_float("GEMINI_CACHE_TTL", _DEFAULT_CACHE_TTL)
+
+_CLIENT: GeminiClient | None = None
+_CLIENT_LOCK = threading.Lock()
+
+# レート制限と同時実行数の制限はプロセス内のすべての呼び出しで共有し、
+# 同時に実行される比較ジョブの合計で GEMINI_RPM / GEMINI_MAX_IN_FLIGHT を超えないようにする
+_RATE_LIMITER = (
+    TokenBucket(_REQUESTS_PER_MINUTE / 60, _MAX_IN_FLIGHT)
+    if _REQUESTS_PER_MINUTE > 0
+    else None
+)
+_IN_FLIGHT = threading.BoundedSemaphore(_MAX_IN_FLIGHT)
 
-_MODEL: genai.GenerativeModel | None = None
+# プロンプトや応答形式を変更したときは値を変えて、古い判定キャッシュを使わないようにする
+# (2: フェイククライアントの判定が GEMINI_MODEL のキーで保存されていた分を使わないようにする)
+_PROMPT_VERSION = "2"
+_PROMPT = (
+    "Compare these hotel photos from two sources and respond ONLY with a JSON object exactly in this format: "
+    '{"score": <float 0-1>, "decision": "<same|different|uncertain>", "reason": "<short explanation in Japanese>"} '
+    "where score indicates visual similarity (1.0 = identical). "
+    "Choose 'same' only if you are confident they show the same hotel, 'different' if clearly not, otherwise use 'uncertain'. "
+    "Do not add any text outside the JSON and do not use Markdown code fences."
+)
+_MULTI_PROMPT = (
+    "Each of the {count} numbered pairs above contains one hotel photo from tour.ne.jp and one from airtrip.jp. "
+    "For each pair, judge whether the two photos show the same hotel and respond ONLY with a JSON array of {count} objects "
+    "in pair order, each exactly in this format: "
+    '{{"score": <float 0-1>, "decision": "<same|different|uncertain>", "reason": "<short explanation in Japanese>"}} '
+    "where score indicates visual similarity (1.0 = identical). "
+    "Choose 'same' only if you are confident they show the same hotel, 'different' if clearly not, otherwise use 'uncertain'. "
+    "Do not add any text outside the JSON and do not use Markdown code fences."
+)
 
 
 def compare_gemini(
@@ -34,91 +91,360 @@ def compare_gemini(
     threshold: float,
     *,
     top_n: int = _TOP_N_IMAGES,
+    selection: str = _PAIR_SELECTION,
+    pairs_per_request: int = _PAIRS_PER_REQUEST,
+    client: GeminiClient | None = None,
 ) -> List[dict]:
-    """Gemini API を使ってホテル画像のマッチングを判定する"""
-    model = _get_model()
+    """
+    Gemini API を使ってホテル画像のマッチングを判定する
 
-    tour_selected = _select_images(images1, top_n)
-    airtrip_selected = _select_images(images2, top_n)
+    ローカルで計算した類似度で問い合わせるペアを上位 top_n 組に絞り込み、
+    各問い合わせを並列に送信する。一時的なエラーはリトライされる。
+    すべてのペアで失敗した場合のみ RuntimeError を送出する。
+
+    引数:
+        top_n: 問い合わせるペア数
+        selection: ペアの選び方 ("phash" / "clip" は類似度の高い順、"zip" は先頭から同じ位置同士)
+        pairs_per_request: 1 回の問い合わせにまとめるペア数
+        client: 使用するクライアント (省略時は環境変数 GEMINI_BACKEND に従う)
+
+    判定済みの画像ペアはキャッシュから返し、API を呼び出さない (結果の cached が True)。
+    キャッシュのキーには実際に使うクライアントのモデル名を使い、フェイククライアントの判定は保存しない。
+    """
+    if selection not in PAIR_SELECTIONS:
+        raise ValueError(f"不明なペア選択方法 '{selection}'")
+
+    selected = _select_pairs(images1, images2, top_n, selection)
+    return [
+        match
+        for _, _, match in _judge_pairs(selected, threshold, pairs_per_request, client)
+    ]
 
-    pair_paths = list(zip(tour_selected, airtrip_selected))
-    if not pair_paths:
-        return []
 
-    prompt = (
-        "Compare these hotel photos from two sources and respond ONLY with a JSON object exactly in this format: "
-        '{"score": <float 0-1>, "decision": "<same|different|uncertain>", "reason": "<short explanation in Japanese>"} '
-        "where score indicates visual similarity (1.0 = identical). "
-        "Choose 'same' only if you are confident they show the same hotel, 'different' if clearly not, otherwise use 'uncertain'. "
-        "Do not add any text outside the JSON and do not use Markdown code fences."
+def compare_gemini_pairs(
+    pairs: Iterable[Tuple[str, str]],
+    threshold: float,
+    *,
+    pairs_per_request: int = _PAIRS_PER_REQUEST,
+    client: GeminiClient | None = None,
+) -> List[Tuple[str, str, dict]]:
+    """
+    ペアを選び直さず、指定した画像ペアだけを Gemini で判定する
+
+    引数:
+        pairs: (tour 画像のパス, airtrip 画像のパス) のイテラブル
+
+    戻り値:
+        (tour 画像のパス, airtrip 画像のパス, 判定結果) のリスト。
+        画像を読み込めなかったペアは含まない
+    """
+    return _judge_pairs(
+        [(tour_path, airtrip_path, None) for tour_path, airtrip_path in pairs],
+        threshold,
+        pairs_per_request,
+        client,
     )
 
-    matches: List[dict] = []
-    for index, (tour_path, airtrip_path) in enumerate(pair_paths, start=1):
+
+def _judge_pairs(
+    selected: List[Tuple[str, str, float | None]],
+    threshold: float,
+    pairs_per_request: int,
+    client: GeminiClient | None,
+) -> List[Tuple[str, str, dict]]:
+    """選択済みのペアを判定し、(tour 画像, airtrip 画像, 判定結果) を選択順に返す"""
+    model_name = _client_model_name(client)
+
+    matches: List[Tuple[str, str, dict] | None] = []
+    pending = []
+    for tour_path, airtrip_path, prior in selected:
+        key = _verdict_key(tour_path, airtrip_path, model_name)
+        result = get_verdict(key) if key is not None else None
+        if result is not None:
+            STATS.record_hit()
+            match = _build_match(
+                tour_path,
+                airtrip_path,
+                result,
+                threshold=threshold,
+                prior=prior,
+                cached=True,
+            )
+            matches.append((tour_path, airtrip_path, match))
+            continue
+
         tour_image = _load_image(tour_path)
         airtrip_image = _load_image(airtrip_path)
 
         if tour_image is None or airtrip_image is None:
             continue
 
-        parts: List[object] = [
-            f"tour.ne.jp image #{index}: {Path(tour_path).name}",
-            tour_image,
-            f"airtrip.jp image #{index}: {Path(airtrip_path).name}",
-            airtrip_image,
-            prompt,
-        ]
+        pending.append(
+            _PendingPair(
+                len(matches),
+                tour_path,
+                airtrip_path,
+                prior,
+                key,
+                tour_image,
+                airtrip_image,
+            )
+        )
+        matches.append(None)
 
-        try:
-            response = model.generate_content(parts)
-        except Exception as exc:
-            raise RuntimeError(f"Gemini API 呼び出しに失敗しました: {exc}") from exc
+    if not matches:
+        return []
+
+    errors: List[Exception] = []
+    if pending:
+        # キャッシュに無いペアがあるときだけクライアントを用意して API を呼び出す
+        dispatcher = GeminiDispatcher(
+            client or _get_client(),
+            max_in_flight=_MAX_IN_FLIGHT,
+            requests_per_minute=_REQUESTS_PER_MINUTE,
+            timeout=_TIMEOUT,
+            max_retries=_MAX_RETRIES,
+            rate_limiter=_RATE_LIMITER,
+            in_flight=_IN_FLIGHT,
+        )
+        size = max(1, pairs_per_request)
+        chunks = [pending[i : i + size] for i in range(0, len(pending), size)]
+        responses = dispatcher.run([_build_request(chunk) for chunk in chunks])
+        for chunk, response, elapsed in zip(chunks, responses, dispatcher.elapsed):
+            for _ in chunk:
+                STATS.record_miss(elapsed / len(chunk))
+            try:
+                if isinstance(response, Exception):
+                    raise RuntimeError(
+                        f"Gemini API 呼び出しに失敗しました: {response}"
+                    ) from response
+                results = _parse_response(response, len(chunk))
+            except RuntimeError as exc:
+                for pair in chunk:
+                    errors.append(exc)
+                    print(
+                        f"Gemini 判定エラー {pair.tour_path} vs {pair.airtrip_path}: {exc}"
+                    )
+                    match = _build_match(
+                        pair.tour_path,
+                        pair.airtrip_path,
+                        None,
+                        prior=pair.prior,
+                        error=str(exc),
+                    )
+                    matches[pair.position] = (pair.tour_path, pair.airtrip_path, match)
+                continue
+
+            for pair, result in zip(chunk, results):
+                if pair.key is not None:
+                    put_verdict(pair.key, result, _CACHE_TTL)
+                match = _build_match(
+                    pair.tour_path,
+                    pair.airtrip_path,
+                    result,
+                    threshold=threshold,
+                    prior=pair.prior,
+                )
+                matches[pair.position] = (pair.tour_path, pair.airtrip_path, match)
+
+    if len(errors) == len(matches):
+        raise errors[0]
+
+    return matches
+
+
+class _PendingPair(NamedTuple):
+    position: int
+    tour_path: str
+    airtrip_path: str
+    prior: float | None
+    key: str | None
+    tour_image: Image.Image
+    airtrip_image: Image.Image
 
-        text = getattr(response, "text", None)
-        if not text:
-            raise RuntimeError("Gemini API からテキスト応答が得られませんでした。")
 
+def _select_pairs(
+    images1: Iterable[str], images2: Iterable[str], top_n: int, selection: str
+) -> List[Tuple[str, str, float | None]]:
+    """
+    問い合わせるペアを (tour 画像, airtrip 画像, 事前の類似度) のリストで返す
+
+    類似度の高い順に、なるべく同じ画像が重複しないように top_n 組を選ぶ
+    """
+    images1 = list(images1)
+    images2 = list(images2)
+    if selection != "zip":
         try:
-            result = json.loads(text)
-        except json.JSONDecodeError as exc:
-            raise RuntimeError(
-                f"Gemini 応答を JSON として解釈できませんでした: {text}"
-            ) from exc
-
-        score = _to_float(result.get("score"))
-        decision = str(result.get("decision", "")).strip().lower()
-        if decision not in {"same", "different", "uncertain"}:
-            decision = "uncertain"
-        reason = str(result.get("reason", "")).strip()
-
-        similarity = score if score is not None else 0.0
-        passed_threshold = score is not None and score >= threshold
-
-        matches.append(
-            {
-                "image1": Path(tour_path).name,
-                "image2": Path(airtrip_path).name,
-                "tour_images": [Path(tour_path).name],
-                "airtrip_images": [Path(airtrip_path).name],
-                "similarity": float(similarity),
-                "decision": decision,
-                "reason": reason,
-                "passed_threshold": passed_threshold,
-                "method": METHOD_NAME,
-            }
+            return _rank_pairs(images1, images2, top_n, selection)
+        except Exception as exc:
+            print(f"Gemini のペア選択に失敗したため先頭から比較します: {exc}")
+
+    return [
+        (tour_path, airtrip_path, None)
+        for tour_path, airtrip_path in zip(
+            _select_images(images1, top_n), _select_images(images2, top_n)
         )
+    ]
 
-    return matches
 
+def _rank_pairs(
+    images1: List[str], images2: List[str], top_n: int, selection: str
+) -> List[Tuple[str, str, float | None]]:
+    if selection == "clip":
+        # torch の読み込みに時間がかかるため、CLIP を使うときだけ読み込む
+        from .clip_matcher import embed_images
+
+        paths1, embeddings1 = embed_images(images1)
+        paths2, embeddings2 = embed_images(images2)
+        if not paths1 or not paths2:
+            return []
+        similarities = embeddings1 @ embeddings2.T
+    else:
+        hashes1 = hash_images(images1)
+        hashes2 = hash_images(images2)
+        paths1, packed1 = pack_hashes(hashes1)
+        paths2, packed2 = pack_hashes(hashes2)
+        if not paths1 or not paths2:
+            return []
+        hash_bits = next(iter(hashes1.values())).hash.size
+        similarities = 1 - hamming_matrix(packed1, packed2) / hash_bits
+
+    order = np.argsort(-similarities, axis=None, kind="stable")
+    rows, cols = np.unravel_index(order, similarities.shape)
+    ranked = list(zip(rows.tolist(), cols.tolist()))
+
+    # まだ使っていない画像同士のペアを優先し、足りなければ残りから類似度順に補う
+    selected: List[Tuple[int, int]] = []
+    used1, used2 = set(), set()
+    for i, j in ranked:
+        if len(selected) >= top_n:
+            break
+        if i not in used1 and j not in used2:
+            selected.append((i, j))
+            used1.add(i)
+            used2.add(j)
+    if len(selected) < top_n:
+        chosen = set(selected)
+        selected += [pair for pair in ranked if pair not in chosen][
+            : top_n - len(selected)
+        ]
+
+    return [(paths1[i], paths2[j], float(similarities[i, j])) for i, j in selected]
+
+
+def _build_request(chunk: List[_PendingPair]) -> list:
+    if len(chunk) == 1:
+        pair = chunk[0]
+        return [
+            f"tour.ne.jp image #1: {Path(pair.tour_path).name}",
+            pair.tour_image,
+            f"airtrip.jp image #1: {Path(pair.airtrip_path).name}",
+            pair.airtrip_image,
+            _PROMPT,
+        ]
+
+    parts: list = []
+    for index, pair in enumerate(chunk, start=1):
+        parts += [
+            f"Pair {index} - tour.ne.jp image: {Path(pair.tour_path).name}",
+            pair.tour_image,
+            f"Pair {index} - airtrip.jp image: {Path(pair.airtrip_path).name}",
+            pair.airtrip_image,
+        ]
+    parts.append(_MULTI_PROMPT.format(count=len(chunk)))
+    return parts
+
+
+def _client_model_name(client: GeminiClient | None) -> str | None:
+    """判定を行うモデル名 (client 省略時は環境変数 GEMINI_BACKEND / GEMINI_MODEL に従う)"""
+    if client is not None:
+        return getattr(client, "model_name", None)
+    if _BACKEND == "fake":
+        return FakeGeminiClient.model_name
+    return _MODEL_NAME
+
+
+def _verdict_key(
+    tour_path: str, airtrip_path: str, model_name: str | None
+) -> str | None:
+    # モデル名の分からないクライアントとフェイククライアントの判定はキャッシュしない
+    # (本番の判定として返されないようにする)
+    if _CACHE_TTL <= 0 or model_name in (None, FakeGeminiClient.model_name):
+        return None
+    try:
+        return verdict_key(tour_path, airtrip_path, model_name, _PROMPT_VERSION)
+    except OSError as exc:
+        print(f"Gemini 判定キャッシュのキー作成に失敗: {exc}")
+        return None
+
+
+def _get_client() -> GeminiClient:
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            if _BACKEND == "fake":
+                _CLIENT = FakeGeminiClient()
+            else:
+                _CLIENT = GenaiClient(_MODEL_NAME, _API_KEY)
+    return _CLIENT
+
+
+def _parse_response(text: str, count: int = 1) -> List[dict]:
+    """応答を count 組分の判定結果のリストにする"""
+    try:
+        result = json.loads(text)
+    except json.JSONDecodeError as exc:
+        raise RuntimeError(
+            f"Gemini 応答を JSON として解釈できませんでした: {text}"
+        ) from exc
+    results = [result] if count == 1 and isinstance(result, dict) else result
+    if (
+        not isinstance(results, list)
+        or len(results) != count
+        or not all(isinstance(r, dict) for r in results)
+    ):
+        raise RuntimeError(f"Gemini 応答の形式が不正です: {text}")
+    return results
+
+
+def _build_match(
+    tour_path: str,
+    airtrip_path: str,
+    result: dict | None,
+    *,
+    threshold: float = 1.0,
+    prior: float | None = None,
+    error: str | None = None,
+    cached: bool = False,
+) -> dict:
+    result = result or {}
+    score = _to_float(result.get("score"))
+    decision = str(result.get("decision", "")).strip().lower()
+    if decision not in {"same", "different", "uncertain"}:
+        decision = "uncertain"
+    reason = str(result.get("reason", "")).strip() if error is None else error
+
+    similarity = score if score is not None else 0.0
+    passed_threshold = score is not None and score >= threshold
 
-def _get_model() -> genai.GenerativeModel:
-    global _MODEL
-    if _MODEL is None:
-        if not _API_KEY:
-            raise RuntimeError("環境変数 GEMINI_API_KEY が設定されていません。")
-        genai.configure(api_key=_API_KEY)
-        _MODEL = genai.GenerativeModel(_MODEL_NAME)
-    return _MODEL
+    match = {
+        "image1": Path(tour_path).name,
+        "image2": Path(airtrip_path).name,
+        "tour_images": [Path(tour_path).name],
+        "airtrip_images": [Path(airtrip_path).name],
+        "similarity": float(similarity),
+        "decision": decision,
+        "reason": reason,
+        "passed_threshold": passed_threshold,
+        "method": METHOD_NAME,
+        "cached": cached,
+    }
+    if prior is not None:
+        # ペアの選択に使ったローカルの類似度
+        match["preselect_similarity"] = prior
+    if error is not None:
+        match["error"] = error
+    return match
 
 
 def _select_images(images: Iterable[str], top_n: int) -> List[str]:
@@ -127,8 +453,7 @@ def _select_images(images: Iterable[str], top_n: int) -> List[str]:
 
 def _load_image(path: str) -> Image.Image | None:
     try:
-        with Image.open(path) as img:
-            return img.convert("RGB")
+        return load_image(path, _IMAGE_SIZE)
     except Exception as exc:
         print(f"Gemini 用画像読み込みに失敗: {path}: {exc}")
         return None
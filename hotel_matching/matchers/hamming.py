@@ -0,0 +1,122 @@
+"""ハッシュ値のハミング距離を NumPy で一括計算するモジュール"""
+
+from __future__ import annotations
+
+import os
+from typing import Iterator, List, Mapping, Sequence, Tuple
+
+import imagehash
+import numpy as np
+
+# iter_hash_matches で一度に距離を計算する行数
+_BLOCK_ROWS = 256
+
+
+def pack_hashes(
+    hashes: Mapping[str, imagehash.ImageHash],
+) -> Tuple[List[str], np.ndarray]:
+    """
+    ImageHash の辞書をパス一覧とビットパック済み配列に変換する
+
+    戻り値:
+        (パスのリスト, shape=(N, W) の配列)
+        64 ビットハッシュでは W=1 の uint64、それ以外は uint8 でパックする
+    """
+    paths = list(hashes.keys())
+    if not paths:
+        return paths, np.zeros((0, 1), dtype=np.uint64)
+
+    bits = np.stack([np.asarray(h.hash, dtype=bool).ravel() for h in hashes.values()])
+    packed = np.packbits(bits, axis=1)
+    if packed.shape[1] % 8 == 0:
+        # 8 バイト単位なら uint64 として扱い XOR の回数を減らす
+        packed = np.ascontiguousarray(packed).view(np.uint64)
+    return paths, packed
+
+
+def hamming_matrix(packed1: np.ndarray, packed2: np.ndarray) -> np.ndarray:
+    """XOR + popcount で全ペアのハミング距離行列 (N, M) を計算する"""
+    xor = np.bitwise_xor(packed1[:, None, :], packed2[None, :, :])
+    return np.bitwise_count(xor).sum(axis=2, dtype=np.int64)
+
+
+def match_hashes(
+    hashes1: Mapping[str, imagehash.ImageHash],
+    hashes2: Mapping[str, imagehash.ImageHash],
+    threshold: float,
+    method: str,
+) -> List[dict]:
+    """
+    2 つのハッシュ群を一括比較し、閾値以上のペアをマッチ結果として返す
+
+    引数:
+        hashes1: 画像パスと ImageHash の辞書
+        hashes2: 画像パスと ImageHash の辞書
+        threshold: 類似度の閾値 (0〜1)
+        method: 結果に記録する手法名
+
+    戻り値:
+        list[dict]: 類似度の降順に並んだマッチ結果
+    """
+    matches = list(iter_hash_matches(hashes1, hashes2, threshold, method))
+    matches.sort(key=lambda x: x["similarity"], reverse=True)
+    return matches
+
+
+def iter_hash_matches(
+    hashes1: Mapping[str, imagehash.ImageHash],
+    hashes2: Mapping[str, imagehash.ImageHash],
+    threshold: float,
+    method: str,
+    *,
+    block_rows: int = _BLOCK_ROWS,
+) -> Iterator[dict]:
+    """
+    match_hashes と同じ比較を block_rows 行ずつ行い、閾値以上のペアを見つけた順に返す
+
+    距離行列もマッチ結果も全体を保持しないため、大きな画像群でもメモリ使用量が一定に保たれる。
+    結果は hashes1 の順に並び、類似度順にはならない
+    """
+    paths1, packed1 = pack_hashes(hashes1)
+    paths2, packed2 = pack_hashes(hashes2)
+    if not paths1 or not paths2:
+        return
+
+    hash_size = next(iter(hashes1.values())).hash.size
+    names1 = [os.path.basename(p) for p in paths1]
+    names2 = [os.path.basename(p) for p in paths2]
+    for start in range(0, len(paths1), block_rows):
+        distances = hamming_matrix(packed1[start : start + block_rows], packed2)
+        similarities = 1 - distances / hash_size
+
+        rows, cols = np.nonzero(similarities >= threshold)
+        yield from _build_matches(
+            names1[start : start + block_rows],
+            names2,
+            rows,
+            cols,
+            similarities,
+            distances,
+            method,
+        )
+
+
+def _build_matches(
+    names1: Sequence[str],
+    names2: Sequence[str],
+    rows: np.ndarray,
+    cols: np.ndarray,
+    similarities: np.ndarray,
+    distances: np.ndarray,
+    method: str,
+) -> List[dict]:
+    return [
+        {
+            "image1": names1[i],
+            "image2": names2[j],
+            "similarity": float(similarities[i, j]),
+            "hash_distance": int(distances[i, j]),
+            "method": method,
+        }
+        for i, j in zip(rows.tolist(), cols.tolist())
+    ]
@@ -2,14 +2,21 @@
 
 from __future__ import annotations
 
-import os
-from typing import Iterable, List
+from typing import Iterable, Iterator, List
 
 import imagehash
-from PIL import Image
+
+from ..cache import cached
+from ..image_loader import THUMBNAIL_SIZE, decode_variant, load_image
+from .hamming import iter_hash_matches, match_hashes
 
 
 METHOD_NAME = "hash"
+_HASH_SIZE = 8
+_PARAMS = {
+    "hash_size": _HASH_SIZE,
+    "decode": decode_variant("rgb", THUMBNAIL_SIZE),
+}
 
 
 def compare_hash(
@@ -20,33 +27,42 @@ def compare_hash(
     hashes1 = _compute_hashes(images1)
     hashes2 = _compute_hashes(images2)
 
-    matches = []
-    for img1_path, hash1 in hashes1.items():
-        for img2_path, hash2 in hashes2.items():
-            diff = hash1 - hash2
-            similarity = 1 - diff / len(hash1.hash) ** 2
+    return match_hashes(hashes1, hashes2, threshold, METHOD_NAME)
 
-            if similarity >= threshold:
-                matches.append(
-                    {
-                        "image1": os.path.basename(img1_path),
-                        "image2": os.path.basename(img2_path),
-                        "similarity": float(similarity),
-                        "hash_distance": int(diff),
-                        "method": METHOD_NAME,
-                    }
-                )
 
-    matches.sort(key=lambda x: x["similarity"], reverse=True)
-    return matches
+def iter_hash(
+    images1: Iterable[str],
+    images2: Iterable[str],
+    threshold: float,
+) -> Iterator[dict]:
+    """compare_hash と同じ比較を行い、マッチ結果を見つけた順に返す (類似度順ではない)"""
+    hashes1 = _compute_hashes(images1)
+    hashes2 = _compute_hashes(images2)
+
+    yield from iter_hash_matches(hashes1, hashes2, threshold, METHOD_NAME)
+
+
+def prepare_hash(images: Iterable[str]) -> None:
+    """ハッシュ値を事前に計算してキャッシュへ保存する"""
+    _compute_hashes(images)
 
 
 def _compute_hashes(image_paths: Iterable[str]):
     hashes = {}
     for img_path in image_paths:
         try:
-            img = Image.open(img_path)
-            hashes[img_path] = imagehash.average_hash(img)
+            hashes[img_path] = cached(
+                img_path,
+                METHOD_NAME,
+                _PARAMS,
+                lambda: _hash_image(img_path),
+            )
         except Exception as exc:
             print(f"画像処理エラー {img_path}: {exc}")
     return hashes
+
+
+def _hash_image(img_path: str) -> imagehash.ImageHash:
+    return imagehash.average_hash(
+        load_image(img_path, THUMBNAIL_SIZE), hash_size=_HASH_SIZE
+    )
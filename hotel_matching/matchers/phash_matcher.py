@@ -3,12 +3,21 @@
 from __future__ import annotations
 
 import os
-from typing import Iterable, List
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
 
 import imagehash
-from PIL import Image
+
+from ..cache import cached
+from ..image_loader import THUMBNAIL_SIZE, decode_variant, load_image
+from ..hash_index import HashIndex
+from .hamming import iter_hash_matches, match_hashes
 
 METHOD_NAME = "phash"
+_HASH_SIZE = 8
+_PARAMS = {
+    "hash_size": _HASH_SIZE,
+    "decode": decode_variant("rgb", THUMBNAIL_SIZE),
+}
 
 
 def compare_phash(
@@ -19,23 +28,86 @@ def compare_phash(
     hashes1 = _compute_hashes(images1)
     hashes2 = _compute_hashes(images2)
 
+    return match_hashes(hashes1, hashes2, threshold, METHOD_NAME)
+
+
+def iter_phash(
+    images1: Iterable[str],
+    images2: Iterable[str],
+    threshold: float,
+) -> Iterator[dict]:
+    """compare_phash と同じ比較を行い、マッチ結果を見つけた順に返す (類似度順ではない)"""
+    hashes1 = _compute_hashes(images1)
+    hashes2 = _compute_hashes(images2)
+
+    yield from iter_hash_matches(hashes1, hashes2, threshold, METHOD_NAME)
+
+
+def prepare_phash(images: Iterable[str]) -> None:
+    """ハッシュ値を事前に計算してキャッシュへ保存する"""
+    _compute_hashes(images)
+
+
+def hash_images(images: Iterable[str]) -> Dict[str, imagehash.ImageHash]:
+    """画像パスと pHash の辞書を返す (読み込めなかった画像は含まない)"""
+    return _compute_hashes(images)
+
+
+def index_phash(
+    images: Iterable[str],
+    index: HashIndex,
+    key: Optional[Callable[[str], str]] = None,
+) -> int:
+    """
+    画像の pHash をインデックスに登録する
+
+    引数:
+        images: 登録する画像パスのイテラブル
+        index: 登録先の HashIndex
+        key: 画像パスから ID を作る関数 (省略時は画像パスをそのまま ID にする)。
+            画像が削除・再ダウンロードされても変わらない ID にしておくと、
+            インデックスに存在しないパスが残らない。登録済みの ID は新しい pHash で置き換える
+
+    戻り値:
+        新たに登録 (または置き換え) した件数
+    """
+    hashes = _compute_hashes(images)
+    ids = [key(path) if key else path for path in hashes]
+    return index.add(ids, [_hash_to_int(h) for h in hashes.values()])
+
+
+def find_phash(
+    images: Iterable[str],
+    index: HashIndex,
+    threshold: float,
+) -> List[dict]:
+    """
+    インデックスに登録済みの画像から、類似度が閾値以上のものを探す
+
+    引数:
+        images: 検索元の画像パスのイテラブル
+        index: index_phash で画像を登録した HashIndex
+        threshold: 類似度の閾値 (0〜1)
+
+    戻り値:
+        list[dict]: 類似度の降順に並んだ検索結果
+    """
+    hash_bits = _HASH_SIZE**2
+    # 浮動小数点の誤差で半径が 1 小さくならないように僅かに足してから切り捨てる
+    radius = int(hash_bits * (1 - threshold) + 1e-9)
+
     matches: List[dict] = []
-    for img1_path, hash1 in hashes1.items():
-        for img2_path, hash2 in hashes2.items():
-            diff = hash1 - hash2
-            hash_size = len(hash1.hash) ** 2
-            similarity = 1 - diff / hash_size
-
-            if similarity >= threshold:
-                matches.append(
-                    {
-                        "image1": os.path.basename(img1_path),
-                        "image2": os.path.basename(img2_path),
-                        "similarity": float(similarity),
-                        "hash_distance": int(diff),
-                        "method": METHOD_NAME,
-                    }
-                )
+    for img_path, hash_value in _compute_hashes(images).items():
+        for item_id, diff in index.query(_hash_to_int(hash_value), radius):
+            matches.append(
+                {
+                    "image1": os.path.basename(img_path),
+                    "id": item_id,
+                    "similarity": 1 - diff / hash_bits,
+                    "hash_distance": diff,
+                    "method": METHOD_NAME,
+                }
+            )
 
     matches.sort(key=lambda x: x["similarity"], reverse=True)
     return matches
@@ -45,8 +117,20 @@ def _compute_hashes(image_paths: Iterable[str]):
     hashes = {}
     for img_path in image_paths:
         try:
-            with Image.open(img_path) as img:
-                hashes[img_path] = imagehash.phash(img)
+            hashes[img_path] = cached(
+                img_path,
+                METHOD_NAME,
+                _PARAMS,
+                lambda: _hash_image(img_path),
+            )
         except Exception as exc:
             print(f"pHash処理エラー {img_path}: {exc}")
     return hashes
+
+
+def _hash_to_int(hash_value: imagehash.ImageHash) -> int:
+    return int(str(hash_value), 16)
+
+
+def _hash_image(img_path: str) -> imagehash.ImageHash:
+    return imagehash.phash(load_image(img_path, THUMBNAIL_SIZE), hash_size=_HASH_SIZE)
@@ -1,34 +1,140 @@
-"""手法名ごとのマッチング関数を管理するレジストリモジュール"""
+"""
+手法名ごとのマッチング関数を管理するレジストリモジュール
+
+各手法は "モジュール:関数名" の文字列で登録し、初めて使うときにモジュールを読み込む。
+torch / clip / OpenCV / google.generativeai などの重い依存は、その手法を使うまで読み込まれない。
+本番環境では warmup() で起動時に読み込んでおくと、最初のリクエストの待ち時間を避けられる。
+"""
 
 from __future__ import annotations
 
-from typing import Callable, Dict, Iterable, List
+import importlib
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+
+class MatchResult(NamedTuple):
+    """マッチ結果のリストと、段階ごとの処理時間や絞り込み件数などの統計"""
+
+    matches: List[dict]
+    stats: Dict[str, Any]
 
-from .clip_matcher import METHOD_NAME as CLIP_NAME
-from .clip_matcher import compare_clip
-from .feature_matcher import METHOD_NAME as FEATURE_NAME
-from .feature_matcher import compare_feature
-from .gemini_matcher import METHOD_NAME as GEMINI_NAME
-from .gemini_matcher import compare_gemini
-from .hash_matcher import METHOD_NAME as HASH_NAME
-from .hash_matcher import compare_hash
-from .phash_matcher import METHOD_NAME as PHASH_NAME
-from .phash_matcher import compare_phash
 
 MatcherFunc = Callable[[Iterable[str], Iterable[str], float], List[dict]]
+IterFunc = Callable[[Iterable[str], Iterable[str], float], Iterator[dict]]
+StatsFunc = Callable[[Iterable[str], Iterable[str], float], MatchResult]
+PrepareFunc = Callable[[Iterable[str]], None]
 
-_MATCHERS: Dict[str, MatcherFunc] = {
-    HASH_NAME: compare_hash,
-    FEATURE_NAME: compare_feature,
-    PHASH_NAME: compare_phash,
-    CLIP_NAME: compare_clip,
-    GEMINI_NAME: compare_gemini,
+# 手法名は各モジュールの METHOD_NAME と一致させること
+_MATCHERS: Dict[str, str] = {
+    "hash": ".hash_matcher:compare_hash",
+    "feature": ".feature_matcher:compare_feature",
+    "phash": ".phash_matcher:compare_phash",
+    "clip": ".clip_matcher:compare_clip",
+    "gemini": ".gemini_matcher:compare_gemini",
+    "cascade": ".cascade_matcher:compare_cascade",
 }
 
+# 画像ごとの特徴量を事前計算できる手法 (計算結果は共有キャッシュに保存される)
+_PREPARERS: Dict[str, str] = {
+    "hash": ".hash_matcher:prepare_hash",
+    "feature": ".feature_matcher:prepare_feature",
+    "phash": ".phash_matcher:prepare_phash",
+    "clip": ".clip_matcher:prepare_clip",
+    "cascade": ".cascade_matcher:prepare_cascade",
+}
+
+# マッチ結果を見つけた順に返せる手法 (それ以外は compare_iter が一括の結果を 1 件ずつ返す)
+_ITERATORS: Dict[str, str] = {
+    "hash": ".hash_matcher:iter_hash",
+    "feature": ".feature_matcher:iter_feature",
+    "phash": ".phash_matcher:iter_phash",
+    "clip": ".clip_matcher:iter_clip",
+}
+
+# マッチ結果と合わせて統計を返せる手法
+_STATS_MATCHERS: Dict[str, str] = {
+    "cascade": ".cascade_matcher:compare_cascade_with_stats",
+}
+
+# モジュールの読み込み以外に、起動時に済ませておける初期化 (モデルの読み込みなど)
+_WARMUPS: Dict[str, str] = {
+    "clip": ".clip_matcher:preload_models",
+    "cascade": ".clip_matcher:preload_models",
+}
+
+_resolved: Dict[str, Callable] = {}
+
 
 def get_matcher(method: str) -> MatcherFunc:
-    """指定された手法名に対応するマッチャー関数を返す"""
+    """
+    指定された手法名に対応するマッチャー関数を返す
+
+    例外:
+        ValueError: 不明な手法名の場合
+        RuntimeError: 手法のモジュール (または依存パッケージ) を読み込めない場合
+    """
     try:
-        return _MATCHERS[method]
+        target = _MATCHERS[method]
     except KeyError as exc:
         raise ValueError(f"不明なマッチャー '{method}'") from exc
+    return _resolve(method, target)
+
+
+def get_preparer(method: str) -> Optional[PrepareFunc]:
+    """指定された手法の事前計算関数を返す。事前計算できない手法は None"""
+    get_matcher(method)
+    target = _PREPARERS.get(method)
+    return _resolve(method, target) if target is not None else None
+
+
+def get_iterator(method: str) -> Optional[IterFunc]:
+    """指定された手法の逐次出力する関数を返す。対応していない手法は None"""
+    get_matcher(method)
+    target = _ITERATORS.get(method)
+    return _resolve(method, target) if target is not None else None
+
+
+def get_stats_matcher(method: str) -> Optional[StatsFunc]:
+    """指定された手法の統計も返すマッチャー関数を返す。統計を持たない手法は None"""
+    get_matcher(method)
+    target = _STATS_MATCHERS.get(method)
+    return _resolve(method, target) if target is not None else None
+
+
+def warmup(methods: Iterable[str]) -> List[str]:
+    """
+    指定された手法のモジュールと、モデルなどの重いリソースを事前に読み込む
+
+    読み込みに失敗した手法はエラーを表示して読み飛ばし、初めて使うときに改めて読み込む
+
+    戻り値:
+        読み込みに成功した手法名のリスト
+    """
+    loaded = []
+    for method in dict.fromkeys(methods):
+        try:
+            get_preparer(method)
+            target = _WARMUPS.get(method)
+            if target is not None:
+                _resolve(method, target)()
+        except Exception as exc:
+            print(f"手法 '{method}' の事前読み込みに失敗しました: {exc}")
+            continue
+        loaded.append(method)
+    return loaded
+
+
+def _resolve(method: str, target: str) -> Callable:
+    """モジュール:関数名 の文字列を関数に解決する (解決結果は保持する)"""
+    func = _resolved.get(target)
+    if func is None:
+        module_name, _, attr = target.partition(":")
+        try:
+            # import はスレッドセーフなので、同時に呼ばれても読み込みは 1 回だけ
+            module = importlib.import_module(module_name, __package__)
+        except ImportError as exc:
+            raise RuntimeError(
+                f"手法 '{method}' を読み込めませんでした: {exc}"
+            ) from exc
+        func = _resolved[target] = getattr(module, attr)
+    return func
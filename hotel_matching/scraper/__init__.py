@@ -10,21 +10,25 @@ from urllib.parse import urlparse, parse_qs
 import requests
 from bs4 import BeautifulSoup
 
+from .downloader import DEFAULT_TIMEOUT, download_images, get_session, guess_extension
 
-def extract_hotel_images_tour(hotel_id: str) -> List[str]:
+
+def extract_hotel_images_tour(hotel_id: str, output_dir: str = "images") -> List[str]:
     """
     tour.ne.jp からホテル画像を取得して保存する
 
     引数:
         hotel_id: tour.ne.jp のホテルID
+        output_dir: 画像の保存先ディレクトリ
 
     戻り値:
         ダウンロードした画像ファイルパスのリスト
     """
     url = f"https://www.tour.ne.jp/j_hotel/{hotel_id}/"
+    session = get_session()
 
     try:
-        response = requests.get(url, timeout=10)
+        response = session.get(url, timeout=DEFAULT_TIMEOUT)
         response.raise_for_status()
 
         soup = BeautifulSoup(response.content, "html.parser")
@@ -40,40 +44,24 @@ def extract_hotel_images_tour(hotel_id: str) -> List[str]:
 
         hotel_images = hotel_images[1:]  # 先頭の1枚を除外
 
-        os.makedirs("images", exist_ok=True)
+        os.makedirs(output_dir, exist_ok=True)
 
-        downloaded_files = []
+        targets = []
         for idx, img_tag in enumerate(hotel_images, 1):
-            try:
-                src_attr = img_tag.get("src")
-                if not isinstance(src_attr, str):
-                    continue
-                img_url = src_attr
-
-                if img_url.startswith("//"):
-                    img_url = "https:" + img_url
-                elif not img_url.startswith("http"):
-                    img_url = "https://" + img_url
-
-                img_response = requests.get(img_url, timeout=10)
-                img_response.raise_for_status()
-
-                ext = "jpg"
-                lower_url = img_url.lower()
-                if ".png" in lower_url:
-                    ext = "png"
-                elif ".webp" in lower_url:
-                    ext = "webp"
+            src_attr = img_tag.get("src")
+            if not isinstance(src_attr, str):
+                continue
+            img_url = src_attr
 
-                filename = f"images/tour_{hotel_id}_{idx}.{ext}"
-                with open(filename, "wb") as f:
-                    f.write(img_response.content)
+            if img_url.startswith("//"):
+                img_url = "https:" + img_url
+            elif not img_url.startswith("http"):
+                img_url = "https://" + img_url
 
-                downloaded_files.append(filename)
-                print(f"ダウンロード完了: {filename}")
+            filename = f"tour_{hotel_id}_{idx}.{guess_extension(img_url)}"
+            targets.append((img_url, os.path.join(output_dir, filename)))
 
-            except Exception as exc:
-                print(f"画像{idx}のダウンロードに失敗: {exc}")
+        downloaded_files = download_images(targets, session=session)
 
         return downloaded_files
 
@@ -82,17 +70,21 @@ def extract_hotel_images_tour(hotel_id: str) -> List[str]:
         return []
 
 
-def extract_hotel_images_airtrip(hotel_id: str) -> List[str]:
+def extract_hotel_images_airtrip(
+    hotel_id: str, output_dir: str = "images"
+) -> List[str]:
     """
     Skygate (airtrip.jp) からホテル画像を取得して保存する
 
     引数:
         hotel_id: Skygate のホテルID
+        output_dir: 画像の保存先ディレクトリ
 
     戻り値:
         ダウンロードした画像ファイルパスのリスト
     """
     url = "https://www.skygate.co.jp/kokunai/tour/list/hotel_detail"
+    session = get_session()
 
     # リトライ用のホテルコードリスト（動作しなくなったら検索可能な「札幌のホテル」に修正してください）
     retry_hotel_codes = ["3072939", "3228052", "1340731"]
@@ -123,7 +115,7 @@ def extract_hotel_images_airtrip(hotel_id: str) -> List[str]:
         }
 
         try:
-            response = requests.get(url, params=params, timeout=10)
+            response = session.get(url, params=params, timeout=DEFAULT_TIMEOUT)
             selected_item_key = parse_qs(urlparse(response.url).query).get(
                 "selectedItemKey", [None]
             )[0]
@@ -144,7 +136,7 @@ def extract_hotel_images_airtrip(hotel_id: str) -> List[str]:
     params["selectedItemKey"] = selected_item_key
 
     try:
-        response = requests.get(url, params=params, timeout=10)
+        response = session.get(url, params=params, timeout=DEFAULT_TIMEOUT)
         print(f"再検索URL: {response.url}")
         response.raise_for_status()
 
@@ -167,29 +159,19 @@ def extract_hotel_images_airtrip(hotel_id: str) -> List[str]:
             print("ギャラリー画像が見つかりませんでした")
             return []
 
-        os.makedirs("images", exist_ok=True)
-
-        downloaded_files = []
-        for idx, img_url in enumerate(image_urls, 1):
-            try:
-                img_response = requests.get(img_url, timeout=10)
-                img_response.raise_for_status()
-
-                url_lower = img_url.lower()
-                ext = (
-                    "png"
-                    if ".png" in url_lower
-                    else "webp" if ".webp" in url_lower else "jpg"
-                )
-                filename = f"images/airtrip_{hotel_id}_{idx}.{ext}"
-                with open(filename, "wb") as f:
-                    f.write(img_response.content)
-
-                downloaded_files.append(filename)
-                print(f"ダウンロード完了: {filename}")
-
-            except Exception as exc:
-                print(f"画像{idx}のダウンロードに失敗: {exc}")
+        os.makedirs(output_dir, exist_ok=True)
+
+        targets = [
+            (
+                img_url,
+                os.path.join(
+                    output_dir,
+                    f"airtrip_{hotel_id}_{idx}.{guess_extension(img_url)}",
+                ),
+            )
+            for idx, img_url in enumerate(image_urls, 1)
+        ]
+        downloaded_files = download_images(targets, session=session)
 
         return downloaded_files
 
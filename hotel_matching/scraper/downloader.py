@@ -0,0 +1,142 @@
+"""
+コネクションプールを共有した HTTP セッションと並列画像ダウンロード
+"""
+
+from __future__ import annotations
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_TIMEOUT = 10
+_DEFAULT_MAX_WORKERS = 8
+_DEFAULT_PER_HOST_LIMIT = 4
+_DEFAULT_RETRIES = 3
+_DEFAULT_BACKOFF = 0.5
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_SESSION: requests.Session | None = None
+_SESSION_LOCK = threading.Lock()
+
+# 同一ホストへの同時接続数の上限は、同時に実行される download_images の呼び出し全体で共有する
+_HOST_LIMITS: Dict[Tuple[str, int], threading.BoundedSemaphore] = {}
+_HOST_LIMITS_LOCK = threading.Lock()
+
+
+def create_session(
+    *,
+    retries: int = _DEFAULT_RETRIES,
+    backoff_factor: float = _DEFAULT_BACKOFF,
+    pool_maxsize: int = _DEFAULT_MAX_WORKERS,
+) -> requests.Session:
+    """
+    keep-alive とリトライ (指数バックオフ) を設定したセッションを作る
+
+    応答の読み込みがタイムアウトした場合はリトライしない
+    (応答しない画像 1 枚でタイムアウト × リトライ回数だけ待たされるのを避ける)
+
+    引数:
+        retries: 接続エラー・一時的なステータスでの最大リトライ回数
+        backoff_factor: リトライ間隔の基準秒数 (backoff_factor * 2 ** n)
+        pool_maxsize: ホストごとに保持する接続数
+    """
+    retry = Retry(
+        total=retries,
+        read=0,
+        backoff_factor=backoff_factor,
+        status_forcelist=_RETRY_STATUSES,
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        max_retries=retry, pool_connections=16, pool_maxsize=pool_maxsize
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """プロセス内で共有するセッションを返す"""
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = create_session()
+    return _SESSION
+
+
+def download_images(
+    targets: Sequence[Tuple[str, str]],
+    *,
+    session: Optional[requests.Session] = None,
+    max_workers: int = _DEFAULT_MAX_WORKERS,
+    per_host_limit: int = _DEFAULT_PER_HOST_LIMIT,
+    timeout: float = DEFAULT_TIMEOUT,
+) -> List[str]:
+    """
+    画像を並列にダウンロードして保存する
+
+    引数:
+        targets: (画像URL, 保存先パス) のシーケンス
+        session: 使用するセッション (省略時は共有セッション)
+        max_workers: 同時に実行するダウンロード数の上限
+        per_host_limit: 同一ホストへの同時接続数の上限
+            (同時に実行されている他の呼び出しの接続も含めて数える)
+        timeout: 1 リクエストあたりのタイムアウト秒数
+
+    戻り値:
+        保存に成功したパスのリスト (targets と同じ順序)
+    """
+    if not targets:
+        return []
+
+    session = session or get_session()
+
+    def fetch(idx: int, url: str, path: str) -> Optional[str]:
+        try:
+            with _host_limit(url, per_host_limit):
+                response = session.get(url, timeout=timeout)
+            response.raise_for_status()
+
+            with open(path, "wb") as f:
+                f.write(response.content)
+
+            print(f"ダウンロード完了: {path}")
+            return path
+        except Exception as exc:
+            print(f"画像{idx}のダウンロードに失敗 ({url}): {exc}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(targets))) as executor:
+        futures = [
+            executor.submit(fetch, idx, url, path)
+            for idx, (url, path) in enumerate(targets, 1)
+        ]
+        results = [future.result() for future in futures]
+
+    return [path for path in results if path is not None]
+
+
+def _host_limit(url: str, limit: int) -> threading.BoundedSemaphore:
+    """ホストと上限値ごとに共有するセマフォを返す"""
+    key = (urlparse(url).netloc, limit)
+    with _HOST_LIMITS_LOCK:
+        if key not in _HOST_LIMITS:
+            _HOST_LIMITS[key] = threading.BoundedSemaphore(limit)
+        return _HOST_LIMITS[key]
+
+
+def guess_extension(url: str) -> str:
+    """URL から保存用の拡張子を推定する"""
+    lower_url = url.lower()
+    if ".png" in lower_url:
+        return "png"
+    if ".webp" in lower_url:
+        return "webp"
+    return "jpg"
@@ -0,0 +1,268 @@
+"""
+サイト・ホテルIDごとに画像を保存するワークスペース管理
+
+画像は <root>/<site>/<hotel_id>/<version>/ に保存する。
+同じホテルの画像が有効期限 (TTL) 内にダウンロード済みであれば再利用し、
+使用中のバージョンには lease ファイルを置いて、ガベージコレクションで消されないようにする。
+lease を解放した後も、クライアントが画像を取得し終えるまでの猶予期間は削除しない。
+"""
+
+from __future__ import annotations
+
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional
+
+_MANIFEST_FILE = "manifest.json"
+_LOCK_FILE = ".lock"
+_LEASE_PREFIX = ".lease-"
+_GC_STAMP_FILE = ".gc"
+_DEFAULT_TTL_SECONDS = 60 * 60
+_DEFAULT_GC_INTERVAL_SECONDS = 5 * 60
+_DEFAULT_RELEASE_GRACE_SECONDS = 10 * 60
+
+ScrapeFunc = Callable[[str, str], List[str]]
+
+
+class Lease:
+    """ImageStore.checkout で取得した画像と、その使用中を示す lease ファイル"""
+
+    def __init__(self, images: List[str], path: Optional[Path]):
+        self.images = images
+        self._path = path
+
+    def release(self) -> None:
+        """画像の使用を終了する (以降はガベージコレクションの対象になる)"""
+        if self._path is not None:
+            self._path.unlink(missing_ok=True)
+            self._path = None
+
+
+class ImageStore:
+    """
+    ホテル単位で画像を共有・再利用するためのストア
+
+    引数:
+        root: 画像を保存するルートディレクトリ
+        ttl_seconds: ダウンロード済み画像を再利用する秒数
+        gc_interval_seconds: collect_garbage_in_background でガベージコレクションを行う間隔
+        release_grace_seconds: lease の解放後、古いバージョンを削除せずに残す秒数
+            (レスポンスを受け取ったクライアントが画像を取得するための猶予)
+    """
+
+    def __init__(
+        self,
+        root: str | os.PathLike,
+        ttl_seconds: float = _DEFAULT_TTL_SECONDS,
+        *,
+        gc_interval_seconds: float = _DEFAULT_GC_INTERVAL_SECONDS,
+        release_grace_seconds: float = _DEFAULT_RELEASE_GRACE_SECONDS,
+    ):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        self.gc_interval_seconds = gc_interval_seconds
+        self.release_grace_seconds = release_grace_seconds
+        self._gc_lock = threading.Lock()
+
+    def checkout(self, site: str, hotel_id: str, scrape: ScrapeFunc) -> Lease:
+        """
+        ホテルの画像を取得する。期限内にダウンロード済みでなければ scrape で取得する
+
+        返された Lease を release() するまでは画像が削除されないことを保証する
+
+        引数:
+            site: サイト名 ("tour" など)
+            hotel_id: ホテルID
+            scrape: (hotel_id, 保存先ディレクトリ) を受け取り、保存したパスを返す関数
+        """
+        hotel_dir = self._hotel_dir(site, hotel_id)
+        hotel_dir.mkdir(parents=True, exist_ok=True)
+
+        # 同じホテルへの同時リクエストは先行するダウンロードの完了を待って結果を共有する
+        with _file_lock(hotel_dir / _LOCK_FILE):
+            version_dir = self._latest_version(hotel_dir)
+            if version_dir is None:
+                version_dir = hotel_dir / f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+                version_dir.mkdir()
+                downloaded = scrape(hotel_id, str(version_dir))
+                if not downloaded:
+                    shutil.rmtree(version_dir, ignore_errors=True)
+                    return Lease([], None)
+                _write_manifest(version_dir, downloaded)
+
+            lease_path = (
+                version_dir / f"{_LEASE_PREFIX}{os.getpid()}-{uuid.uuid4().hex}"
+            )
+            lease_path.touch()
+            return Lease(_read_manifest(version_dir), lease_path)
+
+    @contextmanager
+    def acquire(
+        self, site: str, hotel_id: str, scrape: ScrapeFunc
+    ) -> Iterator[List[str]]:
+        """checkout の with 文版。with 文の間だけ画像パスのリストを利用できる"""
+        lease = self.checkout(site, hotel_id, scrape)
+        try:
+            yield lease.images
+        finally:
+            lease.release()
+
+    def url_path(self, image_path: str) -> str:
+        """画像パスをルートディレクトリからの相対パス (URL 用に / 区切り) にする"""
+        return Path(image_path).resolve().relative_to(self.root.resolve()).as_posix()
+
+    def image_key(self, image_path: str) -> str:
+        """
+        画像のバージョンによらない ID (<site>/<hotel_id>/<ファイル名>) を返す
+
+        画像のパスはダウンロードし直すたびに変わり、古いバージョンは削除されるため、
+        画像をインデックスなどに登録するときはこの ID を使う
+        """
+        parts = Path(self.url_path(image_path)).parts
+        if len(parts) != 4:
+            raise ValueError(f"ストア内の画像ではありません: {image_path}")
+        site, hotel_id, _, name = parts
+        return f"{site}/{hotel_id}/{name}"
+
+    def collect_garbage(self) -> int:
+        """
+        使用中でない古いバージョンを削除する
+
+        各ホテルの最新バージョンは TTL が切れるまで残す。
+        スクレイピング中などでロックされているホテルは待たずに読み飛ばし、次回に削除する
+
+        戻り値:
+            削除したバージョン数
+        """
+        removed = 0
+        now = time.time()
+        for hotel_dir in self.root.glob("*/*"):
+            if not hotel_dir.is_dir():
+                continue
+            with _file_lock(hotel_dir / _LOCK_FILE, blocking=False) as locked:
+                if locked:
+                    removed += self._collect_hotel(hotel_dir, now)
+        return removed
+
+    def collect_garbage_in_background(self) -> bool:
+        """
+        前回から gc_interval_seconds 以上経っていれば、別スレッドでガベージコレクションを始める
+
+        前回の実行時刻はルートディレクトリに記録するため、同じルートを使う複数のプロセスで
+        それぞれ呼び出しても、間隔内に実行されるのはおおむね 1 回になる
+
+        戻り値:
+            ガベージコレクションを始めた場合は True
+        """
+        stamp = self.root / _GC_STAMP_FILE
+        with self._gc_lock:
+            try:
+                if time.time() - stamp.stat().st_mtime < self.gc_interval_seconds:
+                    return False
+            except FileNotFoundError:
+                pass
+            stamp.touch()
+        threading.Thread(
+            target=self._collect_garbage_logged, name="image-gc", daemon=True
+        ).start()
+        return True
+
+    def _collect_garbage_logged(self) -> None:
+        try:
+            removed = self.collect_garbage()
+        except OSError as exc:
+            print(f"画像のガベージコレクションに失敗しました: {exc}")
+            return
+        if removed:
+            print(f"使用されていない画像を {removed} 件削除しました")
+
+    def _collect_hotel(self, hotel_dir: Path, now: float) -> int:
+        removed = 0
+        latest = self._latest_version(hotel_dir)
+        for version_dir in hotel_dir.iterdir():
+            if not version_dir.is_dir() or version_dir == latest:
+                continue
+            if _has_live_lease(version_dir):
+                continue
+            # lease の作成・解放でディレクトリの更新時刻が変わる。
+            # 解放直後のものは、クライアントが画像を取得し終えるまで残す
+            if now - version_dir.stat().st_mtime < self.release_grace_seconds:
+                continue
+            # ダウンロード途中 (manifest なし) のものは TTL が切れるまで残す
+            if not (version_dir / _MANIFEST_FILE).exists():
+                if now - version_dir.stat().st_mtime < self.ttl_seconds:
+                    continue
+            shutil.rmtree(version_dir, ignore_errors=True)
+            removed += 1
+        return removed
+
+    def _hotel_dir(self, site: str, hotel_id: str) -> Path:
+        for part in (site, hotel_id):
+            if not part or "/" in part or "\\" in part or part in (".", ".."):
+                raise ValueError(f"不正なID: {part!r}")
+        return self.root / site / hotel_id
+
+    def _latest_version(self, hotel_dir: Path) -> Optional[Path]:
+        """TTL 内に完了した最新バージョンを返す"""
+        now = time.time()
+        candidates = []
+        for version_dir in hotel_dir.iterdir():
+            manifest = version_dir / _MANIFEST_FILE
+            if version_dir.is_dir() and manifest.exists():
+                mtime = manifest.stat().st_mtime
+                if now - mtime < self.ttl_seconds:
+                    candidates.append((mtime, version_dir))
+        if not candidates:
+            return None
+        return max(candidates)[1]
+
+
+def _write_manifest(version_dir: Path, images: List[str]) -> None:
+    tmp_path = version_dir / (_MANIFEST_FILE + ".tmp")
+    tmp_path.write_text(json.dumps([os.path.basename(p) for p in images]))
+    os.replace(tmp_path, version_dir / _MANIFEST_FILE)
+
+
+def _read_manifest(version_dir: Path) -> List[str]:
+    names = json.loads((version_dir / _MANIFEST_FILE).read_text())
+    return [str(version_dir / name) for name in names]
+
+
+def _has_live_lease(version_dir: Path) -> bool:
+    for lease in version_dir.glob(f"{_LEASE_PREFIX}*"):
+        pid = lease.name[len(_LEASE_PREFIX) :].split("-", 1)[0]
+        try:
+            os.kill(int(pid), 0)
+        except (ValueError, ProcessLookupError):
+            # 異常終了したプロセスの lease は無視して削除する
+            lease.unlink(missing_ok=True)
+            continue
+        except PermissionError:
+            pass
+        return True
+    return False
+
+
+@contextmanager
+def _file_lock(path: Path, blocking: bool = True) -> Iterator[bool]:
+    """
+    排他ロックを取る。blocking=False の場合は待たずに、取れたかどうかを返す
+    """
+    with open(path, "w") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,84 @@
+"""CLIP の推論精度 (fp32 / int8 / bf16) ごとの速度と埋め込みのずれを比較するサンプルスクリプト
+
+sample_images/ の画像を精度ごとにエンコードし、次の値を表示します。
+
+- スループット (画像/秒): モデルの読み込みと画像のデコードを除いた、エンコードにかかった時間から計算
+- 埋め込みのずれ: fp32 の埋め込みとのコサイン類似度 (平均と最小)
+- 類似度のずれ: 全組み合わせの類似度行列の、fp32 との差の絶対値の最大
+
+推論のスレッド数は CLIP_NUM_THREADS で指定できます。
+パッケージを import するため、リポジトリのルートで次のように実行してください:
+    uv run python -m samples.clip_precision_benchmark
+"""
+
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+# キャッシュ済みの埋め込みを使うと計測にならないため、特徴量キャッシュを無効にする
+os.environ["HOTEL_MATCHING_CACHE"] = "0"
+
+from hotel_matching.matchers.clip_matcher import (  # noqa: E402
+    PRECISIONS,
+    embed_images,
+    preload_models,
+)
+
+# 計測条件
+MODEL_NAME = "ViT-B/32"
+IMAGE_REPEAT = 8  # 画像数が少ないので、同じ画像を別名でコピーしてバッチを埋める
+BATCH_SIZE = 16
+REPEAT = 3
+
+# 同じパスは 1 回しかエンコードされないため、別々のファイルとしてコピーする
+work_dir = tempfile.mkdtemp(prefix="clip_benchmark_")
+images = []
+for i in range(IMAGE_REPEAT):
+    for path in sorted(glob.glob("sample_images/*")):
+        images.append(os.path.join(work_dir, f"{i}_{os.path.basename(path)}"))
+        shutil.copyfile(path, images[-1])
+
+
+def run(precision):
+    """REPEAT 回エンコードして最短時間と埋め込みを返す"""
+    preload_models([MODEL_NAME], precision=precision)
+    # 1 回目は画像のデコードを含むので計測から除く
+    embed_images(images, model_name=MODEL_NAME, precision=precision)
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        _, embeddings = embed_images(
+            images, model_name=MODEL_NAME, batch_size=BATCH_SIZE, precision=precision
+        )
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, embeddings
+
+
+print(f"モデル: {MODEL_NAME} / 画像数: {len(images)} / バッチサイズ: {BATCH_SIZE}")
+try:
+    baseline = None
+    for precision in PRECISIONS:
+        try:
+            seconds, embeddings = run(precision)
+        except (RuntimeError, ValueError) as exc:
+            print(f"\n{precision}: 実行できませんでした ({exc})")
+            continue
+
+        print(f"\n{precision}")
+        print(f"  {seconds:.3f}秒 ({len(images) / seconds:.1f} 画像/秒)")
+        if baseline is None:
+            baseline_seconds, baseline = seconds, embeddings
+            continue
+
+        cosine = np.einsum("ij,ij->i", embeddings, baseline)
+        similarity_error = np.abs(embeddings @ embeddings.T - baseline @ baseline.T)
+        print(f"  fp32 比: {baseline_seconds / seconds:.2f}倍")
+        print(f"  埋め込みのずれ: 平均 {cosine.mean():.4f} / 最小 {cosine.min():.4f}")
+        print(f"  類似度のずれ: 最大 {similarity_error.max():.4f}")
+finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
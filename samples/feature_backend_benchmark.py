@@ -0,0 +1,94 @@
+"""特徴点マッチングの対応付け方式 (総当たり / FLANN-LSH) を比較するサンプルスクリプト
+
+sample_images/ の全組み合わせ (同じ画像同士を除く) について、特徴点数ごとに次の値を表示します。
+
+- 処理時間とスループット (特徴点抽出を除いた、ペアの検証にかかった時間)
+- 再現率: 総当たりで一致したペアのうち、FLANN でも一致したペアの割合
+- インライア再現率: 総当たりのインライア数の合計に対する、FLANN で得られたインライア数の割合
+
+最大の特徴点数で FLANN の速度向上とインライア再現率が下限 (MIN_SPEEDUP / MIN_INLIER_RECALL) を
+下回った場合は終了コード 1 で終了するので、環境を変えたときの確認にも使えます。
+
+パッケージを import するため、リポジトリのルートで次のように実行してください:
+    uv run python -m samples.feature_backend_benchmark
+"""
+
+import glob
+import sys
+import time
+
+from hotel_matching.matchers.feature_matcher import compare_feature, prepare_feature
+
+# 計測条件
+FEATURE_COUNTS = [1000, 3000, 5000]
+THRESHOLD = 0.0
+WORKERS = 1  # 対応付け方式の差だけを見るため逐次実行で計測する
+REPEAT = 3
+# 最大の特徴点数 (5000) で期待する下限 (sample_images/ の 6 枚で 3.4 倍・0.96 を計測)
+MIN_SPEEDUP = 3.0
+MIN_INLIER_RECALL = 0.95
+
+images = sorted(glob.glob("sample_images/*"))
+# 処理時間は全組み合わせ、再現率は同じ画像同士を除いたペアで計算する
+compared_count = len(images) ** 2
+pair_count = len(images) * (len(images) - 1)
+
+
+def run(backend, nfeatures):
+    """REPEAT 回実行して最短時間と結果を返す"""
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        matches = compare_feature(
+            images,
+            images,
+            THRESHOLD,
+            orb_nfeatures=nfeatures,
+            workers=WORKERS,
+            matcher_backend=backend,
+        )
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    # 同じ画像同士を除き、RANSAC でインライアが得られたペアだけを一致とみなす
+    return best, {
+        (m["image1"], m["image2"]): m
+        for m in matches
+        if m["image1"] != m["image2"] and m.get("inlier_count")
+    }
+
+
+print(f"画像数: {len(images)} (同じ画像同士を除くペア数: {pair_count})")
+for nfeatures in FEATURE_COUNTS:
+    # 特徴点はキャッシュに保存されるので、先に計算して計測から除く
+    prepare_feature(images, orb_nfeatures=nfeatures)
+
+    bf_time, bf_matches = run("bf", nfeatures)
+    flann_time, flann_matches = run("flann", nfeatures)
+
+    found = bf_matches.keys() & flann_matches.keys()
+    recall = len(found) / len(bf_matches) if bf_matches else 1.0
+    bf_inliers = sum(m["inlier_count"] for m in bf_matches.values())
+    flann_inliers = sum(
+        min(flann_matches[key]["inlier_count"], bf_matches[key]["inlier_count"])
+        for key in found
+    )
+    inlier_recall = flann_inliers / bf_inliers if bf_inliers else 1.0
+
+    print(f"\norb_nfeatures={nfeatures}")
+    print(f"  bf   : {bf_time:.3f}秒 ({compared_count / bf_time:.1f} ペア/秒)")
+    print(
+        f"  flann: {flann_time:.3f}秒 ({compared_count / flann_time:.1f} ペア/秒, "
+        f"{bf_time / flann_time:.2f}倍)"
+    )
+    print(f"  再現率: {recall:.3f} / インライア再現率: {inlier_recall:.3f}")
+
+speedup = bf_time / flann_time
+if speedup < MIN_SPEEDUP or inlier_recall < MIN_INLIER_RECALL:
+    print(
+        f"\nNG: orb_nfeatures={nfeatures} で {speedup:.2f}倍 / インライア再現率 {inlier_recall:.3f} "
+        f"(下限 {MIN_SPEEDUP}倍 / {MIN_INLIER_RECALL})"
+    )
+    sys.exit(1)
+print(
+    f"\nOK: orb_nfeatures={nfeatures} で {speedup:.2f}倍 / インライア再現率 {inlier_recall:.3f}"
+)
@@ -0,0 +1,37 @@
+"""Gemini マッチャーの並列ディスパッチをフェイククライアントで計測するサンプルスクリプト
+
+ネットワークや API キーは不要です。応答待ち時間・エラー率・同時実行数を変えて
+スループットとリトライの効果を確認できます。
+
+パッケージを import するため、リポジトリのルートで次のように実行してください:
+    uv run python -m samples.gemini_load_benchmark
+"""
+
+import glob
+import os
+import time
+
+# キャッシュ済みの判定を使うと計測にならないため、キャッシュを無効にする
+os.environ["HOTEL_MATCHING_CACHE"] = "0"
+
+from hotel_matching.matchers.gemini_client import FakeGeminiClient  # noqa: E402
+from hotel_matching.matchers.gemini_matcher import compare_gemini  # noqa: E402
+
+# 計測条件
+LATENCY = 0.5  # 1 回の呼び出しにかかる秒数
+FAILURE_RATE = 0.2  # 一時的なエラーの発生率
+TOP_N = 6
+
+images = sorted(glob.glob("sample_images/*"))
+
+client = FakeGeminiClient(latency=LATENCY, failure_rate=FAILURE_RATE, seed=0)
+
+start = time.perf_counter()
+matches = compare_gemini(images, images, 0.8, top_n=TOP_N, client=client)
+elapsed = time.perf_counter() - start
+
+failed = sum(1 for match in matches if "error" in match)
+print(f"ペア数: {len(matches)} (失敗: {failed})")
+print(f"呼び出し回数 (リトライ含む): {client.calls}")
+print(f"処理時間: {elapsed:.2f}秒 (逐次実行の目安: {client.calls * LATENCY:.2f}秒)")
+print("※ GEMINI_MAX_IN_FLIGHT / GEMINI_RPM / GEMINI_MAX_RETRIES で挙動を変更できます")
@@ -17,6 +17,7 @@ const methodThresholds = {
     feature: 0.04,
     clip: 0.80,
     gemini: 0.80,
+    cascade: 0.04,
 };
 
 const methodDisplayNames = {
@@ -25,6 +26,7 @@ const methodDisplayNames = {
     feature: '特徴点マッチング (ORB+RANSAC)',
     clip: 'CLIP (ViT-B/32)',
     gemini: 'Gemini (AI判定)',
+    cascade: 'カスケード (pHash → CLIP → 特徴点)',
 };
 
 const methodHints = {
@@ -49,9 +51,14 @@ const methodHints = {
         cons: '処理時間が長い、完全一致検出には不向き'
     },
     gemini: {
-        summary: 'Geminiが2つの画像が同じホテルかを判定し、一致・不一致を判断 ※閾値は未使用です',
+        summary: 'pHashの類似度が高い上位のペアについて、Geminiが2つの画像が同じホテルかを判定し、一致・不一致を判断 ※閾値は未使用です',
         pros: 'AIが文脈を理解して判定、かなり複雑なケースにも対応可能',
         cons: 'API利用料金がかかるため全通り比較は非現実的、処理時間が長い'
+    },
+    cascade: {
+        summary: 'pHashでほぼ同一のペアを確定・明らかに異なるペアを除外し、CLIPで上位に絞ったペアだけを特徴点マッチングで検証 ※閾値は検証段階で使用',
+        pros: '高コストな比較を上位の候補に限定するため、画像数が多くても高速',
+        cons: '前段で除外されたペアは検証されない、段階ごとの閾値は環境変数で調整'
     }
 };
 
@@ -88,6 +95,15 @@ function hideStatus(element) {
     element.className = 'status-message';
 }
 
+function renderCascadeStats(stats) {
+    const seconds = (value) => `${value.toFixed(2)}秒`;
+    return `
+        <p><strong>pHash:</strong> 一致 ${stats.phash.accepted}組 / 除外 ${stats.phash.rejected}組 / 通過 ${stats.phash.passed}組 (${seconds(stats.phash.seconds)})</p>
+        <p><strong>CLIP:</strong> 除外 ${stats.clip.rejected + stats.clip.pruned}組 / 通過 ${stats.clip.passed}組 (${seconds(stats.clip.seconds)})</p>
+        <p><strong>検証 (${stats.verify.method}):</strong> ${stats.verify.input}組中 ${stats.verify.matched}組が一致 (${seconds(stats.verify.seconds)})</p>
+    `;
+}
+
 function updateMethodHint(method) {
     const hint = methodHints[method];
     if (!hint) {
@@ -114,11 +130,11 @@ function setButtonLoading(button, loading) {
     }
 }
 
-function renderImageCell(name, fallbackLabel) {
+function renderImageCell(name, fallbackLabel, imageBase = '/images') {
     if (name) {
         return `
             <div class="match-image">
-                <img src="/images/${name}" alt="${name}">
+                <img src="${imageBase}/${name}" alt="${name}">
                 <div class="label">${name}</div>
             </div>
         `;
@@ -191,6 +207,7 @@ async function handleProcess() {
             <p><strong>airtrip.jpの画像数:</strong> ${data.airtrip_count}枚</p>
             <p><strong>総比較回数:</strong> ${data.total_comparisons}回</p>
             <p><strong>類似度閾値:</strong> ${data.threshold.toFixed(2)}</p>
+            ${data.stats ? renderCascadeStats(data.stats) : ''}
             <p style="font-size: 1.2rem; color: #667eea; margin-top: 10px;">
                 <strong>一致した画像ペア:</strong> ${data.match_count}組
             </p>
@@ -215,8 +232,8 @@ async function handleProcess() {
                                 #${index + 1} - AI判定: ${decisionLabel}（スコア: ${scoreText}）
                             </div>
                             <div class="match-content">
-                                ${renderImageCell(tourImageName, 'tour.ne.jpの画像がありません')}
-                                ${renderImageCell(airtripImageName, 'airtrip.jpの画像がありません')}
+                                ${renderImageCell(tourImageName, 'tour.ne.jpの画像がありません', data.tour_image_base)}
+                                ${renderImageCell(airtripImageName, 'airtrip.jpの画像がありません', data.airtrip_image_base)}
                             </div>
                             <div style="margin-top: 12px; color: #555;">
                                 <strong>コメント:</strong> ${reasonText}
@@ -234,6 +251,8 @@ async function handleProcess() {
                     if (match.clip_model) {
                         detailInfo = `モデル: ${match.clip_model}`;
                     }
+                } else if (match.method === 'cascade') {
+                    detailInfo = `判定段階: ${match.stage}`;
                 }
                 const detailInfoText = detailInfo ? ` (${detailInfo})` : '';
 
@@ -244,11 +263,11 @@ async function handleProcess() {
                         </div>
                         <div class="match-content">
                             <div class="match-image">
-                                <img src="/images/${match.image1}" alt="${match.image1}">
+                                <img src="${data.tour_image_base}/${match.image1}" alt="${match.image1}">
                                 <div class="label">${match.image1}</div>
                             </div>
                             <div class="match-image">
-                                <img src="/images/${match.image2}" alt="${match.image2}">
+                                <img src="${data.airtrip_image_base}/${match.image2}" alt="${match.image2}">
                                 <div class="label">${match.image2}</div>
                             </div>
                         </div>
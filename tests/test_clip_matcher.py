@@ -0,0 +1,31 @@
+"""CLIP モデルのキャッシュで使う重みのバイト数の見積もりのテスト"""
+
+import unittest
+
+import torch
+
+from hotel_matching.matchers.clip_matcher import _model_bytes
+
+
+class ModelBytesTest(unittest.TestCase):
+    def _model(self):
+        return torch.nn.Sequential(torch.nn.Linear(64, 32), torch.nn.LayerNorm(32))
+
+    def test_counts_fp32_weights(self):
+        # Linear (64×32 + 32) と LayerNorm (32 + 32) の float32
+        self.assertEqual(_model_bytes(self._model()), (64 * 32 + 32 + 64) * 4)
+
+    def test_counts_dynamically_quantized_weights(self):
+        model = self._model()
+        torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+
+        # int8 の重みは 1 バイト、バイアスと LayerNorm は float32 のまま。
+        # 量子化のスケール (float32) とゼロ点 (int64) も含む
+        expected = 64 * 32 + (32 + 64) * 4 + 4 + 8
+        self.assertEqual(_model_bytes(model), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+"""ローカルのスタブ HTTP サーバーに対する並列ダウンロードのテスト"""
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from hotel_matching.scraper.downloader import create_session, download_images
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """
+    パスに応じて応答を返すスタブ
+
+    /ok/<name>    画像の代わりに name のバイト列を返す (少し待ってから応答する)
+    /missing      404 を返す
+    /flaky/<name> 各パスへの最初のリクエストだけ 503 を返す
+    /hang         タイムアウトより長く待ってから応答する
+    """
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            first = self.path not in server.seen
+            server.seen.add(self.path)
+        try:
+            if self.path.startswith("/ok/"):
+                time.sleep(0.05)
+                self._respond(200, self.path[len("/ok/") :].encode())
+            elif self.path.startswith("/flaky/") and first:
+                self._respond(503, b"")
+            elif self.path.startswith("/flaky/"):
+                self._respond(200, self.path[len("/flaky/") :].encode())
+            elif self.path == "/hang":
+                time.sleep(1.0)
+                self._respond(200, b"late")
+            else:
+                self._respond(404, b"")
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _respond(self, status, body):
+        try:
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # タイムアウトしたクライアントは応答を待たずに切断している
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadImagesTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.seen = set()
+        self.server.in_flight = 0
+        self.server.max_in_flight = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_port}"
+        self.session = create_session(backoff_factor=0)
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.session.close()
+
+    def _targets(self, paths):
+        return [
+            (f"{self.base}{path}", os.path.join(self.dir, f"{i}.jpg"))
+            for i, path in enumerate(paths)
+        ]
+
+    def test_saves_images_in_order_and_skips_failures(self):
+        targets = self._targets(["/ok/a", "/missing", "/ok/b"])
+
+        saved = download_images(targets, session=self.session)
+
+        self.assertEqual(saved, [targets[0][1], targets[2][1]])
+        with open(saved[0], "rb") as f:
+            self.assertEqual(f.read(), b"a")
+
+    def test_per_host_limit_is_shared_between_concurrent_calls(self):
+        def run(prefix):
+            targets = [
+                (f"{self.base}/ok/{prefix}{i}", os.path.join(self.dir, f"{prefix}{i}"))
+                for i in range(6)
+            ]
+            download_images(
+                targets, session=self.session, max_workers=6, per_host_limit=2
+            )
+
+        threads = [threading.Thread(target=run, args=(p,)) for p in "xyz"]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.server.requests), 18)
+        self.assertLessEqual(self.server.max_in_flight, 2)
+
+    def test_retries_transient_status(self):
+        targets = self._targets(["/flaky/c"])
+
+        saved = download_images(targets, session=self.session)
+
+        self.assertEqual(saved, [targets[0][1]])
+        self.assertEqual(self.server.requests, ["/flaky/c", "/flaky/c"])
+
+    def test_does_not_retry_read_timeout(self):
+        targets = self._targets(["/hang"])
+
+        saved = download_images(targets, session=self.session, timeout=0.2)
+
+        self.assertEqual(saved, [])
+        self.assertEqual(self.server.requests, ["/hang"])
+
+
+if __name__ == "__main__":
+    unittest.main()
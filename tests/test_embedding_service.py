@@ -0,0 +1,181 @@
+"""埋め込みサービスのクライアント・サーバー間の往復、フォールバック、バッチ化のテスト"""
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+
+from hotel_matching.embedding_service import (
+    EmbeddingClient,
+    EmbeddingServer,
+    _Batcher,
+)
+from hotel_matching.matchers import clip_matcher
+
+
+class _FakeEncoder:
+    """
+    CLIP の代わりに、画像の平均輝度から 2 次元の埋め込みを作るエンコーダー
+
+    get_model / encode_tensors の差し替えに使い、推論 1 回ごとの枚数を batches に記録する
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def get_model(self, model_name, precision):
+        return "model", self.preprocess
+
+    @staticmethod
+    def preprocess(image):
+        return float(np.asarray(image.convert("L")).mean()) / 255
+
+    def encode_tensors(self, model, tensors, precision):
+        time.sleep(self.latency)
+        with self._lock:
+            self.batches.append(len(tensors))
+        return np.array([[value, 1.0] for value in tensors], dtype=np.float32)
+
+    def patch(self, test):
+        for name in ("get_model", "encode_tensors"):
+            patcher = mock.patch.object(clip_matcher, name, getattr(self, name))
+            patcher.start()
+            test.addCleanup(patcher.stop)
+
+
+class ClientServerTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        self.encoder = _FakeEncoder()
+        self.encoder.patch(self)
+
+        self.socket_path = os.path.join(self.dir, "clip.sock")
+        self.server = EmbeddingServer(self.socket_path, max_batch=8, max_wait=0.01)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.close)
+        for _ in range(100):
+            if os.path.exists(self.socket_path):
+                break
+            time.sleep(0.01)
+
+    def _image(self, name, gray):
+        path = os.path.join(self.dir, name)
+        Image.new("L", (8, 8), gray).save(path)
+        return path
+
+    def test_round_trip(self):
+        dark = self._image("dark.png", 0)
+        bright = self._image("bright.png", 255)
+        missing = os.path.join(self.dir, "missing.png")
+        client = EmbeddingClient(self.socket_path, timeout=5)
+
+        result = client.encode([dark, missing, bright], "ViT-B/32", "fp32")
+
+        # 読み込めなかった画像は結果に含まれず、キーは依頼したときのパスのまま
+        self.assertEqual(set(result), {dark, bright})
+        np.testing.assert_allclose(result[dark], [0.0, 1.0])
+        np.testing.assert_allclose(result[bright], [1.0, 1.0])
+        self.assertEqual(client.stats()["images"], 2)
+
+    def test_server_error_falls_back(self):
+        client = EmbeddingClient(self.socket_path, timeout=5)
+        with mock.patch.object(
+            clip_matcher, "get_model", side_effect=ValueError("不明な精度")
+        ):
+            result = client.encode([self._image("a.png", 128)], "ViT-B/32", "fp64")
+
+        self.assertIsNone(result)
+
+
+class FallbackTest(unittest.TestCase):
+    def test_unreachable_server_is_not_retried_immediately(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            client = EmbeddingClient(os.path.join(tmp, "absent.sock"), timeout=1)
+
+            self.assertIsNone(client.encode(["a.png"], "ViT-B/32", "fp32"))
+            with mock.patch("hotel_matching.embedding_service.Client") as connect:
+                self.assertIsNone(client.encode(["a.png"], "ViT-B/32", "fp32"))
+            connect.assert_not_called()
+
+    def test_clip_encodes_locally_without_service(self):
+        with (
+            mock.patch.object(clip_matcher, "lookup", return_value=None),
+            mock.patch.object(clip_matcher, "encode_remote", return_value=None),
+            mock.patch.object(clip_matcher, "_encode_local") as encode_local,
+        ):
+            clip_matcher._encode_images(["a.png"], 32, "ViT-B/32", "fp32")
+
+        # サービスを利用できなければ、このプロセスでモデルを読み込んでエンコードする
+        self.assertEqual(encode_local.call_args.args[0], ["a.png"])
+
+    def test_duplicate_paths_are_encoded_once(self):
+        def encode_remote(paths, model_name, precision):
+            return {p: np.ones(2, dtype=np.float32) for p in paths}
+
+        with (
+            mock.patch.object(clip_matcher, "lookup", return_value=None),
+            mock.patch.object(clip_matcher, "store"),
+            mock.patch.object(
+                clip_matcher, "encode_remote", side_effect=encode_remote
+            ) as remote,
+        ):
+            paths, embeddings = clip_matcher._encode_images(
+                ["a.png", "b.png", "a.png"], 32, "ViT-B/32", "fp32"
+            )
+
+        self.assertEqual(remote.call_args.args[0], ["a.png", "b.png"])
+        self.assertEqual(paths, ["a.png", "b.png", "a.png"])
+        self.assertEqual(tuple(embeddings.shape), (3, 2))
+
+
+class BatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.encoder = _FakeEncoder()
+        self.encoder.patch(self)
+
+    def _submit_concurrently(self, batcher, jobs):
+        futures = [batcher.submit(key, tensors) for key, tensors in jobs]
+        return [future.result(timeout=5) for future in futures]
+
+    def test_merges_requests_within_max_wait(self):
+        batcher = _Batcher(max_batch=64, max_wait=0.2)
+        key = ("ViT-B/32", "fp32")
+
+        results = self._submit_concurrently(
+            batcher, [(key, [0.1, 0.2]), (key, [0.3]), (key, [0.4, 0.5])]
+        )
+
+        self.assertEqual(self.encoder.batches, [5])
+        # まとめて推論しても、各依頼には自分の画像の埋め込みだけが返る
+        self.assertEqual([len(r) for r in results], [2, 1, 2])
+        np.testing.assert_allclose(results[1][:, 0], [0.3])
+        self.assertEqual(batcher.stats()["requests"], 3)
+
+    def test_splits_by_model_and_max_batch(self):
+        batcher = _Batcher(max_batch=2, max_wait=0.2)
+
+        self._submit_concurrently(
+            batcher,
+            [
+                (("ViT-B/32", "fp32"), [0.1]),
+                (("ViT-B/32", "int8"), [0.2]),
+                (("ViT-B/32", "int8"), [0.3, 0.4, 0.5]),
+            ],
+        )
+
+        # 精度の異なる依頼は別のバッチになり、同じ精度の依頼はまとめた上で
+        # 1 回の推論が max_batch 枚までになるよう分割される
+        self.assertEqual(self.encoder.batches, [1, 2, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
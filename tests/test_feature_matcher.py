@@ -0,0 +1,50 @@
+"""特徴点マッチングの対応付け方式 (総当たり / FLANN-LSH) のテスト"""
+
+import glob
+import os
+import unittest
+from unittest import mock
+
+from hotel_matching.matchers import feature_matcher
+from hotel_matching.matchers.feature_matcher import compare_feature
+
+_IMAGES = sorted(glob.glob(os.path.join("sample_images", "*")))
+
+
+def _pairs_with_inliers(matches):
+    return {
+        (m["image1"], m["image2"]): m["inlier_count"]
+        for m in matches
+        if m["image1"] != m["image2"] and m.get("inlier_count")
+    }
+
+
+@unittest.skipUnless(_IMAGES, "sample_images/ がありません")
+class FlannBackendTest(unittest.TestCase):
+    def _compare(self, backend, workers):
+        return compare_feature(
+            _IMAGES, _IMAGES, 0.0, workers=workers, matcher_backend=backend
+        )
+
+    def test_builds_one_index_per_train_image(self):
+        build = mock.Mock(wraps=feature_matcher._build_lsh_index)
+        with mock.patch.object(feature_matcher, "_build_lsh_index", build):
+            self._compare("flann", workers=4)
+
+        self.assertEqual(build.call_count, len(_IMAGES))
+
+    def test_results_do_not_depend_on_worker_count(self):
+        self.assertEqual(self._compare("flann", 1), self._compare("flann", 4))
+
+    def test_inlier_recall_against_brute_force(self):
+        # samples/feature_backend_benchmark.py と同じ指標 (1000 特徴点で約 0.99)
+        bf = _pairs_with_inliers(self._compare("bf", 1))
+        flann = _pairs_with_inliers(self._compare("flann", 1))
+
+        self.assertEqual(bf.keys() - flann.keys(), set())
+        recalled = sum(min(flann[key], bf[key]) for key in bf)
+        self.assertGreaterEqual(recalled / sum(bf.values()), 0.95)
+
+
+if __name__ == "__main__":
+    unittest.main()
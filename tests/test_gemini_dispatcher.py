@@ -0,0 +1,140 @@
+"""Gemini ディスパッチャの同時実行数・レート制限・リトライのテスト"""
+
+import threading
+import time
+import unittest
+
+from google.api_core import exceptions as api_exceptions
+
+from hotel_matching.matchers.gemini_client import (
+    GeminiDispatcher,
+    TokenBucket,
+    is_transient_error,
+)
+
+
+class _RecordingClient:
+    """呼び出し回数と同時実行数を記録し、errors の例外を順に送出してから応答するクライアント"""
+
+    model_name = "recording"
+
+    def __init__(self, latency=0.0, errors=()):
+        self.latency = latency
+        self.errors = list(errors)
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def generate(self, parts, timeout):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            error = self.errors.pop(0) if self.errors else None
+        try:
+            time.sleep(self.latency)
+            if error is not None:
+                raise error
+            return "ok"
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def _run_concurrently(dispatchers, requests):
+    threads = [
+        threading.Thread(target=dispatcher.run, args=(requests,))
+        for dispatcher in dispatchers
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class SharedLimitTest(unittest.TestCase):
+    def test_shared_semaphore_caps_in_flight_across_dispatchers(self):
+        client = _RecordingClient(latency=0.05)
+        in_flight = threading.BoundedSemaphore(2)
+        dispatchers = [
+            GeminiDispatcher(
+                client, max_in_flight=2, requests_per_minute=0, in_flight=in_flight
+            )
+            for _ in range(3)
+        ]
+
+        _run_concurrently(dispatchers, [["parts"]] * 4)
+
+        self.assertEqual(client.calls, 12)
+        self.assertLessEqual(client.max_in_flight, 2)
+
+    def test_shared_bucket_limits_rate_across_dispatchers(self):
+        client = _RecordingClient()
+        # 容量 2、毎秒 20 トークン: 10 件の送信には少なくとも (10 - 2) / 20 = 0.4 秒かかる
+        bucket = TokenBucket(rate=20, capacity=2)
+        dispatchers = [
+            GeminiDispatcher(client, max_in_flight=5, rate_limiter=bucket)
+            for _ in range(2)
+        ]
+
+        start = time.monotonic()
+        _run_concurrently(dispatchers, [["parts"]] * 5)
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(client.calls, 10)
+        self.assertGreaterEqual(elapsed, 0.35)
+
+
+class RetryTest(unittest.TestCase):
+    def _dispatcher(self, client):
+        return GeminiDispatcher(
+            client, requests_per_minute=0, max_retries=3, sleep=lambda _: None
+        )
+
+    def test_retries_transient_errors(self):
+        client = _RecordingClient(
+            errors=[
+                api_exceptions.ResourceExhausted("quota"),
+                api_exceptions.ServiceUnavailable("unavailable"),
+                TimeoutError("timeout"),
+            ]
+        )
+
+        results = self._dispatcher(client).run([["parts"]])
+
+        self.assertEqual(results, ["ok"])
+        self.assertEqual(client.calls, 4)
+
+    def test_gives_up_after_max_retries(self):
+        client = _RecordingClient(errors=[ConnectionError("reset")] * 5)
+
+        results = self._dispatcher(client).run([["parts"]])
+
+        self.assertIsInstance(results[0], ConnectionError)
+        self.assertEqual(client.calls, 4)
+
+    def test_does_not_retry_permanent_errors(self):
+        for error in (
+            api_exceptions.InvalidArgument("bad request"),
+            api_exceptions.Unauthenticated("bad key"),
+            api_exceptions.PermissionDenied("forbidden"),
+            RuntimeError("empty response"),
+        ):
+            with self.subTest(error=type(error).__name__):
+                client = _RecordingClient(errors=[error])
+
+                results = self._dispatcher(client).run([["parts"]])
+
+                self.assertIs(results[0], error)
+                self.assertEqual(client.calls, 1)
+
+    def test_classifies_errors(self):
+        self.assertTrue(is_transient_error(api_exceptions.InternalServerError("")))
+        self.assertTrue(is_transient_error(api_exceptions.DeadlineExceeded("")))
+        self.assertFalse(is_transient_error(api_exceptions.NotFound("")))
+        self.assertFalse(is_transient_error(ValueError("")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+"""HashIndex の登録・置き換え・別プロセスからの追記の読み込みのテスト"""
+
+import tempfile
+import unittest
+
+from hotel_matching.hash_index import HashIndex
+
+
+class HashIndexTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+
+    def test_skips_duplicate_entries(self):
+        index = HashIndex(self.dir)
+        self.assertEqual(index.add(["a", "b"], [0b1011, 0xFF00]), 2)
+        self.assertEqual(index.add(["a"], [0b1011]), 0)
+
+        self.assertEqual(index.query(0b1010, 1), [("a", 1)])
+        self.assertEqual(len(index), 2)
+
+    def test_replaces_hash_of_existing_id(self):
+        index = HashIndex(self.dir)
+        index.add(["hotel/1.jpg"], [0])
+        self.assertEqual(index.add(["hotel/1.jpg"], [(1 << 64) - 1]), 1)
+
+        # 置き換えられた古いハッシュでは見つからない
+        self.assertEqual(index.query(0, 4), [])
+        self.assertEqual(index.query((1 << 64) - 1, 0), [("hotel/1.jpg", 0)])
+        self.assertEqual(len(index), 1)
+
+    def test_replacement_is_visible_to_other_instances(self):
+        writer = HashIndex(self.dir)
+        reader = HashIndex(self.dir)
+        writer.add(["a"], [0])
+        self.assertEqual(reader.query(0, 0), [("a", 0)])
+
+        writer.add(["a"], [0xFFFF])
+        self.assertEqual(reader.query(0, 0), [])
+        # 読み直しても最後に登録したハッシュだけが残る
+        self.assertEqual(HashIndex(self.dir).query(0xFFFF, 0), [("a", 0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+"""ジョブのイベント履歴の保持数の上限と再接続時の配信のテスト"""
+
+import unittest
+
+from apps.jobs import SUCCEEDED, JobManager
+
+
+class JobEventsTest(unittest.TestCase):
+    def _run(self, n_matches, max_events):
+        def func(job):
+            for i in range(n_matches):
+                job.emit("match", {"index": i})
+            return {"count": n_matches}
+
+        return JobManager(max_workers=1, max_events=max_events).run(func)
+
+    def test_keeps_latest_events_and_final_result(self):
+        job = self._run(n_matches=10, max_events=3)
+
+        self.assertEqual(job.status, SUCCEEDED)
+        # status + match 10 件 + result の 12 件のうち、新しい 3 件だけを保持する
+        self.assertEqual([e["id"] for e in job.events], [9, 10, 11])
+        self.assertEqual(job.events[-1]["event"], "result")
+        self.assertEqual(job.to_dict()["event_count"], 12)
+
+    def test_iter_events_skips_dropped_events(self):
+        job = self._run(n_matches=10, max_events=3)
+
+        self.assertEqual([e["id"] for e in job.iter_events(0)], [9, 10, 11])
+        # Last-Event-ID による再接続では続きのイベントだけを返す
+        self.assertEqual([e["id"] for e in job.iter_events(11)], [11])
+
+    def test_iter_events_without_limit_returns_all(self):
+        job = self._run(n_matches=2, max_events=100)
+
+        events = list(job.iter_events(0))
+        self.assertEqual(
+            [e["event"] for e in events], ["status", "match", "match", "result"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+"""SizedLRU の追い出しと同時読み込みのテスト"""
+
+import threading
+import time
+import unittest
+
+from hotel_matching.lru import SizedLRU
+
+
+class SizedLRUTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        evicted = []
+        lru = SizedLRU(10, on_evict=evicted.append)
+        lru.put("a", "A", 4)
+        lru.put("b", "B", 4)
+        lru.get("a")
+        lru.put("c", "C", 4)
+
+        self.assertEqual(lru.keys(), ["a", "c"])
+        self.assertEqual(evicted, ["b"])
+
+    def test_oversized_value(self):
+        lru = SizedLRU(10)
+        lru.put("a", "A", 4)
+        lru.put("big", "BIG", 20)
+        self.assertEqual(lru.keys(), ["a"])
+
+        # keep_latest では上限を超えていても直前の値だけは保持する
+        lru = SizedLRU(10, keep_latest=True)
+        lru.put("a", "A", 4)
+        lru.put("big", "BIG", 20)
+        self.assertEqual(lru.keys(), ["big"])
+
+    def test_concurrent_loads_of_same_key_run_once(self):
+        lru = SizedLRU(100)
+        calls = []
+
+        def load():
+            calls.append(threading.current_thread().name)
+            time.sleep(0.05)
+            return "value", 1
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(lru.get_or_load("k", load)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["value"] * 5)
+
+    def test_does_not_store_none(self):
+        lru = SizedLRU(100)
+        self.assertIsNone(lru.get_or_load("k", lambda: (None, 0)))
+        self.assertEqual(lru.keys(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()